@@ -0,0 +1,324 @@
+"""
+In-process benchmark for the Hephaestus pipeline.
+
+Samples (or loads) one latent per prompt with a fixed seed, then times the requested
+suites and compares fast paths against their reference implementation:
+
+    python benchmark.py --suite mesh color --mcubes_res 256
+    python benchmark.py --from_cache results/latent_cache --suite color --output bench.json
+    python benchmark.py --suite samplers --num_prompts 3 --compare_samplers ddim:50 dpm++2m unipc:8
+"""
+import os
+# Fix OpenMP conflict on Mac
+os.environ['KMP_DUPLICATE_LIB_OK'] = 'TRUE'
+
+import json
+import time
+import argparse
+import numpy as np
+import torch
+import pytorch_lightning as pl
+
+from sample_stage1 import load_model, get_sampler, get_latent_shape, sample_latents, build_rays, preview_views, resolve_steps
+from utility.mesh_extractor import MeshExtractor
+from utility.camera_bank import num_views, THUMBNAIL_VIEW
+from utility.latent_cache import load_cache_entry, list_cache_entries
+
+import warnings
+warnings.filterwarnings("ignore", category=UserWarning)
+warnings.filterwarnings("ignore", category=DeprecationWarning)
+
+DEFAULT_PROMPTS = ['a robot', 'a wooden chair', 'a red sports car']
+
+
+def synchronize(device):
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    elif device.type == 'mps':
+        torch.mps.synchronize()
+
+
+def timed(fn, device):
+    """
+    Run fn() and return (result, seconds) with device work included in the timing.
+    """
+    synchronize(device)
+    start = time.time()
+    result = fn()
+    synchronize(device)
+    return result, time.time() - start
+
+
+def chamfer_distance(a, b, device, chunk=4096):
+    """
+    Symmetric mean nearest-neighbour distance between two point sets (numpy [N, 3]).
+    """
+    if len(a) == 0 or len(b) == 0:
+        return float('inf')
+    a = torch.from_numpy(np.asarray(a, dtype=np.float32)).to(device)
+    b = torch.from_numpy(np.asarray(b, dtype=np.float32)).to(device)
+
+    def one_way(x, y):
+        dists = []
+        for p in range(0, x.shape[0], chunk):
+            dists.append(torch.cdist(x[p:p+chunk], y).min(-1).values)
+        return torch.cat(dists).mean().item()
+    return 0.5 * (one_way(a, b) + one_way(b, a))
+
+
+def color_error(rgb, ref):
+    """
+    Mean absolute error (0-255 scale) and PSNR between two [N, 3] color arrays in [0, 1].
+    """
+    rgb = np.clip(rgb, 0, 1)
+    ref = np.clip(ref, 0, 1)
+    mse = float(((rgb - ref) ** 2).mean())
+    psnr = float('inf') if mse == 0 else 10 * np.log10(1.0 / mse)
+    return float(np.abs(rgb - ref).mean() * 255), psnr
+
+
+def image_psnr(img, ref):
+    mse = ((img.float() - ref.float()) ** 2).mean().item()
+    return float('inf') if mse == 0 else 10 * np.log10(1.0 / mse)
+
+
+def bench_mesh(model, triplane, device, args):
+    """
+    Dense vs sparse marching cubes at --mcubes_res.
+    """
+    renderer = model.first_stage_model.triplane_decoder
+    results = {}
+    meshes = {}
+    for name, sparse in (('dense', False), ('sparse', True)):
+        extractor = MeshExtractor(renderer, res=args.mcubes_res, iso=10, device=device,
+                                  memory_budget_mb=args.mcubes_budget_mb, sparse=sparse, verbose=False)
+        (vertices, triangles), seconds = timed(lambda: extractor.extract_geometry(triplane), device)
+        meshes[name] = vertices
+        results[name] = {'seconds': seconds, 'vertices': int(len(vertices)), 'triangles': int(len(triangles))}
+    results['sparse']['chamfer_vs_dense'] = chamfer_distance(meshes['sparse'], meshes['dense'], device)
+    results['sparse']['speedup'] = results['dense']['seconds'] / max(results['sparse']['seconds'], 1e-9)
+    return results
+
+
+def bench_color(model, triplane, device, args):
+    """
+    Six-view rendered vertex colors (reference) vs direct point queries.
+    """
+    renderer = model.first_stage_model.triplane_decoder
+    extractor = MeshExtractor(renderer, res=args.mcubes_res, iso=10, device=device,
+                              memory_budget_mb=args.mcubes_budget_mb, sparse=True, verbose=False)
+    vertices, _ = extractor.extract_geometry(triplane)
+
+    results = {'vertices': int(len(vertices))}
+    ref, seconds = timed(lambda: extractor.vertex_colors(triplane, vertices), device)
+    results['render'] = {'seconds': seconds}
+    for samples in (1, 3):
+        extractor.color_samples = samples
+        rgb, seconds = timed(lambda: extractor.point_colors(triplane, vertices), device)
+        mae, psnr = color_error(rgb, ref)
+        results[f'point_x{samples}'] = {
+            'seconds': seconds, 'mae': mae, 'psnr': psnr,
+            'speedup': results['render']['seconds'] / max(seconds, 1e-9),
+        }
+    return results
+
+
+def bench_render(model, triplane, device, args):
+    """
+    Per-view preview rendering (reference) vs packed multi-view rendering, with and without
+    occupancy-grid empty-space skipping and early ray termination.
+    """
+    vae = model.first_stage_model
+    views = preview_views(num_views())
+    rays = build_rays(args.render_res, views).to(device)
+    H = args.render_res
+
+    def per_view():
+        frames = []
+        for v in range(len(views)):
+            rgb, _ = vae.render_triplane_eg3d_decoder(triplane, rays[v:v+1], torch.zeros(1, H, H, 3).to(device))
+            frames.append(rgb)
+        return torch.cat(frames, 0)
+
+    ref, ref_seconds = timed(per_view, device)
+    results = {'views': len(views), 'per_view': {'seconds': ref_seconds}}
+    variants = [(f'packed_{budget}', budget, False, 0.) for budget in (H * H, 2**15, 2**17)]
+    variants.append(('packed_occupancy', 2**15, True, 0.))
+    variants.append(('packed_termination', 2**15, False, args.termination_eps))
+    variants.append(('packed_occupancy_termination', 2**15, True, args.termination_eps))
+    for name, budget, occupancy, eps in variants:
+        rgb, seconds = timed(lambda: vae.render_triplane_eg3d_decoder_views(triplane, rays, budget, occupancy, eps)[0], device)
+        results[name] = {
+            'seconds': seconds,
+            'max_abs_diff': (rgb - ref).abs().max().item(),
+            'mean_abs_diff': (rgb - ref).abs().mean().item(),
+            'speedup': ref_seconds / max(seconds, 1e-9),
+        }
+
+    planes = triplane.reshape(1, 3, -1, triplane.shape[-2], triplane.shape[-1])
+    grid = vae.triplane_decoder.build_occupancy_grid(planes, vae.triplane_render_kwargs)
+    results['packed_occupancy']['occupied_fraction'] = grid.float().mean().item()
+    return results
+
+
+def bench_feature_reuse(model, triplane, device, args, prompt):
+    """
+    Quality vs speed of deep-feature reuse: resamples the prompt from the same noise with
+    --reuse_intervals and compares latents and a rendered thumbnail against the full run.
+    """
+    sampler = get_sampler(model, args.sampler)
+    shape = [model.channels, model.image_size, model.image_size * 3]
+    generator = torch.Generator().manual_seed(args.seed)
+    x_T = torch.randn([1] + shape, generator=generator).to(device)
+    rays = build_rays(args.render_res, [THUMBNAIL_VIEW]).to(device)
+    vae = model.first_stage_model
+    unet = model.model.diffusion_model
+
+    results = {}
+    reference = None
+    for interval in [0] + args.reuse_intervals:
+        kwargs = {'feature_reuse': interval, 'feature_reuse_layer': args.reuse_layer} if interval > 1 else {}
+        (latent, decoded), seconds = timed(
+            lambda: sample_latents(model, sampler, prompt, args.steps, 1, shape, args.cfg_scale, x_T=x_T.clone(), sampler_kwargs=kwargs),
+            device)
+        with torch.no_grad():
+            image = vae.render_triplane_eg3d_decoder_views(decoded, rays, occupancy=True)[0, 0]
+        if reference is None:
+            reference = (latent, image, seconds)
+            results['full'] = {'seconds': seconds}
+            continue
+        results[f'reuse_{interval}'] = {
+            'seconds': seconds,
+            'speedup': reference[2] / max(seconds, 1e-9),
+            'full_calls': unet.full_calls,
+            'partial_calls': unet.partial_calls,
+            'latent_rel_err': ((latent - reference[0]).norm() / reference[0].norm()).item(),
+            'render_psnr': image_psnr(image, reference[1]),
+        }
+    return results
+
+
+def bench_samplers(model, triplane, device, args, prompt):
+    """
+    Few-step samplers vs the first --compare_samplers entry (50-step DDIM by default), all
+    started from the same noise. Entries are 'name' (preset steps) or 'name:steps'.
+    """
+    shape = [model.channels, model.image_size, model.image_size * 3]
+    generator = torch.Generator().manual_seed(args.seed)
+    x_T = torch.randn([1] + shape, generator=generator).to(device)
+    rays = build_rays(args.render_res, [THUMBNAIL_VIEW]).to(device)
+    vae = model.first_stage_model
+
+    results = {}
+    reference = None
+    for entry in args.compare_samplers:
+        name, _, steps = entry.partition(':')
+        steps = resolve_steps(name, int(steps) if steps else None)
+        sampler = get_sampler(model, name)
+        (latent, decoded), seconds = timed(
+            lambda: sample_latents(model, sampler, prompt, steps, 1, shape, args.cfg_scale, x_T=x_T.clone()), device)
+        with torch.no_grad():
+            image = vae.render_triplane_eg3d_decoder_views(decoded, rays, occupancy=True)[0, 0]
+        key = f'{name}_{steps}'
+        if reference is None:
+            reference = (latent, image, seconds)
+            results[key] = {'seconds': seconds}
+            continue
+        results[key] = {
+            'seconds': seconds,
+            'speedup': reference[2] / max(seconds, 1e-9),
+            'latent_rel_err': ((latent - reference[0]).norm() / reference[0].norm()).item(),
+            'render_psnr': image_psnr(image, reference[1]),
+        }
+    return results
+
+
+SUITES = {
+    'mesh': bench_mesh,
+    'color': bench_color,
+    'render': bench_render,
+    'feature_reuse': bench_feature_reuse,
+    'samplers': bench_samplers,
+}
+# suites that resample from the prompt instead of working on the decoded triplane
+PROMPT_SUITES = ('feature_reuse', 'samplers')
+
+
+def load_triplanes(model, configs, device, args):
+    """
+    Yield (name, triplane [1, C, H, W]) for each benchmark input.
+    """
+    if args.from_cache is not None:
+        for path in list_cache_entries(args.from_cache)[:args.num_prompts]:
+            entry = load_cache_entry(path, device)
+            triplane = entry['triplane']
+            if triplane is None:
+                with torch.no_grad():
+                    triplane = model.decode_first_stage(entry['latent'])
+            yield entry['meta'].get('prompt', os.path.basename(path)), triplane[:1]
+        return
+
+    sampler = get_sampler(model, args.sampler)
+    shape = get_latent_shape(configs)
+    for prompt in args.prompts[:args.num_prompts]:
+        pl.seed_everything(args.seed)
+        _, triplane = sample_latents(model, sampler, prompt, args.steps, 1, shape, args.cfg_scale)
+        yield prompt, triplane
+
+
+def print_results(results, indent=0):
+    for key, value in results.items():
+        if isinstance(value, dict):
+            print(' ' * indent + f"{key}:")
+            print_results(value, indent + 2)
+        elif isinstance(value, float):
+            print(' ' * indent + f"{key}: {value:.4f}")
+        else:
+            print(' ' * indent + f"{key}: {value}")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--config", type=str, default='configs/default.yaml')
+    parser.add_argument("--ckpt", type=str, default=None)
+    parser.add_argument("--suite", nargs='+', default=['mesh', 'color'], choices=list(SUITES.keys()))
+    parser.add_argument("--prompts", nargs='+', default=DEFAULT_PROMPTS)
+    parser.add_argument("--num_prompts", type=int, default=1)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--sampler", type=str, default='ddim')
+    parser.add_argument("--steps", type=int, default=50)
+    parser.add_argument("--cfg_scale", type=float, default=7.5)
+    parser.add_argument("--mcubes_res", type=int, default=128)
+    parser.add_argument("--mcubes_budget_mb", type=int, default=2048)
+    parser.add_argument("--render_res", type=int, default=128)
+    parser.add_argument("--termination_eps", type=float, default=1e-3)
+    parser.add_argument("--reuse_intervals", type=int, nargs='+', default=[2, 3, 5],
+                        help="Feature reuse intervals compared against full sampling (feature_reuse suite)")
+    parser.add_argument("--reuse_layer", type=int, default=0)
+    parser.add_argument("--compare_samplers", nargs='+', default=['ddim:50', 'dpm++2m', 'dpm++3m', 'unipc'],
+                        help="Samplers for the samplers suite as name or name:steps; the first one is the reference")
+    parser.add_argument("--from_cache", type=str, default=None,
+                        help="Benchmark cached latents (see sample_stage1 --cache_dir) instead of sampling")
+    parser.add_argument("--output", type=str, default=None, help="Write results as JSON")
+    args = parser.parse_args()
+
+    model, configs, device = load_model(args.config, args.ckpt)
+
+    all_results = {}
+    for prompt, triplane in load_triplanes(model, configs, device, args):
+        print(f"\n=== {prompt} ===")
+        all_results[prompt] = {}
+        for suite in args.suite:
+            if suite in PROMPT_SUITES:
+                all_results[prompt][suite] = SUITES[suite](model, triplane, device, args, prompt)
+            else:
+                all_results[prompt][suite] = SUITES[suite](model, triplane, device, args)
+        print_results(all_results[prompt])
+
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(all_results, f, indent=2)
+        print(f"✓ Results written to {args.output}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,403 @@
+"""
+Persistent generation daemon.
+
+Loads the model once and serves generation jobs over a Unix socket (or TCP port)
+using line-delimited JSON. Each job is one JSON object per line, e.g.
+
+    {"prompt": "a robot", "sampler": "ddim", "steps": 50, "cfg_scale": 7.5, "seed": 42}
+
+and the daemon answers with one JSON event per line:
+
+    {"event": "accepted", "job": 1}
+    {"event": "progress", "job": 1, "stage": "sampling", "step": 10, "total": 50}
+    {"event": "output", "job": 1, "path": "results/default/daemon/a_robot_1234_0_0.ply"}
+    {"event": "done", "job": 1, "outputs": [...], "seconds": 12.3}
+
+Errors are reported as {"event": "error", ...}. The special ops {"op": "ping"} and
+{"op": "shutdown"} are also understood.
+
+With --continuous_batching, the sampling steps of concurrent ddim/dpm jobs share one UNet
+batch (see ldm.models.diffusion.continuous_batching); decoding and post-processing still
+run one job at a time.
+"""
+
+import os
+# Fix OpenMP conflict on Mac
+os.environ['KMP_DUPLICATE_LIB_OK'] = 'TRUE'
+
+import sys
+import json
+import socket
+import argparse
+import threading
+import traceback
+import socketserver
+
+import warnings
+warnings.filterwarnings("ignore", category=UserWarning)
+warnings.filterwarnings("ignore", category=DeprecationWarning)
+
+DEFAULT_SOCKET = '/tmp/hephaestus.sock'
+
+# sample_stage1 options a job may set; the others (config, ckpt, precision, attention, compile,
+# cache_dir, ...) are fixed when the daemon starts, so clients cannot choose where files are written
+JOB_OPTIONS = (
+    'seed', 'samples', 'batch_size', 'sampler', 'steps', 'cfg_scale',
+    'guidance_interval', 'guidance_reuse', 'early_stop_tol', 'feature_reuse', 'feature_reuse_layer',
+    'no_video', 'render_res', 'render_ray_budget', 'occupancy', 'termination_eps',
+    'no_mcubes', 'mcubes_res', 'mcubes_budget_mb', 'mcubes_sparse', 'color_mode',
+    'refine', 'refine_mode', 'refine_iters', 'refine_strength', 'refine_steps', 'no_refine',
+    'cache_triplane',
+)
+
+
+class GenerationService:
+    """
+    Owns the loaded model and the samplers shared by all jobs (camera rays are cached by utility.camera_bank).
+    Every model call holds self.lock since the model is not re-entrant. With continuous batching,
+    the scheduler takes the same lock for each of its ticks, so its batched sampling steps pause
+    while a job on the regular path holds the model instead of running concurrently with it.
+    """
+    def __init__(self, config='configs/default.yaml', ckpt=None, test_folder='daemon',
+                 continuous_batching=False, max_batch=8, cond_cache_dir=None, cache_dir=None):
+        from sample_stage1 import load_model, get_latent_shape, get_parser
+        from ldm.models.diffusion.continuous_batching import ContinuousBatchScheduler
+
+        self.config = config
+        self.model, self.configs, self.device = load_model(config, ckpt, cond_cache_dir)
+        self.shape = get_latent_shape(self.configs)
+        self.defaults = vars(get_parser().parse_args([]))
+        self.defaults['config'] = config
+        self.defaults['test_folder'] = test_folder
+        self.defaults['cache_dir'] = cache_dir
+
+        self.lock = threading.Lock()
+        self.counter_lock = threading.Lock()
+        self.samplers = {}
+        self.job_counter = 0
+
+        self.scheduler = None
+        if continuous_batching:
+            self.scheduler = ContinuousBatchScheduler(self.model, max_batch, lock=self.lock)
+            self.scheduler.start()
+
+    def get_sampler(self, name):
+        from sample_stage1 import get_sampler
+        if name not in self.samplers:
+            self.samplers[name] = get_sampler(self.model, name)
+        return self.samplers[name]
+
+    def make_args(self, job):
+        """
+        Merge a job dict with the sample_stage1 defaults. Unknown keys, and process-wide options
+        that only the daemon's command line sets, raise a ValueError.
+        """
+        from sample_stage1 import resolve_steps
+        args = dict(self.defaults)
+        for key, value in job.items():
+            if key in ('op', 'id', 'prompt'):
+                continue
+            if key == 'video':
+                args['no_video'] = not value
+            elif key == 'mcubes':
+                args['no_mcubes'] = not value
+            elif key in JOB_OPTIONS:
+                args[key] = value
+            elif key in args:
+                raise ValueError(f"Job option {key} is fixed when the daemon starts")
+            else:
+                raise ValueError(f"Unknown job option: {key}")
+        args['steps'] = resolve_steps(args['sampler'], args['steps'])
+        return argparse.Namespace(**args)
+
+    def use_scheduler(self, args):
+        """
+        Whether a job can sample through the continuous batching scheduler. Jobs with sampler
+        options the scheduler does not implement (feature reuse, guidance interval/reuse,
+        early stopping) take the regular path.
+        """
+        from sample_stage1 import get_sampler_kwargs
+        return (self.scheduler is not None and args.cache_dir is None
+                and args.sampler in self.scheduler.SAMPLERS and not get_sampler_kwargs(args))
+
+    def sample_continuous(self, prompt, s, args, progress):
+        """
+        Sample the latents of one job sample through the continuous batching scheduler.
+        The initial noise is drawn from a per-job generator so concurrent jobs stay reproducible.
+        """
+        import torch
+        from sample_stage1 import get_sampler_kwargs
+
+        with self.lock, torch.no_grad():
+            c = self.model.get_learned_conditioning([prompt]).repeat(args.batch_size, 1, 1)
+        generator = torch.Generator()
+        if args.seed is not None:
+            generator.manual_seed(args.seed + s)
+        else:
+            generator.seed()
+        x_T = torch.randn([args.batch_size] + self.shape, generator=generator)
+
+        progress('sampling', step=0, total=args.steps)
+        return self.scheduler.sample(
+            c, args.steps, self.shape, args.sampler,
+            guidance_scale=args.cfg_scale, uncond=torch.zeros_like(c), x_T=x_T,
+            callback=lambda i: progress('sampling', step=i + 1, total=args.steps),
+            **get_sampler_kwargs(args)
+        )
+
+    def postprocess(self, decode_res, s, args, prompt, log_dir, file_basename, job_id, emit, progress, latents=None):
+        from sample_stage1 import render_previews, postprocess_sample
+
+        progress('video')
+        frames = render_previews(self.model, decode_res, args, self.device)
+        outputs = []
+        for b in range(args.batch_size):
+            paths = postprocess_sample(
+                self.model, decode_res, b, log_dir, f"{file_basename}_{s}_{b}",
+                args, self.device, prompt, progress=progress, frames=frames[b], latents=latents
+            )
+            for path in paths:
+                emit({'event': 'output', 'job': job_id, 'path': path})
+            outputs.extend(paths)
+        return outputs
+
+    def next_job_id(self, job):
+        """
+        The job's own 'id', else the next job number.
+        """
+        with self.counter_lock:
+            self.job_counter += 1
+            return job.get('id', self.job_counter)
+
+    def run_job(self, job, emit, job_id=None):
+        """
+        Run one generation job, reporting events through emit(dict).
+        job_id defaults to next_job_id(job).
+
+        Returns:
+            List of written output paths
+        """
+        import time
+        import torch
+        import pytorch_lightning as pl
+        from sample_stage1 import sample_or_load, generate_short_filename
+        from utility.device_utils import empty_cache
+        from utility.latent_cache import LatentCache
+
+        if job_id is None:
+            job_id = self.next_job_id(job)
+        prompt = job.get('prompt')
+        if not prompt:
+            raise ValueError("Job is missing a 'prompt'")
+        args = self.make_args(job)
+        emit({'event': 'accepted', 'job': job_id})
+        start = time.time()
+
+        def progress(stage, **info):
+            emit(dict(event='progress', job=job_id, stage=stage, **info))
+
+        log_dir = os.path.join('results', args.config.split('/')[-1].split('.')[0], args.test_folder)
+        os.makedirs(log_dir, exist_ok=True)
+        file_basename = generate_short_filename(prompt)
+
+        outputs = []
+        if self.use_scheduler(args):
+            for s in range(args.samples):
+                sample = self.sample_continuous(prompt, s, args, progress)
+                with self.lock:
+                    progress('decoding')
+                    with torch.no_grad():
+                        decode_res = self.model.decode_first_stage(sample)
+                    outputs.extend(self.postprocess(decode_res, s, args, prompt, log_dir, file_basename, job_id, emit, progress, sample))
+                    del decode_res
+        else:
+            with self.lock:
+                if args.seed is not None:
+                    pl.seed_everything(args.seed)
+
+                sampler = self.get_sampler(args.sampler)
+                latent_cache = LatentCache(args.cache_dir) if args.cache_dir is not None else None
+
+                for s in range(args.samples):
+                    sample, decode_res = sample_or_load(
+                        self.model, sampler, prompt, s, args, self.shape, self.device, latent_cache, progress=progress
+                    )
+                    outputs.extend(self.postprocess(decode_res, s, args, prompt, log_dir, file_basename, job_id, emit, progress, sample))
+                    del decode_res
+
+        with self.lock:
+            empty_cache(self.device)
+
+        emit({'event': 'done', 'job': job_id, 'outputs': outputs, 'seconds': round(time.time() - start, 2)})
+        return outputs
+
+
+class JobHandler(socketserver.StreamRequestHandler):
+    def emit(self, event):
+        try:
+            self.wfile.write((json.dumps(event) + '\n').encode('utf-8'))
+            self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            # Client went away; keep running the job so its outputs still land on disk
+            pass
+
+    def handle(self):
+        for line in self.rfile:
+            line = line.decode('utf-8').strip()
+            if not line:
+                continue
+            try:
+                job = json.loads(line)
+            except json.JSONDecodeError as e:
+                self.emit({'event': 'error', 'message': f"Invalid JSON: {e}"})
+                continue
+
+            op = job.get('op', 'generate')
+            if op == 'ping':
+                self.emit({'event': 'pong'})
+            elif op == 'shutdown':
+                self.emit({'event': 'shutdown'})
+                threading.Thread(target=self.server.shutdown, daemon=True).start()
+                return
+            elif op == 'generate':
+                service = self.server.service
+                # assigned before anything can fail, so errors carry the id clients match on
+                job_id = service.next_job_id(job)
+                try:
+                    service.run_job(job, self.emit, job_id)
+                except Exception as e:
+                    traceback.print_exc()
+                    self.emit({'event': 'error', 'job': job_id, 'message': str(e)})
+            else:
+                self.emit({'event': 'error', 'message': f"Unknown op: {op}"})
+
+
+class ThreadingUnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+class ThreadingTCPServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+def submit_job(job, socket_path=DEFAULT_SOCKET, host='127.0.0.1', port=None):
+    """
+    Send one job to a running daemon and yield its events until the job finishes.
+    """
+    if port is not None:
+        sock = socket.create_connection((host, port))
+    else:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(socket_path)
+    with sock, sock.makefile('rwb') as f:
+        f.write((json.dumps(job) + '\n').encode('utf-8'))
+        f.flush()
+        for line in f:
+            event = json.loads(line)
+            yield event
+            if event.get('event') in ('done', 'error', 'pong', 'shutdown'):
+                break
+
+
+def serve(args):
+    if args.attention is not None:
+        from utility.attention import set_attention_backend
+        set_attention_backend(args.attention)
+    service = GenerationService(args.config, args.ckpt, args.test_folder,
+                                args.continuous_batching, args.max_batch, args.cond_cache_dir, args.cache_dir)
+
+    if args.precision == 'int8':
+        from utility.quantization import quantize_model_int8
+        quantize_model_int8(service.model, shape=service.shape)
+        service.defaults['precision'] = args.precision
+    elif args.precision == 'bf16':
+        from utility.device_utils import PrecisionPolicy
+        policy = PrecisionPolicy(args.precision, service.device)
+        service.model.set_precision(policy)
+        service.defaults['precision'] = policy.precision
+
+    if args.compile is not None:
+        from utility.compile import compile_model, warmup_compiled
+        compiled = compile_model(service.model, args.compile)
+        batch_size = service.defaults['batch_size']
+        warmup_compiled(service.model, compiled, service.shape, batch_sizes=sorted({1, batch_size}))
+
+    if args.warmup:
+        print("Warming up samplers and rays...")
+        service.get_sampler(service.defaults['sampler'])
+        from sample_stage1 import build_rays, preview_views
+        from utility.camera_bank import num_views
+        build_rays(service.defaults['render_res'], preview_views(num_views()))
+
+    if args.port is not None:
+        server = ThreadingTCPServer((args.host, args.port), JobHandler)
+        address = f"{args.host}:{args.port}"
+    else:
+        if os.path.exists(args.socket):
+            os.remove(args.socket)
+        server = ThreadingUnixServer(args.socket, JobHandler)
+        address = args.socket
+    server.service = service
+
+    print(f"✓ Hephaestus daemon ready on {address}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if service.scheduler is not None:
+            service.scheduler.stop()
+        if args.port is None and os.path.exists(args.socket):
+            os.remove(args.socket)
+        print("Daemon stopped")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--config", type=str, default='configs/default.yaml')
+    parser.add_argument("--ckpt", type=str, default=None)
+    parser.add_argument("--test_folder", type=str, default="daemon")
+    parser.add_argument("--socket", type=str, default=DEFAULT_SOCKET,
+                        help="Unix socket path to listen on (ignored when --port is given)")
+    parser.add_argument("--host", type=str, default='127.0.0.1')
+    parser.add_argument("--port", type=int, default=None,
+                        help="Listen on a TCP port instead of a Unix socket")
+    parser.add_argument("--warmup", action='store_true', default=False,
+                        help="Build the default sampler and camera rays before accepting jobs")
+    parser.add_argument("--continuous_batching", action='store_true', default=False,
+                        help="Share one UNet batch between the sampling steps of concurrent ddim/dpm jobs")
+    parser.add_argument("--max_batch", type=int, default=8,
+                        help="Max UNet rows per step with --continuous_batching (CFG counts two rows per sample)")
+    parser.add_argument("--cond_cache_dir", type=str, default=None,
+                        help="Persist encoded prompt conditionings here across daemon restarts")
+    parser.add_argument("--cache_dir", type=str, default=None,
+                        help="Latent cache shared by all jobs (see sample_stage1 --cache_dir); jobs cannot set their own")
+    parser.add_argument("--attention", type=str, default=None, choices=['auto', 'sdpa', 'chunked', 'math'],
+                        help="Attention backend for the UNet and VAE (default: $HEPHAESTUS_ATTENTION, else auto)")
+    parser.add_argument("--compile", type=str, default=None, choices=['compile', 'trace'],
+                        help="Run the UNet, VAE decoder and triplane MLP as compiled graphs, built at startup")
+    parser.add_argument("--precision", type=str, default='fp32', choices=['fp32', 'bf16', 'int8'],
+                        help="bf16: bfloat16 autocast for the UNet and VAE decoder; "
+                             "int8: dynamic int8 quantization of the UNet, CLIP and triplane MLP (CPU only)")
+    parser.add_argument("--send", type=str, default=None,
+                        help="Client mode: send a JSON job (or 'ping'/'shutdown') to a running daemon")
+    args = parser.parse_args()
+
+    if args.send is not None:
+        if args.send in ('ping', 'shutdown'):
+            job = {'op': args.send}
+        else:
+            job = json.loads(args.send)
+        status = 0
+        for event in submit_job(job, args.socket, args.host, args.port):
+            print(json.dumps(event))
+            if event.get('event') == 'error':
+                status = 1
+        sys.exit(status)
+
+    serve(args)
+
+if __name__ == '__main__':
+    main()
@@ -9,8 +9,6 @@ import json
 import kiui
 import tqdm
 import torch
-import mcubes
-import trimesh
 import datetime
 import argparse
 import subprocess
@@ -19,17 +17,19 @@ import gradio as gr
 import imageio.v2 as imageio
 import pytorch_lightning as pl
 from omegaconf import OmegaConf
-from safetensors.torch import load_file
 from huggingface_hub import hf_hub_download
 
 from ldm.models.diffusion.ddim import DDIMSampler
 from ldm.models.diffusion.plms import PLMSSampler
 from ldm.models.diffusion.dpm_solver import DPMSolverSampler
+from sample_stage1 import get_sampler, resolve_steps, SAMPLER_PRESETS
 
 from utility.initialize import instantiate_from_config, get_obj_from_str
-from utility.triplane_renderer.eg3d_renderer import sample_from_planes, generate_planes
-from utility.triplane_renderer.renderer import get_rays, to8b
+from utility.triplane_renderer.renderer import to8b
 from utility.device_utils import get_device, get_dtype, empty_cache, to_device
+from utility.mesh_extractor import MeshExtractor
+from utility.model_loader import load_safetensors_model
+from utility.camera_bank import get_view_rays, num_views
 
 # Optional import for stage 2 refinement
 try:
@@ -62,9 +62,7 @@ os.makedirs("tmp", exist_ok=True)
 if ckpt.endswith(".ckpt"):
     model = get_obj_from_str(configs.model["target"]).load_from_checkpoint(ckpt, map_location='cpu', strict=False, **configs.model.params)
 elif ckpt.endswith(".safetensors"):
-    model = get_obj_from_str(configs.model["target"])(**configs.model.params)
-    model_ckpt = load_file(ckpt)
-    model.load_state_dict(model_ckpt)
+    model = load_safetensors_model(get_obj_from_str(configs.model["target"]), configs.model.params, ckpt)
 else:
     raise NotImplementedError
 
@@ -79,41 +77,20 @@ if device.type == "mps":
     model = model.half()
     print("Model converted to float16 for MPS")
 
-sampler = DDIMSampler(model)
+# CLIP conditioning is a single token, so cross-attention can be computed once per prompt
+model.set_context_cache(True)
+# repeated prompts skip the CLIP text encoder
+model.set_conditioning_cache(True)
+
+# built on first use and kept for later requests
+samplers = {'ddim': DDIMSampler(model)}
+SAMPLER_CHOICES = ['ddim'] + list(SAMPLER_PRESETS.keys())
 
 img_size = configs.model.params.unet_config.params.image_size
 channels = configs.model.params.unet_config.params.in_channels
 shape = [channels, img_size, img_size * 3]
 
-pose_folder = 'assets/sample_data/pose'
-poses_fname = sorted([os.path.join(pose_folder, f) for f in os.listdir(pose_folder)])
-batch_rays_list = []
 H = 128
-ratio = 512 // H
-for p in poses_fname:
-    c2w = np.loadtxt(p).reshape(4, 4)
-    c2w[:3, 3] *= 2.2
-    c2w = np.array([
-        [1, 0, 0, 0],
-        [0, 0, -1, 0],
-        [0, 1, 0, 0],
-        [0, 0, 0, 1]
-    ]) @ c2w
-
-    k = np.array([
-        [560 / ratio, 0, H * 0.5],
-        [0, 560 / ratio, H * 0.5],
-        [0, 0, 1]
-    ])
-
-    rays_o, rays_d = get_rays(H, H, torch.Tensor(k), torch.Tensor(c2w[:3, :4]))
-    coords = torch.stack(torch.meshgrid(torch.linspace(0, H-1, H), torch.linspace(0, H-1, H), indexing='ij'), -1)
-    coords = torch.reshape(coords, [-1,2]).long()
-    rays_o = rays_o[coords[:, 0], coords[:, 1]]
-    rays_d = rays_d[coords[:, 0], coords[:, 1]]
-    batch_rays = torch.stack([rays_o, rays_d], 0)
-    batch_rays_list.append(batch_rays)
-batch_rays_list = torch.stack(batch_rays_list, 0)
 ###################################### INIT STAGE 1 #########################################
 
 ###################################### INIT STAGE 2 #########################################
@@ -160,95 +137,27 @@ def add_text(rgb, caption):
     return rgb
 
 def marching_cube(b, text, global_info):
-    # prepare volumn for marching cube
-    res = 128
     assert 'decode_res' in global_info
     decode_res = global_info['decode_res']
-    c_list = torch.linspace(-1.2, 1.2, steps=res)
-    grid_x, grid_y, grid_z = torch.meshgrid(
-        c_list, c_list, c_list, indexing='ij'
-    )
-    coords = torch.stack([grid_x, grid_y, grid_z], -1).to(device)
-    plane_axes = generate_planes()
-    feats = sample_from_planes(
-        plane_axes, decode_res[b:b+1].reshape(1, 3, -1, 256, 256), coords.reshape(1, -1, 3), padding_mode='zeros', box_warp=2.4
-    )
-    fake_dirs = torch.zeros_like(coords)
-    fake_dirs[..., 0] = 1
-    out = model.first_stage_model.triplane_decoder.decoder(feats, fake_dirs)
-    u = out['sigma'].reshape(res, res, res).detach().cpu().numpy()
-    del out
-
-    # marching cube
-    vertices, triangles = mcubes.marching_cubes(u, 10)
-    min_bound = np.array([-1.2, -1.2, -1.2])
-    max_bound = np.array([1.2, 1.2, 1.2])
-    vertices = vertices / (res - 1) * (max_bound - min_bound)[None, :] + min_bound[None, :]
-    pt_vertices = torch.from_numpy(vertices).to(device)
-
-    # extract vertices color
-    res_triplane = 256
-    render_kwargs = {
-        'depth_resolution': 128,
-        'disparity_space_sampling': False,
-        'box_warp': 2.4,
-        'depth_resolution_importance': 128,
-        'clamp_mode': 'softplus',
-        'white_back': True,
-        'det': True
-    }
-    rays_o_list = [
-        np.array([0, 0, 2]),
-        np.array([0, 0, -2]),
-        np.array([0, 2, 0]),
-        np.array([0, -2, 0]),
-        np.array([2, 0, 0]),
-        np.array([-2, 0, 0]),
-    ]
-    rgb_final = None
-    diff_final = None
-    for rays_o in tqdm.tqdm(rays_o_list):
-        rays_o = torch.from_numpy(rays_o.reshape(1, 3)).repeat(vertices.shape[0], 1).float().to(device)
-        rays_d = pt_vertices.reshape(-1, 3) - rays_o
-        rays_d = rays_d / torch.norm(rays_d, dim=-1).reshape(-1, 1)
-        dist = torch.norm(pt_vertices.reshape(-1, 3) - rays_o, dim=-1).cpu().numpy().reshape(-1)
-
-        render_out = model.first_stage_model.triplane_decoder(
-            decode_res[b:b+1].reshape(1, 3, -1, res_triplane, res_triplane),
-            rays_o.unsqueeze(0), rays_d.unsqueeze(0), render_kwargs,
-            whole_img=False, tvloss=False
-        )
-        rgb = render_out['rgb_marched'].reshape(-1, 3).detach().cpu().numpy()
-        depth = render_out['depth_final'].reshape(-1).detach().cpu().numpy()
-        depth_diff = np.abs(dist - depth)
-
-        if rgb_final is None:
-            rgb_final = rgb.copy()
-            diff_final = depth_diff.copy()
-
-        else:
-            ind = diff_final > depth_diff
-            rgb_final[ind] = rgb[ind]
-            diff_final[ind] = depth_diff[ind]
-
-    # bgr to rgb
-    rgb_final = np.stack([
-        rgb_final[:, 2], rgb_final[:, 1], rgb_final[:, 0]
-    ], -1)
-
-    # export to ply
-    mesh = trimesh.Trimesh(vertices, triangles, vertex_colors=(rgb_final * 255).astype(np.uint8))
+    occupancy, termination_eps = global_info.get('render_options', (False, 0.))
+    extractor = MeshExtractor(model.first_stage_model.triplane_decoder, res=128, iso=10, device=device,
+                              occupancy=occupancy, termination_eps=termination_eps)
     path = os.path.join('tmp', f"{text.replace(' ', '_')}_{str(datetime.datetime.now()).replace(' ', '_')}.ply")
-    trimesh.exchange.export.export_mesh(mesh, path, file_type='ply')
+    extractor.export(decode_res[b:b+1], path)
 
-    del vertices, triangles, rgb_final
     empty_cache(device)
 
     return path
 
-def infer(prompt, samples, steps, scale, seed, global_info):
+def default_steps(sampler_name):
+    return gr.update(value=50 if sampler_name == 'ddim' else resolve_steps(sampler_name))
+
+def infer(prompt, samples, sampler_name, steps, scale, seed, occupancy, termination_eps, global_info):
     prompt = prompt.replace('/', '')
     pl.seed_everything(seed)
+    if sampler_name not in samplers:
+        samplers[sampler_name] = get_sampler(model, sampler_name)
+    sampler = samplers[sampler_name]
     batch_size = samples
     with torch.no_grad():
         noise = None
@@ -269,23 +178,21 @@ def infer(prompt, samples, steps, scale, seed, global_info):
         big_video_list = []
 
         global_info['decode_res'] = decode_res
-
+        # same meaning as sample_stage1's --occupancy / --termination_eps, also used for vertex colors
+        global_info['render_options'] = (bool(occupancy), float(termination_eps))
+
+        # render all frames of all samples in packed renderer calls
+        view_num = num_views()
+        views = list(range(view_num//8*3, view_num//8*5, 2))
+        rgb_samples = model.first_stage_model.render_triplane_eg3d_decoder_views(
+            decode_res, get_view_rays(views, H).to(device), occupancy=bool(occupancy), termination_eps=float(termination_eps)
+        )
+        rgb_samples = to8b(rgb_samples.detach().cpu().numpy())
         for b in range(batch_size):
-            def render_img(v):
-                rgb_sample, _ = model.first_stage_model.render_triplane_eg3d_decoder(
-                    decode_res[b:b+1], batch_rays_list[v:v+1].to(device), torch.zeros(1, H, H, 3).to(device),
-                )
-                rgb_sample = to8b(rgb_sample.detach().cpu().numpy())[0]
-                rgb_sample = np.stack(
-                    [rgb_sample[..., 2], rgb_sample[..., 1], rgb_sample[..., 0]], -1
-                )
-                rgb_sample = add_text(rgb_sample, str(b))
-                return rgb_sample
-
-            view_num = len(batch_rays_list)
             video_list = []
-            for v in tqdm.tqdm(range(view_num//8*3, view_num//8*5, 2)):
-                rgb_sample = render_img(v)
+            for v in range(len(views)):
+                rgb_sample = np.ascontiguousarray(rgb_samples[b, v][..., ::-1])
+                rgb_sample = add_text(rgb_sample, str(b))
                 video_list.append(rgb_sample)
             big_video_list.append(video_list)
         # if batch_size == 2:
@@ -419,7 +326,9 @@ with block:
             with gr.Row(elem_id="advanced-options"):
                 with gr.Tab("Advanced options"):
                     samples = gr.Slider(label="Number of Samples", minimum=1, maximum=4, value=4, step=1)
+                    sampler_name = gr.Dropdown(SAMPLER_CHOICES, label="Sampler", value='ddim')
                     steps = gr.Slider(label="Steps", minimum=1, maximum=500, value=50, step=1)
+                    sampler_name.change(default_steps, inputs=[sampler_name], outputs=[steps])
                     scale = gr.Slider(
                         label="Guidance Scale", minimum=0, maximum=50, value=7.5, step=0.1
                     )
@@ -430,7 +339,9 @@ with block:
                         step=1,
                         randomize=True,
                     )
-            gr.on([text.submit, btn.click], infer, inputs=[text, samples, steps, scale, seed, global_info], outputs=[global_info, gallery])
+                    occupancy = gr.Checkbox(label="Occupancy-grid empty-space skipping (approximate)", value=False)
+                    termination_eps = gr.Number(label="Early ray termination threshold (0 for exact renders)", value=0, minimum=0)
+            gr.on([text.submit, btn.click], infer, inputs=[text, samples, sampler_name, steps, scale, seed, occupancy, termination_eps, global_info], outputs=[global_info, gallery])
             # advanced_button.click(
             #     None,
             #     [],
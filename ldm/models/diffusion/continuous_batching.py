@@ -0,0 +1,323 @@
+"""SAMPLING ONLY.
+
+Step-level continuous batching: requests sampled concurrently share one UNet batch. Every
+request keeps its own latent, step index, conditioning and guidance scale; each tick gathers
+the rows of all active requests into a single apply_model call with per-row timesteps, then
+advances every request by one solver step. New requests join between ticks and finished
+ones leave without waiting for the rest of the batch.
+"""
+
+import queue
+import threading
+import collections
+import torch
+
+from ldm.modules.diffusionmodules.util import get_ddim_schedule
+from ldm.models.diffusion.dpm_solver.dpm_solver import NoiseScheduleVP, DPM_Solver, expand_dims
+
+
+class DDIMStepper(object):
+    """
+    Deterministic DDIM (eta=0), one step per call; matches DDIMSampler.ddim_sampling.
+    """
+    def __init__(self, schedule):
+        self.timesteps, self.alphas, self.alphas_prev, self.sqrt_one_minus_alphas = schedule
+        self.total_steps = len(self.timesteps)
+        self.i = 0
+
+    @staticmethod
+    def make_schedule(model, steps):
+        schedule = get_ddim_schedule(model, steps)
+        return ([int(t) for t in schedule['ddim_timesteps']], schedule['ddim_alphas'],
+                schedule['ddim_alphas_prev'], schedule['ddim_sqrt_one_minus_alphas'])
+
+    @property
+    def done(self):
+        return self.i >= self.total_steps
+
+    def model_time(self):
+        return float(self.timesteps[self.total_steps - self.i - 1])
+
+    def step(self, x, e_t):
+        index = self.total_steps - self.i - 1
+        a_t = self.alphas[index]
+        a_prev = self.alphas_prev[index]
+        pred_x0 = (x - self.sqrt_one_minus_alphas[index] * e_t) / a_t.sqrt()
+        dir_xt = (1. - a_prev).sqrt() * e_t
+        self.i += 1
+        return a_prev.sqrt() * pred_x0 + dir_xt
+
+
+class DPMSolverStepper(object):
+    """
+    Multistep DPM-Solver++ (data prediction, time-uniform steps), one model evaluation per call;
+    matches DPMSolverSampler (order 2, lower order final steps).
+    """
+    def __init__(self, noise_schedule, steps, device, order=2, lower_order_final=True):
+        self.ns = noise_schedule
+        self.solver = DPM_Solver(None, noise_schedule, predict_x0=True, thresholding=False)
+        self.timesteps = self.solver.get_time_steps('time_uniform', noise_schedule.T, 1. / noise_schedule.total_N, steps, device)
+        self.total_steps = steps
+        self.order = order
+        self.lower_order_final = lower_order_final
+        self.model_prev_list = []
+        self.t_prev_list = []
+        self.i = 0
+
+    @property
+    def done(self):
+        return self.i >= self.total_steps
+
+    def model_time(self):
+        # continuous time in [1/N, 1] to the discrete model input time, as in model_wrapper
+        return (self.timesteps[self.i].item() - 1. / self.ns.total_N) * 1000.
+
+    def step(self, x, noise):
+        dims = x.dim()
+        vec_s = self.timesteps[self.i].expand(x.shape[0])
+        alpha_s, sigma_s = self.ns.marginal_alpha(vec_s), self.ns.marginal_std(vec_s)
+        self.model_prev_list = (self.model_prev_list + [(x - expand_dims(sigma_s, dims) * noise) / expand_dims(alpha_s, dims)])[-self.order:]
+        self.t_prev_list = (self.t_prev_list + [vec_s])[-self.order:]
+
+        step = self.i + 1
+        if step < self.order:
+            step_order = step
+        elif self.lower_order_final and self.total_steps < 15:
+            step_order = min(self.order, self.total_steps + 1 - step)
+        else:
+            step_order = self.order
+        vec_t = self.timesteps[step].expand(x.shape[0])
+        self.i += 1
+        return self.solver.multistep_dpm_solver_update(
+            x, self.model_prev_list[-step_order:], self.t_prev_list[-step_order:], vec_t, step_order)
+
+
+class SamplingRequest(object):
+    """
+    One in-flight request: latent rows [B, C, H, W], their conditioning and a stepper.
+    """
+    def __init__(self, x, cond, uncond, guidance_scale, stepper, callback=None):
+        self.x = x
+        self.cond = cond
+        self.uncond = uncond
+        self.guidance_scale = guidance_scale
+        self.stepper = stepper
+        self.callback = callback
+        self.finished = threading.Event()
+        self.error = None
+
+    @property
+    def guided(self):
+        return self.uncond is not None and self.guidance_scale != 1.
+
+    @property
+    def rows(self):
+        return self.x.shape[0] * (2 if self.guided else 1)
+
+    def fail(self, error):
+        self.error = error
+        self.finished.set()
+
+    def wait(self, timeout=None):
+        """
+        Block until the request finishes and return its latents.
+        """
+        self.finished.wait(timeout)
+        if self.error is not None:
+            raise self.error
+        return self.x
+
+
+class ContinuousBatchScheduler(object):
+    """
+    Runs the UNet for all concurrent requests on one background thread.
+
+    Args:
+        model: LatentDiffusion model
+        max_batch: Max UNet rows per tick (conditional and unconditional rows both count).
+            A request that is larger on its own still runs, alone.
+        lock: Model lock held for every tick. Code that runs the model outside the scheduler
+            must hold the same lock, since the UNet caches (cross-attention context, feature
+            reuse) and the conditioning cache are shared.
+
+    Request callbacks run in order on a separate notifier thread, never under the lock, so a
+    slow callback (e.g. a client socket) does not hold up sampling or other model users.
+    """
+    SAMPLERS = ('ddim', 'dpm', 'dpm_solver')
+
+    def __init__(self, model, max_batch=8, lock=None):
+        self.model = model
+        self.max_batch = max_batch
+        self.lock = lock if lock is not None else threading.Lock()
+        self.device = model.betas.device
+        self.pending = collections.deque()
+        self.active = []
+        self.condition = threading.Condition()
+        self.running = False
+        self.thread = None
+        self.notifications = queue.Queue()
+        self.notifier = None
+        self.ddim_schedules = {}
+        self.noise_schedule = None
+        self.ticks = 0
+        self.rows_evaluated = 0
+
+    def make_stepper(self, sampler, steps):
+        if sampler == 'ddim':
+            if steps not in self.ddim_schedules:
+                self.ddim_schedules[steps] = DDIMStepper.make_schedule(self.model, steps)
+            return DDIMStepper(self.ddim_schedules[steps])
+        elif sampler in ('dpm', 'dpm_solver'):
+            if self.noise_schedule is None:
+                alphas_cumprod = self.model.alphas_cumprod.clone().detach().to(torch.float32).to(self.device)
+                self.noise_schedule = NoiseScheduleVP('discrete', alphas_cumprod=alphas_cumprod)
+            return DPMSolverStepper(self.noise_schedule, steps, self.device)
+        raise NotImplementedError(f"Sampler not supported by continuous batching: {sampler}")
+
+    def submit(self, cond, steps, shape, sampler='ddim', guidance_scale=1., uncond=None, x_T=None, callback=None,
+               **sampler_kwargs):
+        """
+        Queue a request. cond holds one conditioning row per sample; shape is [C, H, W].
+        Sampler options the steppers do not implement (feature_reuse, guidance_interval,
+        guidance_reuse, early_stop_tol, ...) raise a ValueError instead of being ignored.
+
+        Returns:
+            SamplingRequest; call wait() for the final latents
+        """
+        if sampler_kwargs:
+            raise ValueError(f"Not supported by continuous batching: {', '.join(sorted(sampler_kwargs))}")
+        if x_T is None:
+            x_T = torch.randn([cond.shape[0]] + list(shape), device=self.device)
+        request = SamplingRequest(x_T.to(self.device), cond, uncond, guidance_scale,
+                                  self.make_stepper(sampler, steps), callback)
+        with self.condition:
+            if not self.running:
+                raise RuntimeError("Scheduler is not running")
+            self.pending.append(request)
+            self.condition.notify()
+        return request
+
+    def sample(self, *args, **kwargs):
+        return self.submit(*args, **kwargs).wait()
+
+    def start(self):
+        with self.condition:
+            if self.running:
+                return
+            self.running = True
+        self.notifier = threading.Thread(target=self.notify_loop, daemon=True)
+        self.notifier.start()
+        self.thread = threading.Thread(target=self.loop, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        with self.condition:
+            self.running = False
+            self.condition.notify_all()
+        if self.thread is not None:
+            self.thread.join()
+        for request in list(self.pending) + self.active:
+            request.fail(RuntimeError("Scheduler stopped"))
+        self.pending.clear()
+        self.active = []
+        if self.notifier is not None:
+            self.notifications.put(None)
+            self.notifier.join()
+
+    def loop(self):
+        while True:
+            with self.condition:
+                while self.running and not self.pending and not self.active:
+                    self.condition.wait()
+                if not self.running:
+                    return
+                self.admit()
+            try:
+                with self.lock:
+                    self.tick()
+            except Exception as e:
+                # the shared model call failed, so every request in the batch did
+                for request in self.active:
+                    request.fail(e)
+                self.active = []
+
+    def notify_loop(self):
+        """
+        Run request callbacks and completions posted by tick(), in order. A step notification
+        is (request, step index), a completion is (request, None).
+        """
+        while True:
+            item = self.notifications.get()
+            if item is None:
+                return
+            request, i = item
+            if request.error is not None:
+                continue
+            if i is None:
+                request.finished.set()
+                continue
+            # a failing callback (e.g. a client that went away) only ends its own request
+            try:
+                request.callback(i)
+            except Exception as e:
+                request.fail(e)
+
+    def admit(self):
+        """
+        Move pending requests into the active set, first come first served, while they fit.
+        """
+        rows = sum(r.rows for r in self.active)
+        while self.pending and (not self.active or rows + self.pending[0].rows <= self.max_batch):
+            request = self.pending.popleft()
+            self.active.append(request)
+            rows += request.rows
+
+    @torch.no_grad()
+    def tick(self):
+        """
+        One shared apply_model call for every active request, then one solver step each.
+        Callbacks and completions are posted to the notifier thread rather than run here, since
+        the caller holds the model lock.
+        """
+        # requests whose callback failed on the notifier thread leave here
+        self.active = [r for r in self.active if r.error is None]
+        if not self.active:
+            return
+        x_in, t_in, c_in = [], [], []
+        for request in self.active:
+            t = torch.full((request.x.shape[0],), request.stepper.model_time(), device=self.device)
+            x_in.append(request.x)
+            t_in.append(t)
+            c_in.append(request.cond)
+            if request.guided:
+                x_in.append(request.x)
+                t_in.append(t)
+                c_in.append(request.uncond)
+        with self.model.inference_mode():
+            out = self.model.apply_model(torch.cat(x_in), torch.cat(t_in), torch.cat(c_in))
+        self.ticks += 1
+        self.rows_evaluated += out.shape[0]
+
+        p = 0
+        stepped = []
+        for request in self.active:
+            b = request.x.shape[0]
+            e_t = out[p:p+b]
+            p += b
+            if request.guided:
+                e_t_uncond = out[p:p+b]
+                p += b
+                e_t = e_t_uncond + request.guidance_scale * (e_t - e_t_uncond)
+            # a failing step only ends its own request
+            try:
+                request.x = request.stepper.step(request.x, e_t)
+            except Exception as e:
+                request.fail(e)
+                continue
+            stepped.append(request)
+            if request.callback is not None:
+                self.notifications.put((request, request.stepper.i - 1))
+            if request.stepper.done:
+                self.notifications.put((request, None))
+
+        self.active = [r for r in stepped if not r.stepper.done]
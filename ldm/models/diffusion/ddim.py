@@ -5,8 +5,9 @@ import numpy as np
 from tqdm import tqdm
 from functools import partial
 
-from ldm.modules.diffusionmodules.util import make_ddim_sampling_parameters, make_ddim_timesteps, noise_like, \
-    extract_into_tensor
+from ldm.modules.diffusionmodules.util import noise_like, extract_into_tensor, get_ddim_schedule
+from ldm.models.diffusion.guidance import GuidanceSchedule
+from ldm.models.diffusion.early_stopping import EarlyStopping
 
 
 class DDIMSampler(object):
@@ -15,6 +16,7 @@ class DDIMSampler(object):
         self.model = model
         self.ddpm_num_timesteps = model.num_timesteps
         self.schedule = schedule
+        self.nfe = 0
 
     def register_buffer(self, name, attr):
         if type(attr) == torch.Tensor:
@@ -25,63 +27,15 @@ class DDIMSampler(object):
         setattr(self, name, attr)
 
     def make_schedule(self, ddim_num_steps, ddim_discretize="uniform", ddim_eta=0., verbose=True):
-        self.ddim_timesteps = make_ddim_timesteps(ddim_discr_method=ddim_discretize, num_ddim_timesteps=ddim_num_steps,
-                                                  num_ddpm_timesteps=self.ddpm_num_timesteps,verbose=verbose)
-        alphas_cumprod = self.model.alphas_cumprod
-        assert alphas_cumprod.shape[0] == self.ddpm_num_timesteps, 'alphas have to be defined for each timestep'
-        device = next(self.model.parameters()).device
-        # Use float32 for buffers to match MPS requirements (MPS supports float32)
-        # Even if model is float16, buffers work better in float32 for numerical stability
-        target_dtype = torch.float32
-        
-        # Helper to convert numpy arrays or tensors to proper dtype and device
-        def to_torch(x):
-            if isinstance(x, np.ndarray):
-                # Convert numpy array to tensor with float32
-                tensor = torch.from_numpy(x.astype(np.float32))
-            elif isinstance(x, torch.Tensor):
-                tensor = x.clone().detach()
-                # Ensure float32
-                if tensor.dtype == torch.float64:
-                    tensor = tensor.float()
-                elif tensor.dtype == torch.float16:
-                    # Keep as float32 for buffers
-                    tensor = tensor.float()
-            else:
-                tensor = torch.tensor(x, dtype=torch.float32)
-            
-            # Move to device (keep as float32)
-            return tensor.to(device)
-
-        self.register_buffer('betas', to_torch(self.model.betas))
-        self.register_buffer('alphas_cumprod', to_torch(alphas_cumprod))
-        self.register_buffer('alphas_cumprod_prev', to_torch(self.model.alphas_cumprod_prev))
-
-        # calculations for diffusion q(x_t | x_{t-1}) and others
-        # Ensure all numpy operations use float32 for MPS compatibility
-        alphas_cumprod_cpu = alphas_cumprod.cpu().float()
-        alphas_np = alphas_cumprod_cpu.numpy().astype(np.float32)
-        self.register_buffer('sqrt_alphas_cumprod', to_torch(np.sqrt(alphas_np, dtype=np.float32)))
-        self.register_buffer('sqrt_one_minus_alphas_cumprod', to_torch(np.sqrt(1. - alphas_np, dtype=np.float32)))
-        self.register_buffer('log_one_minus_alphas_cumprod', to_torch(np.log(1. - alphas_np, dtype=np.float32)))
-        self.register_buffer('sqrt_recip_alphas_cumprod', to_torch(np.sqrt(1. / alphas_np, dtype=np.float32)))
-        self.register_buffer('sqrt_recipm1_alphas_cumprod', to_torch(np.sqrt(1. / alphas_np - 1, dtype=np.float32)))
-
-        # ddim sampling parameters
-        # Use float32 numpy arrays for MPS compatibility
-        alphacums_np = alphas_cumprod.cpu().float().numpy().astype(np.float32)
-        ddim_sigmas, ddim_alphas, ddim_alphas_prev = make_ddim_sampling_parameters(alphacums=alphacums_np,
-                                                                                   ddim_timesteps=self.ddim_timesteps,
-                                                                                   eta=ddim_eta,verbose=verbose)
-        self.register_buffer('ddim_sigmas', to_torch(ddim_sigmas))
-        self.register_buffer('ddim_alphas', to_torch(ddim_alphas))
-        self.register_buffer('ddim_alphas_prev', to_torch(ddim_alphas_prev))
-        ddim_alphas_np = ddim_alphas.astype(np.float32) if isinstance(ddim_alphas, np.ndarray) else ddim_alphas
-        self.register_buffer('ddim_sqrt_one_minus_alphas', to_torch(np.sqrt(1. - ddim_alphas_np, dtype=np.float32)))
-        sigmas_for_original_sampling_steps = ddim_eta * torch.sqrt(
-            (1 - self.alphas_cumprod_prev) / (1 - self.alphas_cumprod) * (
-                        1 - self.alphas_cumprod / self.alphas_cumprod_prev))
-        self.register_buffer('ddim_sigmas_for_original_num_steps', sigmas_for_original_sampling_steps)
+        assert self.model.alphas_cumprod.shape[0] == self.ddpm_num_timesteps, 'alphas have to be defined for each timestep'
+        # Buffers are float32 on the model device (MPS friendly) and cached across sampler instances,
+        # so repeated sample() calls with the same settings skip the setup entirely
+        # float32 regardless of the precision policy: bf16 cannot resolve alphas_cumprod near t=0
+        schedule = get_ddim_schedule(self.model, ddim_num_steps, ddim_discretize, ddim_eta, dtype=torch.float32)
+        for name, value in schedule.items():
+            self.register_buffer(name, value)
+        if verbose:
+            print(f'Selected timesteps for ddim sampler: {self.ddim_timesteps}')
 
     @torch.no_grad()
     def sample(self,
@@ -106,6 +60,12 @@ class DDIMSampler(object):
                unconditional_guidance_scale=1.,
                unconditional_conditioning=None,
                # this has to come in the same format as the conditioning, # e.g. as encoded tokens, ...
+               feature_reuse=0,
+               feature_reuse_layer=0,
+               guidance_interval=None,
+               guidance_reuse=0,
+               early_stop_tol=0.,
+               early_stop_patience=2,
                **kwargs
                ):
         if conditioning is not None:
@@ -122,22 +82,28 @@ class DDIMSampler(object):
         C, H, W = shape
         size = (batch_size, C, H, W)
         print(f'Data shape for DDIM sampling is {size}, eta {eta}')
-
-        samples, intermediates = self.ddim_sampling(conditioning, size,
-                                                    callback=callback,
-                                                    img_callback=img_callback,
-                                                    quantize_denoised=quantize_x0,
-                                                    mask=mask, x0=x0,
-                                                    ddim_use_original_steps=False,
-                                                    noise_dropout=noise_dropout,
-                                                    temperature=temperature,
-                                                    score_corrector=score_corrector,
-                                                    corrector_kwargs=corrector_kwargs,
-                                                    x_T=x_T,
-                                                    log_every_t=log_every_t,
-                                                    unconditional_guidance_scale=unconditional_guidance_scale,
-                                                    unconditional_conditioning=unconditional_conditioning,
-                                                    )
+        guidance = GuidanceSchedule(unconditional_guidance_scale, guidance_interval, guidance_reuse)
+
+        with self.model.inference_mode(), self.model.feature_reuse(feature_reuse, feature_reuse_layer):
+            samples, intermediates = self.ddim_sampling(conditioning, size,
+                                                        callback=callback,
+                                                        img_callback=img_callback,
+                                                        quantize_denoised=quantize_x0,
+                                                        mask=mask, x0=x0,
+                                                        ddim_use_original_steps=False,
+                                                        noise_dropout=noise_dropout,
+                                                        temperature=temperature,
+                                                        score_corrector=score_corrector,
+                                                        corrector_kwargs=corrector_kwargs,
+                                                        x_T=x_T,
+                                                        log_every_t=log_every_t,
+                                                        unconditional_guidance_scale=unconditional_guidance_scale,
+                                                        unconditional_conditioning=unconditional_conditioning,
+                                                        guidance=guidance,
+                                                        early_stop=EarlyStopping(early_stop_tol, early_stop_patience),
+                                                        )
+        if guidance.scheduled:
+            print(guidance.summary())
         return samples, intermediates
 
     @torch.no_grad()
@@ -146,7 +112,8 @@ class DDIMSampler(object):
                       callback=None, timesteps=None, quantize_denoised=False,
                       mask=None, x0=None, img_callback=None, log_every_t=100,
                       temperature=1., noise_dropout=0., score_corrector=None, corrector_kwargs=None,
-                      unconditional_guidance_scale=1., unconditional_conditioning=None,):
+                      unconditional_guidance_scale=1., unconditional_conditioning=None, guidance=None,
+                      early_stop=None):
         device = self.model.betas.device
         b = shape[0]
         if x_T is None:
@@ -166,10 +133,17 @@ class DDIMSampler(object):
         print(f"Running DDIM Sampling with {total_steps} timesteps")
 
         iterator = tqdm(time_range, desc='DDIM Sampler', total=total_steps)
+        # inpainting re-imposes x0 every step, so pred_x0 convergence says nothing there
+        if early_stop is not None and (not early_stop.enabled or mask is not None):
+            early_stop = None
+        self.nfe = 0
 
         for i, step in enumerate(iterator):
             index = total_steps - i - 1
-            ts = torch.full((b,), step, device=device, dtype=torch.long)
+            if ddim_use_original_steps:
+                ts = torch.full((b,), step, device=device, dtype=torch.long)
+            else:
+                ts = self.step_timesteps[index].expand(b)
 
             if mask is not None:
                 assert x0 is not None
@@ -181,24 +155,39 @@ class DDIMSampler(object):
                                       noise_dropout=noise_dropout, score_corrector=score_corrector,
                                       corrector_kwargs=corrector_kwargs,
                                       unconditional_guidance_scale=unconditional_guidance_scale,
-                                      unconditional_conditioning=unconditional_conditioning)
+                                      unconditional_conditioning=unconditional_conditioning,
+                                      guidance=guidance)
             img, pred_x0 = outs
+            self.nfe += 1
+            stop = early_stop is not None and early_stop(pred_x0, i, total_steps)
+            if stop:
+                # jump to t=0: with alpha_prev = 1 the DDIM update returns pred_x0 itself
+                img = pred_x0
             if callback: callback(i)
             if img_callback: img_callback(pred_x0, i)
 
-            if index % log_every_t == 0 or index == total_steps - 1:
+            if index % log_every_t == 0 or index == total_steps - 1 or stop:
                 intermediates['x_inter'].append(img)
                 intermediates['pred_x0'].append(pred_x0)
+            if stop:
+                iterator.close()
+                break
 
+        if early_stop is not None:
+            print(early_stop.summary(self.nfe, total_steps))
+        intermediates['nfe'] = self.nfe
         return img, intermediates
 
     @torch.no_grad()
     def p_sample_ddim(self, x, c, t, index, repeat_noise=False, use_original_steps=False, quantize_denoised=False,
                       temperature=1., noise_dropout=0., score_corrector=None, corrector_kwargs=None,
-                      unconditional_guidance_scale=1., unconditional_conditioning=None):
+                      unconditional_guidance_scale=1., unconditional_conditioning=None, guidance=None):
         b, *_, device = *x.shape, x.device
 
-        if unconditional_conditioning is None or unconditional_guidance_scale == 1.:
+        if guidance is not None:
+            t_frac = (index if use_original_steps else self.ddim_timesteps[index]) / self.ddpm_num_timesteps
+            e_t = guidance(self.model.apply_model, x, t, c, unconditional_conditioning, t_frac)
+        elif unconditional_conditioning is None or unconditional_guidance_scale == 1.:
             e_t = self.model.apply_model(x, t, c)
         else:
             x_in = torch.cat([x] * 2)
@@ -211,15 +200,18 @@ class DDIMSampler(object):
             assert self.model.parameterization == "eps"
             e_t = score_corrector.modify_score(self.model, e_t, x, t, c, **corrector_kwargs)
 
-        alphas = self.model.alphas_cumprod if use_original_steps else self.ddim_alphas
-        alphas_prev = self.model.alphas_cumprod_prev if use_original_steps else self.ddim_alphas_prev
-        sqrt_one_minus_alphas = self.model.sqrt_one_minus_alphas_cumprod if use_original_steps else self.ddim_sqrt_one_minus_alphas
-        sigmas = self.model.ddim_sigmas_for_original_num_steps if use_original_steps else self.ddim_sigmas
         # select parameters corresponding to the currently considered timestep
-        a_t = torch.full((b, 1, 1, 1), alphas[index], device=device)
-        a_prev = torch.full((b, 1, 1, 1), alphas_prev[index], device=device)
-        sigma_t = torch.full((b, 1, 1, 1), sigmas[index], device=device)
-        sqrt_one_minus_at = torch.full((b, 1, 1, 1), sqrt_one_minus_alphas[index],device=device)
+        if use_original_steps:
+            a_t = torch.full((b, 1, 1, 1), self.model.alphas_cumprod[index], device=device)
+            a_prev = torch.full((b, 1, 1, 1), self.model.alphas_cumprod_prev[index], device=device)
+            sigma_t = torch.full((b, 1, 1, 1), self.ddim_sigmas_for_original_num_steps[index], device=device)
+            sqrt_one_minus_at = torch.full((b, 1, 1, 1), self.model.sqrt_one_minus_alphas_cumprod[index], device=device)
+        else:
+            # precomputed [1, 1, 1, 1] device tensors, broadcast over the batch
+            a_t = self.step_a_t[index:index+1]
+            a_prev = self.step_a_prev[index:index+1]
+            sigma_t = self.step_sigma_t[index:index+1]
+            sqrt_one_minus_at = self.step_sqrt_one_minus_at[index:index+1]
 
         # current prediction for x_0
         pred_x0 = (x - sqrt_one_minus_at * e_t) / a_t.sqrt()
@@ -262,10 +254,11 @@ class DDIMSampler(object):
 
         iterator = tqdm(time_range, desc='Decoding image', total=total_steps)
         x_dec = x_latent
-        for i, step in enumerate(iterator):
-            index = total_steps - i - 1
-            ts = torch.full((x_latent.shape[0],), step, device=x_latent.device, dtype=torch.long)
-            x_dec, _ = self.p_sample_ddim(x_dec, cond, ts, index=index, use_original_steps=use_original_steps,
-                                          unconditional_guidance_scale=unconditional_guidance_scale,
-                                          unconditional_conditioning=unconditional_conditioning)
+        with self.model.inference_mode():
+            for i, step in enumerate(iterator):
+                index = total_steps - i - 1
+                ts = torch.full((x_latent.shape[0],), step, device=x_latent.device, dtype=torch.long)
+                x_dec, _ = self.p_sample_ddim(x_dec, cond, ts, index=index, use_original_steps=use_original_steps,
+                                              unconditional_guidance_scale=unconditional_guidance_scale,
+                                              unconditional_conditioning=unconditional_conditioning)
         return x_dec
\ No newline at end of file
@@ -7,6 +7,8 @@ https://github.com/CompVis/taming-transformers
 """
 
 import os
+import hashlib
+import threading
 try:
     import wandb
 except ImportError:
@@ -18,7 +20,7 @@ import numpy as np
 import pytorch_lightning as pl
 from torch.optim.lr_scheduler import LambdaLR
 from einops import rearrange, repeat
-from contextlib import contextmanager
+from contextlib import contextmanager, nullcontext
 from functools import partial
 from tqdm import tqdm
 from torchvision.utils import make_grid
@@ -29,8 +31,10 @@ from ldm.modules.ema import LitEma
 from module.model_2d import DiagonalGaussianDistribution
 from ldm.modules.distributions.distributions import normal_kl
 from ldm.models.autoencoder import VQModelInterface, IdentityFirstStage, AutoencoderKL
-from ldm.modules.diffusionmodules.util import make_beta_schedule, extract_into_tensor, noise_like
+from ldm.modules.diffusionmodules.util import make_beta_schedule, extract_into_tensor, noise_like, set_inference_mode
 from ldm.models.diffusion.ddim import DDIMSampler
+from ldm.modules.attention import set_context_cache
+from ldm.modules.encoders.conditioning_cache import ConditioningCache
 from utility.triplane_renderer.renderer import to8b
 
 
@@ -507,6 +511,11 @@ class LatentDiffusion(DDPM):
         self.instantiate_first_stage(first_stage_config)
         self.instantiate_cond_stage(cond_stage_config)
         self.cond_stage_forward = cond_stage_forward
+        self.conditioning_cache = None
+        # utility.device_utils.PrecisionPolicy, None runs everything in the weights' dtype
+        self.precision_policy = None
+        self.inference_depth = 0
+        self.inference_lock = threading.Lock()
         self.clip_denoised = False
         self.bbox_tokenizer = None  
 
@@ -603,7 +612,93 @@ class LatentDiffusion(DDPM):
             raise NotImplementedError(f"encoder_posterior of type '{type(encoder_posterior)}' not yet implemented")
         return self.scale_factor * (z + self.scale_shift)
 
+    def set_context_cache(self, enabled=True):
+        """
+        Inference mode for single-token conditioning (FrozenCLIPTextEmbedder
+        with n_repeat=1): every cross-attention layer computes its output once
+        per prompt, and once for the unconditional context, and reuses it for
+        all sampling steps.
+        """
+        set_context_cache(self.model, enabled)
+
+    def set_conditioning_cache(self, enabled=True, capacity=1024, cache_dir=None):
+        """
+        Cache the text conditioning of prompts (frozen text encoders only), in memory with LRU
+        eviction and optionally on disk. Entries are keyed by the encoder version, its settings
+        and a fingerprint of its weights, so a different encoder never reuses them.
+        """
+        if not enabled or self.cond_stage_trainable:
+            self.conditioning_cache = None
+            return
+        encoder = self.cond_stage_model
+        first_param = next(encoder.parameters())
+        fingerprint = hashlib.sha256(first_param.detach().flatten()[:4096].float().cpu().numpy().tobytes()).hexdigest()[:16]
+        settings = [getattr(encoder, name, None) for name in ('version', 'max_length', 'n_repeat', 'normalize')]
+        version = f"{type(encoder).__name__}:{':'.join(str(s) for s in settings)}:{self.cond_stage_forward}:{fingerprint}"
+        self.conditioning_cache = ConditioningCache(version, capacity, cache_dir)
+
+    def set_precision(self, policy):
+        """
+        Set the per-module precision policy (utility.device_utils.PrecisionPolicy) used by
+        apply_model and decode_first_stage.
+        """
+        self.precision_policy = policy
+
+    def autocast(self, part):
+        if self.precision_policy is None:
+            return nullcontext()
+        return self.precision_policy.autocast(part)
+
+    @contextmanager
+    def inference_mode(self):
+        """
+        Run the UNet without gradient checkpointing (see util.set_inference_mode). Entered by
+        every sampler; the checkpointed training path is restored on exit.
+        """
+        if self.model.training and torch.is_grad_enabled():
+            # sampling with gradients (e.g. guidance losses) keeps the memory savings
+            yield None
+            return
+        # reentrant: the daemon samples from several threads, the last one out restores
+        with self.inference_lock:
+            self.inference_depth += 1
+            if self.inference_depth == 1:
+                set_inference_mode(self.model, True)
+        try:
+            yield self.model
+        finally:
+            with self.inference_lock:
+                self.inference_depth -= 1
+                if self.inference_depth == 0:
+                    set_inference_mode(self.model, False)
+
+    @contextmanager
+    def feature_reuse(self, interval=3, layer=0):
+        """
+        Sample with deep UNet features reused across adjacent model calls (see
+        UNetModel.set_feature_reuse). Approximate; interval <= 1 is a no-op, and so is a UNet
+        without feature reuse support (the triplane UNet variants).
+        """
+        unet = self.model.diffusion_model
+        if interval is None or interval <= 1:
+            yield None
+            return
+        if not hasattr(unet, 'set_feature_reuse'):
+            print(f"⚠ Warning: {type(unet).__name__} does not support feature reuse, sampling without it")
+            yield None
+            return
+        unet.set_feature_reuse(interval, layer)
+        try:
+            yield unet
+        finally:
+            unet.set_feature_reuse(0)
+
     def get_learned_conditioning(self, c):
+        if self.conditioning_cache is not None and isinstance(c, list) and all(isinstance(p, str) for p in c):
+            return self.conditioning_cache.get(c, self.encode_conditioning, self.device)
+        return self.encode_conditioning(c)
+
+    def encode_conditioning(self, c):
         if self.cond_stage_forward is None:
             if hasattr(self.cond_stage_model, 'encode') and callable(self.cond_stage_model.encode):
                 c = self.cond_stage_model.encode(c)
@@ -825,7 +920,10 @@ class LatentDiffusion(DDPM):
         #     if isinstance(self.first_stage_model, VQModelInterface):
         #         return self.first_stage_model.decode(z, force_not_quantize=predict_cids or force_not_quantize)
         #     else:
-        return self.first_stage_model.decode(z, unrollout=True)
+        with self.autocast('vae_decoder'):
+            dec = self.first_stage_model.decode(z, unrollout=True)
+        # the triplane renderer and density thresholds run in float32
+        return dec.float() if dec.dtype == torch.bfloat16 else dec
 
     # same as above but without decorator
     def differentiable_decode_first_stage(self, z, predict_cids=False, force_not_quantize=False):
@@ -1108,11 +1206,15 @@ class LatentDiffusion(DDPM):
             x_recon = fold(o) / normalization
 
         else:
-            if self.use_3daware:
-                x_noisy_3daware = self.to3daware(x_noisy)
-                x_recon = self.model(x_noisy_3daware, t, **cond)
-            else:
-                x_recon = self.model(x_noisy, t, **cond)
+            with self.autocast('unet'):
+                if self.use_3daware:
+                    x_noisy_3daware = self.to3daware(x_noisy)
+                    x_recon = self.model(x_noisy_3daware, t, **cond)
+                else:
+                    x_recon = self.model(x_noisy, t, **cond)
+            if self.precision_policy is not None and self.precision_policy.enabled:
+                # sampler updates run in the float32 schedule dtype
+                x_recon = tuple(x.float() for x in x_recon) if isinstance(x_recon, tuple) else x_recon.float()
 
         if isinstance(x_recon, tuple) and not return_ids:
             return x_recon[0]
@@ -1361,7 +1463,10 @@ class LatentDiffusion(DDPM):
     @torch.no_grad()
     def sample(self, cond, batch_size=16, return_intermediates=False, x_T=None,
                verbose=True, timesteps=None, quantize_denoised=False,
-               mask=None, x0=None, shape=None,**kwargs):
+               mask=None, x0=None, shape=None, callback=None, **kwargs):
+        unsupported = [k for k in ('feature_reuse', 'guidance_interval', 'guidance_reuse', 'early_stop_tol') if kwargs.get(k)]
+        if unsupported:
+            raise ValueError(f"Not supported by the DDPM sampler: {', '.join(unsupported)}")
         if shape is None:
             shape = (batch_size, self.channels, self.image_size, self.image_size * 3)
         if cond is not None:
@@ -1370,11 +1475,12 @@ class LatentDiffusion(DDPM):
                 list(map(lambda x: x[:batch_size], cond[key])) for key in cond}
             else:
                 cond = [c[:batch_size] for c in cond] if isinstance(cond, list) else cond[:batch_size]
-        return self.p_sample_loop(cond,
-                                  shape,
-                                  return_intermediates=return_intermediates, x_T=x_T,
-                                  verbose=verbose, timesteps=timesteps, quantize_denoised=quantize_denoised,
-                                  mask=mask, x0=x0)
+        with self.inference_mode():
+            return self.p_sample_loop(cond,
+                                      shape,
+                                      return_intermediates=return_intermediates, x_T=x_T,
+                                      verbose=verbose, timesteps=timesteps, quantize_denoised=quantize_denoised,
+                                      mask=mask, x0=x0, callback=callback)
 
     @torch.no_grad()
     def sample_log(self,cond,batch_size,ddim, ddim_steps,**kwargs):
@@ -185,6 +185,7 @@ def model_wrapper(
     guidance_scale=1.,
     classifier_fn=None,
     classifier_kwargs={},
+    guidance=None,
 ):
     """Create a wrapper function for the noise prediction model.
 
@@ -271,6 +272,8 @@ def model_wrapper(
         guidance_scale: A `float`. The scale for the guided sampling.
         classifier_fn: A classifier function. Only used for the classifier guidance.
         classifier_kwargs: A `dict`. A dict for the other inputs of the classifier function.
+        guidance: A `GuidanceSchedule` (ldm.models.diffusion.guidance). Only used for the "classifier-free"
+            guidance type; when given it decides per call whether to evaluate the unconditional branch.
     Returns:
         A noise prediction model that accepts the noised data and the continuous time as the inputs.
     """
@@ -334,6 +337,10 @@ def model_wrapper(
             noise = noise_pred_fn(x, t_continuous)
             return noise - guidance_scale * expand_dims(sigma_t, dims=cond_grad.dim()) * cond_grad
         elif guidance_type == "classifier-free":
+            if guidance is not None:
+                # t_continuous is already normalized (T = 1 is pure noise)
+                return guidance(lambda x_in, t_in, c_in: noise_pred_fn(x_in, t_in, cond=c_in),
+                                x, t_continuous, condition, unconditional_condition, t_continuous.reshape(-1)[0].item())
             if guidance_scale == 1. or unconditional_condition is None:
                 return noise_pred_fn(x, t_continuous, cond=condition)
             else:
@@ -348,6 +355,23 @@ def model_wrapper(
     return model_fn
 
 
+def step_callback_wrapper(model_fn, callback=None):
+    """
+    Call `callback(i)` at the i-th evaluation of `model_fn`. The multistep DPM-Solver and UniPC
+    solvers evaluate the model once per step, so this reports progress like the DDIM sampler's callback.
+    """
+    if callback is None:
+        return model_fn
+    calls = [0]
+
+    def fn(x, t_continuous):
+        out = model_fn(x, t_continuous)
+        callback(calls[0])
+        calls[0] += 1
+        return out
+    return fn
+
+
 class DPM_Solver:
     def __init__(self, model_fn, noise_schedule, predict_x0=False, thresholding=False, max_val=1.):
         """Construct a DPM-Solver. 
@@ -407,6 +431,16 @@ class DPM_Solver:
         else:
             return self.noise_prediction_fn(x, t)
 
+    def to_data_prediction(self, x, model_out, t):
+        """
+        Convert an output of `self.model_fn` at time `t` to the data prediction x_0.
+        """
+        if self.predict_x0:
+            return model_out
+        dims = x.dim()
+        alpha_t, sigma_t = self.noise_schedule.marginal_alpha(t), self.noise_schedule.marginal_std(t)
+        return (x - expand_dims(sigma_t, dims) * model_out) / expand_dims(alpha_t, dims)
+
     def get_time_steps(self, skip_type, t_T, t_0, N, device):
         """Compute the intermediate time steps for sampling.
 
@@ -964,7 +998,7 @@ class DPM_Solver:
 
     def sample(self, x, steps=20, t_start=None, t_end=None, order=3, skip_type='time_uniform',
         method='singlestep', lower_order_final=True, denoise_to_zero=False, solver_type='dpm_solver',
-        atol=0.0078, rtol=0.05,
+        atol=0.0078, rtol=0.05, early_stop=None,
     ):
         """
         Compute the sample at time `t_end` by DPM-Solver, given the initial `x` at time `t_start`.
@@ -1064,6 +1098,9 @@ class DPM_Solver:
             solver_type: A `str`. The taylor expansion type for the solver. `dpm_solver` or `taylor`. We recommend `dpm_solver`.
             atol: A `float`. The absolute tolerance of the adaptive step size solver. Valid when `method` == 'adaptive'.
             rtol: A `float`. The relative tolerance of the adaptive step size solver. Valid when `method` == 'adaptive'.
+            early_stop: An optional `EarlyStopping` (see ldm.models.diffusion.early_stopping). Valid when `method` == 'multistep'.
+                After every model evaluation it receives the data prediction; once that has converged we return it
+                directly instead of running the remaining steps. The number of model evaluations is kept in `self.nfe`.
         Returns:
             x_end: A pytorch tensor. The approximated solution at time `t_end`.
 
@@ -1078,16 +1115,28 @@ class DPM_Solver:
             assert steps >= order
             timesteps = self.get_time_steps(skip_type=skip_type, t_T=t_T, t_0=t_0, N=steps, device=device)
             assert timesteps.shape[0] - 1 == steps
+            if early_stop is not None and not early_stop.enabled:
+                early_stop = None
+            self.nfe = 0
+
+            def converged(x, model_out, vec_t):
+                self.nfe += 1
+                return early_stop is not None and early_stop(self.to_data_prediction(x, model_out, vec_t), self.nfe - 1, steps)
+
             with torch.no_grad():
                 vec_t = timesteps[0].expand((x.shape[0]))
                 model_prev_list = [self.model_fn(x, vec_t)]
                 t_prev_list = [vec_t]
+                if converged(x, model_prev_list[-1], vec_t):
+                    return self.to_data_prediction(x, model_prev_list[-1], vec_t)
                 # Init the first `order` values by lower order multistep DPM-Solver.
                 for init_order in range(1, order):
                     vec_t = timesteps[init_order].expand(x.shape[0])
                     x = self.multistep_dpm_solver_update(x, model_prev_list, t_prev_list, vec_t, init_order, solver_type=solver_type)
                     model_prev_list.append(self.model_fn(x, vec_t))
                     t_prev_list.append(vec_t)
+                    if converged(x, model_prev_list[-1], vec_t):
+                        return self.to_data_prediction(x, model_prev_list[-1], vec_t)
                 # Compute the remaining values by `order`-th order multistep DPM-Solver.
                 for step in range(order, steps + 1):
                     vec_t = timesteps[step].expand(x.shape[0])
@@ -1103,6 +1152,9 @@ class DPM_Solver:
                     # We do not need to evaluate the final model value.
                     if step < steps:
                         model_prev_list[-1] = self.model_fn(x, vec_t)
+                        if converged(x, model_prev_list[-1], vec_t):
+                            # jump to the final denoise: the data prediction at the current time
+                            return self.to_data_prediction(x, model_prev_list[-1], vec_t)
         elif method in ['singlestep', 'singlestep_fixed']:
             if method == 'singlestep':
                 timesteps_outer, orders = self.get_orders_and_timesteps_for_singlestep_solver(steps=steps, order=order, skip_type=skip_type, t_T=t_T, t_0=t_0, device=device)
@@ -2,16 +2,28 @@
 
 import torch
 
-from .dpm_solver import NoiseScheduleVP, model_wrapper, DPM_Solver
+from .dpm_solver import NoiseScheduleVP, model_wrapper, step_callback_wrapper, DPM_Solver
+from ldm.models.diffusion.guidance import GuidanceSchedule
+from ldm.models.diffusion.early_stopping import EarlyStopping
 
 
 class DPMSolverSampler(object):
-    def __init__(self, model, **kwargs):
+    """
+    Multistep DPM-Solver++ (data prediction).
+
+    Args:
+        order: 2 for DPM-Solver++ 2M, 3 for DPM-Solver++ 3M
+        skip_type: Time step spacing, 'time_uniform', 'logSNR' or 'time_quadratic'
+    """
+    def __init__(self, model, order=2, skip_type="time_uniform", **kwargs):
         super().__init__()
         self.model = model
+        self.order = order
+        self.skip_type = skip_type
         device = next(model.parameters()).device
         to_torch = lambda x: x.clone().detach().to(torch.float32).to(device)
         self.register_buffer('alphas_cumprod', to_torch(model.alphas_cumprod))
+        self.nfe = 0
 
     def register_buffer(self, name, attr):
         if type(attr) == torch.Tensor:
@@ -44,6 +56,14 @@ class DPMSolverSampler(object):
                unconditional_guidance_scale=1.,
                unconditional_conditioning=None,
                # this has to come in the same format as the conditioning, # e.g. as encoded tokens, ...
+               feature_reuse=0,
+               feature_reuse_layer=0,
+               guidance_interval=None,
+               guidance_reuse=0,
+               early_stop_tol=0.,
+               early_stop_patience=2,
+               order=None,
+               skip_type=None,
                **kwargs
                ):
         if conditioning is not None:
@@ -68,6 +88,7 @@ class DPMSolverSampler(object):
             img = x_T
 
         ns = NoiseScheduleVP('discrete', alphas_cumprod=self.alphas_cumprod)
+        guidance = GuidanceSchedule(unconditional_guidance_scale, guidance_interval, guidance_reuse)
 
         model_fn = model_wrapper(
             lambda x, t, c: self.model.apply_model(x, t, c),
@@ -77,9 +98,20 @@ class DPMSolverSampler(object):
             condition=conditioning,
             unconditional_condition=unconditional_conditioning,
             guidance_scale=unconditional_guidance_scale,
+            # plain CFG stays on the wrapper's own path
+            guidance=guidance if guidance.scheduled else None,
         )
+        model_fn = step_callback_wrapper(model_fn, callback)
 
-        dpm_solver = DPM_Solver(model_fn, ns, predict_x0=True, thresholding=False)
-        x = dpm_solver.sample(img, steps=S, skip_type="time_uniform", method="multistep", order=2, lower_order_final=True)
+        early_stop = EarlyStopping(early_stop_tol, early_stop_patience)
+        with self.model.inference_mode(), self.model.feature_reuse(feature_reuse, feature_reuse_layer):
+            dpm_solver = DPM_Solver(model_fn, ns, predict_x0=True, thresholding=False)
+            x = dpm_solver.sample(img, steps=S, skip_type=skip_type or self.skip_type, method="multistep",
+                                  order=order or self.order, lower_order_final=True, early_stop=early_stop)
+        self.nfe = dpm_solver.nfe
+        if early_stop.enabled:
+            print(early_stop.summary(self.nfe, S))
+        if guidance.scheduled:
+            print(guidance.summary())
 
         return x.to(device), None
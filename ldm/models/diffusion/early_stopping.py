@@ -0,0 +1,54 @@
+"""SAMPLING ONLY.
+
+Adaptive early stopping shared by the DDIM and DPM-Solver samplers: once the predicted x_0
+stops changing between steps, the remaining steps are skipped and the sampler returns that
+prediction, i.e. it jumps straight to the final denoise.
+"""
+
+
+class EarlyStopping(object):
+    """
+    Tracks the relative change of pred_x0 between consecutive sampler steps.
+
+    Args:
+        tol: Stop once max_b ||x0_i - x0_{i-1}|| / ||x0_{i-1}|| stays below tol (0 disables)
+        patience: Number of consecutive steps that have to be below tol
+        min_fraction: Never stop before this fraction of the steps has run
+    """
+    def __init__(self, tol=0., patience=2, min_fraction=0.3):
+        self.tol = tol
+        self.patience = patience
+        self.min_fraction = min_fraction
+        self.prev = None
+        self.calm_steps = 0
+        self.last_change = None
+
+    @property
+    def enabled(self):
+        return self.tol > 0
+
+    def __call__(self, pred_x0, step, total_steps):
+        """
+        Record the prediction of step `step` (0-based) out of `total_steps`.
+
+        Returns:
+            True when sampling can stop and return pred_x0
+        """
+        if not self.enabled:
+            return False
+        prev, self.prev = self.prev, pred_x0
+        if prev is None:
+            return False
+
+        b = pred_x0.shape[0]
+        diff = (pred_x0 - prev).reshape(b, -1).norm(dim=1)
+        ref = prev.reshape(b, -1).norm(dim=1).clamp(min=1e-8)
+        self.last_change = (diff / ref).max().item()
+        self.calm_steps = self.calm_steps + 1 if self.last_change < self.tol else 0
+        return self.calm_steps >= self.patience and step + 1 >= self.min_fraction * total_steps
+
+    def summary(self, nfe, total_steps):
+        if nfe < total_steps:
+            return (f"Early stop: {nfe}/{total_steps} model evaluations "
+                    f"(pred_x0 change {self.last_change:.2e} < {self.tol:g})")
+        return f"Early stop: not triggered, {nfe}/{total_steps} model evaluations"
@@ -0,0 +1,72 @@
+"""SAMPLING ONLY.
+
+Classifier-free guidance scheduling shared by the DDIM, PLMS and DPM-Solver samplers.
+"""
+
+import torch
+
+
+class GuidanceSchedule(object):
+    """
+    Classifier-free guidance with an optional timestep window and guidance reuse.
+
+    With the defaults every call evaluates the unconditional and conditional branches in one
+    batch, exactly like the samplers' inline CFG.
+
+    Args:
+        scale: Guidance scale
+        interval: (lo, hi) range of the normalized timestep (1 = pure noise, 0 = data) in which
+            CFG is applied; outside it only the conditional branch is evaluated (scale 1)
+        reuse: After a full CFG evaluation, keep its (cond - uncond) delta for the next `reuse`
+            calls inside the window and only evaluate the conditional branch on those
+    """
+    def __init__(self, scale=1., interval=None, reuse=0):
+        self.scale = scale
+        self.interval = tuple(interval) if interval is not None else (0., 1.)
+        self.reuse = reuse
+        self.delta = None
+        self.reuse_left = 0
+        self.guided_calls = 0
+        self.cond_calls = 0
+
+    def in_window(self, t_frac):
+        lo, hi = self.interval
+        return lo <= t_frac <= hi
+
+    def __call__(self, fn, x, t, c, uc, t_frac):
+        """
+        Guided model output at x.
+
+        Args:
+            fn: Model function fn(x, t, c)
+            t: Model timesteps [B]
+            c, uc: Conditional and unconditional conditioning
+            t_frac: Normalized timestep of this call, as a Python float
+        """
+        if uc is None or self.scale == 1.:
+            return fn(x, t, c)
+
+        if not self.in_window(t_frac):
+            self.cond_calls += 1
+            return fn(x, t, c)
+
+        if self.reuse_left > 0 and self.delta is not None and self.delta.shape == x.shape:
+            self.reuse_left -= 1
+            self.cond_calls += 1
+            return fn(x, t, c) + (self.scale - 1.) * self.delta
+
+        x_in = torch.cat([x] * 2)
+        t_in = torch.cat([t] * 2)
+        c_in = torch.cat([uc, c])
+        e_t_uncond, e_t = fn(x_in, t_in, c_in).chunk(2)
+        self.guided_calls += 1
+        self.delta = e_t - e_t_uncond
+        self.reuse_left = self.reuse
+        return e_t_uncond + self.scale * self.delta
+
+    @property
+    def scheduled(self):
+        return self.interval != (0., 1.) or self.reuse > 0
+
+    def summary(self):
+        return f"CFG: {self.guided_calls} guided, {self.cond_calls} conditional-only model calls"
@@ -0,0 +1 @@
+from .sampler import UniPCSampler
\ No newline at end of file
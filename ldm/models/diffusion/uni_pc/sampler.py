@@ -0,0 +1,119 @@
+"""SAMPLING ONLY."""
+
+import torch
+
+from ldm.models.diffusion.dpm_solver.dpm_solver import NoiseScheduleVP, model_wrapper, step_callback_wrapper
+from ldm.models.diffusion.guidance import GuidanceSchedule
+from ldm.models.diffusion.early_stopping import EarlyStopping
+from .uni_pc import UniPC
+
+
+class UniPCSampler(object):
+    """
+    Multistep UniPC predictor-corrector (data prediction).
+
+    Args:
+        order: Predictor order (the corrector adds one)
+        skip_type: Time step spacing, 'time_uniform', 'logSNR' or 'time_quadratic'
+        variant: 'bh1' or 'bh2'
+    """
+    def __init__(self, model, order=2, skip_type="logSNR", variant="bh2", **kwargs):
+        super().__init__()
+        self.model = model
+        self.order = order
+        self.skip_type = skip_type
+        self.variant = variant
+        device = next(model.parameters()).device
+        to_torch = lambda x: x.clone().detach().to(torch.float32).to(device)
+        self.register_buffer('alphas_cumprod', to_torch(model.alphas_cumprod))
+        self.nfe = 0
+
+    def register_buffer(self, name, attr):
+        if type(attr) == torch.Tensor:
+            # Move to the same device as the model
+            model_device = next(self.model.parameters()).device
+            if attr.device != model_device:
+                attr = attr.to(model_device)
+        setattr(self, name, attr)
+
+    @torch.no_grad()
+    def sample(self,
+               S,
+               batch_size,
+               shape,
+               conditioning=None,
+               callback=None,
+               normals_sequence=None,
+               img_callback=None,
+               quantize_x0=False,
+               eta=0.,
+               mask=None,
+               x0=None,
+               temperature=1.,
+               noise_dropout=0.,
+               score_corrector=None,
+               corrector_kwargs=None,
+               verbose=True,
+               x_T=None,
+               log_every_t=100,
+               unconditional_guidance_scale=1.,
+               unconditional_conditioning=None,
+               # this has to come in the same format as the conditioning, # e.g. as encoded tokens, ...
+               feature_reuse=0,
+               feature_reuse_layer=0,
+               guidance_interval=None,
+               guidance_reuse=0,
+               early_stop_tol=0.,
+               early_stop_patience=2,
+               order=None,
+               skip_type=None,
+               **kwargs
+               ):
+        if conditioning is not None:
+            if isinstance(conditioning, dict):
+                cbs = conditioning[list(conditioning.keys())[0]].shape[0]
+                if cbs != batch_size:
+                    print(f"Warning: Got {cbs} conditionings but batch-size is {batch_size}")
+            else:
+                if conditioning.shape[0] != batch_size:
+                    print(f"Warning: Got {conditioning.shape[0]} conditionings but batch-size is {batch_size}")
+
+        # sampling
+        C, H, W = shape
+        size = (batch_size, C, H, W)
+
+
+        device = self.model.betas.device
+        if x_T is None:
+            img = torch.randn(size, device=device)
+        else:
+            img = x_T
+
+        ns = NoiseScheduleVP('discrete', alphas_cumprod=self.alphas_cumprod)
+        guidance = GuidanceSchedule(unconditional_guidance_scale, guidance_interval, guidance_reuse)
+
+        model_fn = model_wrapper(
+            lambda x, t, c: self.model.apply_model(x, t, c),
+            ns,
+            model_type="noise",
+            guidance_type="classifier-free",
+            condition=conditioning,
+            unconditional_condition=unconditional_conditioning,
+            guidance_scale=unconditional_guidance_scale,
+            # plain CFG stays on the wrapper's own path
+            guidance=guidance if guidance.scheduled else None,
+        )
+        model_fn = step_callback_wrapper(model_fn, callback)
+
+        early_stop = EarlyStopping(early_stop_tol, early_stop_patience)
+        with self.model.inference_mode(), self.model.feature_reuse(feature_reuse, feature_reuse_layer):
+            uni_pc = UniPC(model_fn, ns, predict_x0=True, thresholding=False, variant=self.variant)
+            x = uni_pc.sample(img, steps=S, skip_type=skip_type or self.skip_type, order=order or self.order,
+                              lower_order_final=True, early_stop=early_stop)
+        self.nfe = uni_pc.nfe
+        if early_stop.enabled:
+            print(early_stop.summary(self.nfe, S))
+        if guidance.scheduled:
+            print(guidance.summary())
+
+        return x.to(device), None
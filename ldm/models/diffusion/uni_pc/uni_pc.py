@@ -0,0 +1,162 @@
+import torch
+
+from ldm.models.diffusion.dpm_solver.dpm_solver import DPM_Solver, expand_dims
+
+
+class UniPC(DPM_Solver):
+    def __init__(self, model_fn, noise_schedule, predict_x0=True, thresholding=False, max_val=1., variant='bh2'):
+        """Construct a UniPC (unified predictor-corrector) multistep solver.
+
+        Wei Zhao, Lujia Bai, Yongming Rao, Jie Zhou and Jiwen Lu, "UniPC: A Unified Predictor-Corrector
+        Framework for Fast Sampling of Diffusion Models", arXiv preprint arXiv:2302.04867 (2023).
+
+        Every step runs the UniP predictor, evaluates the model once at the predicted point and uses that
+        evaluation both for the UniC corrector of this step and as the history of the next one, so the
+        corrector raises the order of accuracy without extra model evaluations (NFE == `steps`).
+
+        Args:
+            model_fn: A noise prediction model function which accepts the continuous-time input
+                (t in [epsilon, T]), see `model_wrapper`.
+            noise_schedule: A noise schedule object, such as NoiseScheduleVP.
+            predict_x0: A `bool`. If true, use the data prediction model (UniPC with DPM-Solver++ style
+                updates, recommended for guided sampling).
+            variant: A `str`. 'bh1' (B(h) = h) or 'bh2' (B(h) = e^h - 1). 'bh2' is recommended for guided
+                sampling with few steps.
+        """
+        super().__init__(model_fn, noise_schedule, predict_x0=predict_x0, thresholding=thresholding, max_val=max_val)
+        assert variant in ('bh1', 'bh2')
+        self.variant = variant
+
+    def multistep_uni_pc_update(self, x, model_prev_list, t_prev_list, t, order, use_corrector=True):
+        """
+        One UniPC step from the last time in `t_prev_list` to `t`, of the given order.
+
+        Returns:
+            x_t: The corrected solution at time `t` (the predicted one when `use_corrector` is False).
+            model_t: The model output at the predicted x_t, or None when `use_corrector` is False.
+        """
+        assert order <= len(model_prev_list)
+        ns = self.noise_schedule
+        # all rows share the same times, so the coefficients are computed on scalars
+        t_prev_0, t = t_prev_list[-1][:1], t[:1]
+        lambda_prev_0, lambda_t = ns.marginal_lambda(t_prev_0), ns.marginal_lambda(t)
+        sigma_prev_0, sigma_t = ns.marginal_std(t_prev_0), ns.marginal_std(t)
+        log_alpha_prev_0, log_alpha_t = ns.marginal_log_mean_coeff(t_prev_0), ns.marginal_log_mean_coeff(t)
+        alpha_t = torch.exp(log_alpha_t)
+        model_prev_0 = model_prev_list[-1]
+        h = (lambda_t - lambda_prev_0)[0]
+
+        rks = []
+        D1s = []
+        for i in range(1, order):
+            lambda_prev_i = ns.marginal_lambda(t_prev_list[-(i + 1)][:1])[0]
+            rk = (lambda_prev_i - lambda_prev_0[0]) / h
+            rks.append(rk)
+            D1s.append((model_prev_list[-(i + 1)] - model_prev_0) / rk)
+        rks.append(torch.ones_like(h))
+        rks = torch.stack(rks)
+
+        hh = -h if self.predict_x0 else h
+        h_phi_1 = torch.expm1(hh)  # h * phi_1(h) = e^h - 1
+        h_phi_k = h_phi_1 / hh - 1
+        B_h = hh if self.variant == 'bh1' else h_phi_1
+        R = []
+        b = []
+        factorial_i = 1
+        for i in range(1, order + 1):
+            R.append(torch.pow(rks, i - 1))
+            b.append(h_phi_k * factorial_i / B_h)
+            factorial_i *= i + 1
+            h_phi_k = h_phi_k / hh - 1 / factorial_i
+        R = torch.stack(R)
+        b = torch.stack(b)
+
+        if len(D1s) > 0:
+            D1s = torch.stack(D1s, dim=1)  # [B, K, ...]
+            # the order 2 predictor uses the simplified coefficient of the paper
+            rhos_p = torch.tensor([0.5], device=x.device) if order == 2 else torch.linalg.solve(R[:-1, :-1], b[:-1])
+            pred_res = torch.einsum('k,bk...->b...', rhos_p.to(x.dtype), D1s)
+        else:
+            D1s = None
+            pred_res = 0
+        if use_corrector:
+            rhos_c = torch.tensor([0.5], device=x.device) if order == 1 else torch.linalg.solve(R, b)
+            rhos_c = rhos_c.to(x.dtype)
+
+        dims = x.dim()
+        if self.predict_x0:
+            x_t_ = expand_dims(sigma_t / sigma_prev_0, dims) * x - expand_dims(alpha_t * h_phi_1, dims) * model_prev_0
+            scale = expand_dims(alpha_t * B_h, dims)
+        else:
+            x_t_ = expand_dims(torch.exp(log_alpha_t - log_alpha_prev_0), dims) * x - expand_dims(sigma_t * h_phi_1, dims) * model_prev_0
+            scale = expand_dims(sigma_t * B_h, dims)
+        x_t = x_t_ - scale * pred_res
+
+        model_t = None
+        if use_corrector:
+            model_t = self.model_fn(x_t, t.expand(x.shape[0]))
+            corr_res = torch.einsum('k,bk...->b...', rhos_c[:-1], D1s) if D1s is not None else 0
+            x_t = x_t_ - scale * (corr_res + rhos_c[-1] * (model_t - model_prev_0))
+        return x_t, model_t
+
+    def sample(self, x, steps=10, t_start=None, t_end=None, order=2, skip_type='time_uniform',
+        lower_order_final=True, early_stop=None,
+    ):
+        """
+        Compute the sample at time `t_end` by multistep UniPC, given the initial `x` at time `t_start`.
+        The total number of function evaluations (NFE) == `steps`.
+
+        Args:
+            x: A pytorch tensor. The initial value at time `t_start`.
+            steps: A `int`. The total number of function evaluations (NFE).
+            order: A `int`. The order of UniPC (the predictor; the corrector is one order higher).
+            skip_type: A `str`. 'logSNR' or 'time_uniform' or 'time_quadratic', see `get_time_steps`.
+            lower_order_final: A `bool`. Whether to use lower order solvers at the final steps (for `steps` < 15).
+            early_stop: An optional `EarlyStopping`, as in `DPM_Solver.sample`.
+        Returns:
+            x_end: A pytorch tensor. The approximated solution at time `t_end`.
+        """
+        t_0 = 1. / self.noise_schedule.total_N if t_end is None else t_end
+        t_T = self.noise_schedule.T if t_start is None else t_start
+        assert steps >= order
+        timesteps = self.get_time_steps(skip_type=skip_type, t_T=t_T, t_0=t_0, N=steps, device=x.device)
+        if early_stop is not None and not early_stop.enabled:
+            early_stop = None
+        self.nfe = 0
+
+        def converged(x, model_out, vec_t):
+            self.nfe += 1
+            return early_stop is not None and early_stop(self.to_data_prediction(x, model_out, vec_t), self.nfe - 1, steps)
+
+        with torch.no_grad():
+            vec_t = timesteps[0].expand(x.shape[0])
+            model_prev_list = [self.model_fn(x, vec_t)]
+            t_prev_list = [vec_t]
+            if converged(x, model_prev_list[-1], vec_t):
+                return self.to_data_prediction(x, model_prev_list[-1], vec_t)
+            # Init the first `order` values by lower order UniPC.
+            for init_order in range(1, order):
+                vec_t = timesteps[init_order].expand(x.shape[0])
+                x, model_x = self.multistep_uni_pc_update(x, model_prev_list, t_prev_list, vec_t, init_order)
+                model_prev_list.append(model_x)
+                t_prev_list.append(vec_t)
+                if converged(x, model_x, vec_t):
+                    return self.to_data_prediction(x, model_x, vec_t)
+            for step in range(order, steps + 1):
+                vec_t = timesteps[step].expand(x.shape[0])
+                if lower_order_final and steps < 15:
+                    step_order = min(order, steps + 1 - step)
+                else:
+                    step_order = order
+                # the last step has no next model evaluation to correct with
+                x, model_x = self.multistep_uni_pc_update(x, model_prev_list, t_prev_list, vec_t, step_order,
+                                                          use_corrector=step < steps)
+                for i in range(order - 1):
+                    t_prev_list[i] = t_prev_list[i + 1]
+                    model_prev_list[i] = model_prev_list[i + 1]
+                t_prev_list[-1] = vec_t
+                if step < steps:
+                    model_prev_list[-1] = model_x
+                    if converged(x, model_x, vec_t):
+                        return self.to_data_prediction(x, model_x, vec_t)
+        return x
@@ -2,10 +2,11 @@ from inspect import isfunction
 import math
 import torch
 import torch.nn.functional as F
-from torch import nn, einsum
+from torch import nn
 from einops import rearrange, repeat
 
 from ldm.modules.diffusionmodules.util import checkpoint
+from utility.attention import attention
 
 
 def exists(val):
@@ -167,9 +168,19 @@ class CrossAttention(nn.Module):
             nn.Dropout(dropout)
         )
 
+        # per-prompt cache for single-token contexts, see set_context_cache
+        self.cache_context = False
+        self.context_cache_size = 4
+        self._context_cache = []
+
     def forward(self, x, context=None, mask=None):
         h = self.heads
 
+        if exists(context) and context.shape[1] == 1 and not exists(mask):
+            # a softmax over a single key is identically one, so every query
+            # receives the projected value of that key
+            return self.single_token_forward(context).expand(-1, x.shape[1], -1)
+
         q = self.to_q(x)
         context = default(context, x)
         k = self.to_k(context)
@@ -177,23 +188,55 @@ class CrossAttention(nn.Module):
 
         q, k, v = map(lambda t: rearrange(t, 'b n (h d) -> (b h) n d', h=h), (q, k, v))
 
-        sim = einsum('b i d, b j d -> b i j', q, k) * self.scale
-
         if exists(mask):
             mask = rearrange(mask, 'b ... -> b (...)')
-            max_neg_value = -torch.finfo(sim.dtype).max
             mask = repeat(mask, 'b j -> (b h) () j', h=h)
-            sim.masked_fill_(~mask, max_neg_value)
-
-        # attention, what we cannot get enough of
-        attn = sim.softmax(dim=-1)
 
-        out = einsum('b i j, b j d -> b i d', attn, v)
+        # attention, what we cannot get enough of (backend: see utility.attention)
+        out = attention(q, k, v, self.scale, mask)
         out = rearrange(out, '(b h) n d -> b n (h d)', h=h)
         return self.to_out(out)
 
+    def single_token_forward(self, context):
+        """
+        Attention output for a length-1 context, shaped [b, 1, query_dim].
+        When caching is enabled the result is reused for as long as the same
+        context is fed in again, i.e. for every timestep of a prompt.
+        """
+        if not self.cache_context or torch.is_grad_enabled():
+            return self.to_out(self.to_v(context))
+
+        for cached_context, cached_out in self._context_cache:
+            if cached_context.shape == context.shape and cached_context.dtype == context.dtype \
+                    and cached_context.device == context.device and torch.equal(cached_context, context):
+                return cached_out
+
+        out = self.to_out(self.to_v(context))
+        self._context_cache.append((context.clone(), out))
+        if len(self._context_cache) > self.context_cache_size:
+            self._context_cache.pop(0)
+        return out
+
+
+def set_context_cache(module, enabled=True, max_entries=4):
+    """
+    Enable or disable the single-token cross-attention cache on every
+    CrossAttention inside `module`. Existing cache entries are dropped.
+    :param max_entries: number of distinct contexts kept per layer, e.g. the
+                        conditional and unconditional batches of a CFG run.
+    """
+    for m in module.modules():
+        if isinstance(m, CrossAttention):
+            m.cache_context = enabled
+            m.context_cache_size = max_entries
+            m._context_cache = []
+    return module
+
 
 class BasicTransformerBlock(nn.Module):
+    # set by util.set_inference_mode: call _forward directly, skipping checkpoint()
+    inference = False
+
     def __init__(self, dim, n_heads, d_head, dropout=0., context_dim=None, gated_ff=True, checkpoint=True):
         super().__init__()
         self.attn1 = CrossAttention(query_dim=dim, heads=n_heads, dim_head=d_head, dropout=dropout)  # is a self-attention
@@ -206,6 +249,8 @@ class BasicTransformerBlock(nn.Module):
         self.checkpoint = checkpoint
 
     def forward(self, x, context=None):
+        if self.inference:
+            return self._forward(x, context)
         return checkpoint(self._forward, (x, context), self.parameters(), self.checkpoint)
 
     def _forward(self, x, context=None):
@@ -17,7 +17,8 @@ from ldm.modules.diffusionmodules.util import (
     normalization,
     timestep_embedding,
 )
-from ldm.modules.attention import SpatialTransformer
+from ldm.modules.attention import SpatialTransformer, set_context_cache
+from utility.attention import attention
 
 
 # dummy replace
@@ -77,7 +78,40 @@ class TimestepEmbedSequential(nn.Sequential, TimestepBlock):
     support it as an extra input.
     """
 
+    # (call, input) per layer, resolved once by fuse_dispatch for inference
+    dispatch = None
+
+    def fuse_dispatch(self, enabled=True):
+        """
+        Resolve once which input each layer takes, and call the blocks in inference mode through
+        their _forward, so the per-step forward skips the isinstance checks and module calls.
+        """
+        if not enabled:
+            self.dispatch = None
+            return
+        dispatch = []
+        for layer in self:
+            call = layer._forward if getattr(layer, 'inference', False) else layer
+            if isinstance(layer, TimestepBlock):
+                dispatch.append((call, 'emb'))
+            elif isinstance(layer, SpatialTransformer):
+                dispatch.append((call, 'context'))
+            else:
+                dispatch.append((call, None))
+        self.dispatch = dispatch
+
     def forward(self, x, emb, context=None):
+        # read once: another thread may leave inference mode meanwhile
+        dispatch = self.dispatch
+        if dispatch is not None:
+            for call, arg in dispatch:
+                if arg == 'emb':
+                    x = call(x, emb)
+                elif arg == 'context':
+                    x = call(x, context)
+                else:
+                    x = call(x)
+            return x
         for layer in self:
             if isinstance(layer, TimestepBlock):
                 x = layer(x, emb)
@@ -176,6 +210,9 @@ class ResBlock(TimestepBlock):
     :param down: if True, use this block for downsampling.
     """
 
+    # set by util.set_inference_mode: call _forward directly, skipping checkpoint()
+    inference = False
+
     def __init__(
         self,
         channels,
@@ -247,6 +284,8 @@ class ResBlock(TimestepBlock):
         :param emb: an [N x emb_channels] Tensor of timestep embeddings.
         :return: an [N x C x ...] Tensor of outputs.
         """
+        if self.inference:
+            return self._forward(x, emb)
         return checkpoint(
             self._forward, (x, emb), self.parameters(), self.use_checkpoint
         )
@@ -282,6 +321,9 @@ class AttentionBlock(nn.Module):
     https://github.com/hojonathanho/diffusion/blob/1e0dceb3b3495bbe19116a5e1b3596cd0706c543/diffusion_tf/models/unet.py#L66.
     """
 
+    # set by util.set_inference_mode: call _forward directly, skipping checkpoint()
+    inference = False
+
     def __init__(
         self,
         channels,
@@ -312,6 +354,8 @@ class AttentionBlock(nn.Module):
         self.proj_out = zero_module(conv_nd(1, channels, channels, 1))
 
     def forward(self, x):
+        if self.inference:
+            return self._forward(x)
         return checkpoint(self._forward, (x,), self.parameters(), True)   # TODO: check checkpoint usage, is True # TODO: fix the .half call!!!
         #return pt_checkpoint(self._forward, x)  # pytorch
 
@@ -363,13 +407,8 @@ class QKVAttentionLegacy(nn.Module):
         assert width % (3 * self.n_heads) == 0
         ch = width // (3 * self.n_heads)
         q, k, v = qkv.reshape(bs * self.n_heads, ch * 3, length).split(ch, dim=1)
-        scale = 1 / math.sqrt(math.sqrt(ch))
-        weight = th.einsum(
-            "bct,bcs->bts", q * scale, k * scale
-        )  # More stable with f16 than dividing afterwards
-        weight = th.softmax(weight.float(), dim=-1).type(weight.dtype)
-        a = th.einsum("bts,bcs->bct", weight, v)
-        return a.reshape(bs, -1, length)
+        a = attention(q.transpose(1, 2), k.transpose(1, 2), v.transpose(1, 2), 1 / math.sqrt(ch))
+        return a.transpose(1, 2).reshape(bs, -1, length)
 
     @staticmethod
     def count_flops(model, _x, y):
@@ -394,16 +433,9 @@ class QKVAttention(nn.Module):
         bs, width, length = qkv.shape
         assert width % (3 * self.n_heads) == 0
         ch = width // (3 * self.n_heads)
-        q, k, v = qkv.chunk(3, dim=1)
-        scale = 1 / math.sqrt(math.sqrt(ch))
-        weight = th.einsum(
-            "bct,bcs->bts",
-            (q * scale).view(bs * self.n_heads, ch, length),
-            (k * scale).view(bs * self.n_heads, ch, length),
-        )  # More stable with f16 than dividing afterwards
-        weight = th.softmax(weight.float(), dim=-1).type(weight.dtype)
-        a = th.einsum("bts,bcs->bct", weight, v.reshape(bs * self.n_heads, ch, length))
-        return a.reshape(bs, -1, length)
+        q, k, v = (t.reshape(bs * self.n_heads, ch, length).transpose(1, 2) for t in qkv.chunk(3, dim=1))
+        a = attention(q, k, v, 1 / math.sqrt(ch))
+        return a.transpose(1, 2).reshape(bs, -1, length)
 
     @staticmethod
     def count_flops(model, _x, y):
@@ -691,6 +723,13 @@ class UNetModel(nn.Module):
             #nn.LogSoftmax(dim=1)  # change to cross_entropy and produce non-normalized logits
         )
 
+        # deep feature reuse across sampling steps, see set_feature_reuse
+        self.reuse_interval = 0
+        self.reuse_layer = 0
+        self.full_calls = 0
+        self.partial_calls = 0
+        self.reset_feature_cache()
+
     def convert_to_fp16(self):
         """
         Convert the torso of the model to float16.
@@ -707,6 +746,37 @@ class UNetModel(nn.Module):
         self.middle_block.apply(convert_module_to_f32)
         self.output_blocks.apply(convert_module_to_f32)
 
+    def set_context_cache(self, enabled=True):
+        """
+        Reuse the cross-attention output of single-token contexts across
+        timesteps. Exact, and only active under torch.no_grad().
+        """
+        set_context_cache(self, enabled)
+
+    def set_feature_reuse(self, interval=0, layer=0):
+        """
+        Approximate acceleration for sampling (DeepCache-style). Every interval-th forward
+        call runs the full UNet and caches the deep features entering the last layer + 1
+        output blocks; the calls in between only run input blocks 0..layer and those
+        output blocks, reusing the cached deep features. interval <= 1 disables it.
+        Features and the call count are kept per batch size, so calls that switch between
+        a CFG batch and a conditional-only batch (guidance interval/reuse) each reuse their own.
+        Only active under torch.no_grad(). full_calls / partial_calls count the calls
+        made since it was last enabled.
+        """
+        assert 0 <= layer < len(self.input_blocks) - 1, f"reuse layer must be in [0, {len(self.input_blocks) - 2}]"
+        self.reuse_interval = interval
+        self.reuse_layer = layer
+        self.reset_feature_cache()
+        if interval > 1:
+            self.full_calls = 0
+            self.partial_calls = 0
+
+    def reset_feature_cache(self):
+        # batch size -> cached deep features / number of calls
+        self._cached_features = {}
+        self._reuse_calls = {}
+
     def forward(self, x, timesteps=None, context=None, y=None,**kwargs):
         """
         Apply the model to an input batch.
@@ -728,15 +798,39 @@ class UNetModel(nn.Module):
             emb = emb + self.label_emb(y)
 
         h = x.type(self.dtype)
-        for module in self.input_blocks:
-            h = module(h, emb, context)
-            hs.append(h)
-        h = self.middle_block(h, emb, context)
-        for module in self.output_blocks:
+        reuse = self.reuse_interval > 1 and not th.is_grad_enabled()
+        if reuse:
+            calls = self._reuse_calls.get(x.shape[0], 0)
+            reuse_step = x.shape[0] in self._cached_features and calls % self.reuse_interval != 0
+            self._reuse_calls[x.shape[0]] = calls + 1
+        else:
+            reuse_step = False
+        # output blocks from this index on pair with input blocks reuse_layer..0
+        shallow_start = len(self.output_blocks) - 1 - self.reuse_layer
+
+        if reuse_step:
+            self.partial_calls += 1
+            for module in self.input_blocks[:self.reuse_layer + 1]:
+                h = module(h, emb, context)
+                hs.append(h)
+            h = self._cached_features[x.shape[0]]
+            output_blocks = self.output_blocks[shallow_start:]
+        else:
+            for module in self.input_blocks:
+                h = module(h, emb, context)
+                hs.append(h)
+            h = self.middle_block(h, emb, context)
+            output_blocks = self.output_blocks
+            if reuse:
+                self.full_calls += 1
+
+        for i, module in enumerate(output_blocks):
             # if h.shape[1] == 640:
             #     # h[:, :320] = h[:, :320] * 1.4
             #     # print("here")
             #     h = h * 1.2
+            if reuse and not reuse_step and i == shallow_start:
+                self._cached_features[x.shape[0]] = h
             h = th.cat([h, hs.pop()], dim=1)
             h = module(h, emb, context)
         h = h.type(x.dtype)
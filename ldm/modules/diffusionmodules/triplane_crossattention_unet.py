@@ -80,7 +80,40 @@ class TimestepEmbedSequential(nn.Sequential, TimestepBlock):
     support it as an extra input.
     """
 
+    # (call, input) per layer, resolved once by fuse_dispatch for inference
+    dispatch = None
+
+    def fuse_dispatch(self, enabled=True):
+        """
+        Resolve once which input each layer takes, and call the blocks in inference mode through
+        their _forward, so the per-step forward skips the isinstance checks and module calls.
+        """
+        if not enabled:
+            self.dispatch = None
+            return
+        dispatch = []
+        for layer in self:
+            call = layer._forward if getattr(layer, 'inference', False) else layer
+            if isinstance(layer, TimestepBlock):
+                dispatch.append((call, 'emb'))
+            elif isinstance(layer, SpatialTransformer):
+                dispatch.append((call, 'context'))
+            else:
+                dispatch.append((call, None))
+        self.dispatch = dispatch
+
     def forward(self, x, emb, context=None):
+        # read once: another thread may leave inference mode meanwhile
+        dispatch = self.dispatch
+        if dispatch is not None:
+            for call, arg in dispatch:
+                if arg == 'emb':
+                    x = call(x, emb)
+                elif arg == 'context':
+                    x = call(x, context)
+                else:
+                    x = call(x)
+            return x
         for layer in self:
             if isinstance(layer, TimestepBlock):
                 x = layer(x, emb)
@@ -179,6 +212,9 @@ class ResBlock(TimestepBlock):
     :param down: if True, use this block for downsampling.
     """
 
+    # set by util.set_inference_mode: call _forward directly, skipping checkpoint()
+    inference = False
+
     def __init__(
         self,
         channels,
@@ -250,6 +286,8 @@ class ResBlock(TimestepBlock):
         :param emb: an [N x emb_channels] Tensor of timestep embeddings.
         :return: an [N x C x ...] Tensor of outputs.
         """
+        if self.inference:
+            return self._forward(x, emb)
         return checkpoint(
             self._forward, (x, emb), self.parameters(), self.use_checkpoint
         )
@@ -333,6 +371,9 @@ class CrossAttention(nn.Module):
 
 
 class TriplaneAttentionBlock(nn.Module):
+    # set by util.set_inference_mode: call _forward directly, skipping checkpoint()
+    inference = False
+
     def __init__(
         self,
         channels,
@@ -358,6 +399,8 @@ class TriplaneAttentionBlock(nn.Module):
         self.plane3_ca = CrossAttention(channels, channels, self.num_heads, num_head_channels)
 
     def forward(self, x):
+        if self.inference:
+            return self._forward(x)
         return checkpoint(self._forward, (x,), self.parameters(), True)   # TODO: check checkpoint usage, is True # TODO: fix the .half call!!!
         #return pt_checkpoint(self._forward, x)  # pytorch
 
@@ -385,6 +428,9 @@ class AttentionBlock(nn.Module):
     https://github.com/hojonathanho/diffusion/blob/1e0dceb3b3495bbe19116a5e1b3596cd0706c543/diffusion_tf/models/unet.py#L66.
     """
 
+    # set by util.set_inference_mode: call _forward directly, skipping checkpoint()
+    inference = False
+
     def __init__(
         self,
         channels,
@@ -415,6 +461,8 @@ class AttentionBlock(nn.Module):
         self.proj_out = zero_module(conv_nd(1, channels, channels, 1))
 
     def forward(self, x):
+        if self.inference:
+            return self._forward(x)
         return checkpoint(self._forward, (x,), self.parameters(), True)   # TODO: check checkpoint usage, is True # TODO: fix the .half call!!!
         #return pt_checkpoint(self._forward, x)  # pytorch
 
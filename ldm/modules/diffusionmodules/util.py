@@ -10,10 +10,12 @@
 
 import os
 import math
+import threading
 import torch
 import torch.nn as nn
 import numpy as np
 from einops import repeat
+from collections import OrderedDict
 
 from ldm.util import instantiate_from_config
 
@@ -119,6 +121,79 @@ def make_ddim_sampling_parameters(alphacums, ddim_timesteps, eta, verbose=True):
     return sigmas, alphas, alphas_prev
 
 
+# max schedules kept per model (distinct steps/eta/device/dtype combinations)
+DDIM_SCHEDULE_CACHE_SIZE = 16
+_ddim_schedule_lock = threading.Lock()
+
+
+def get_ddim_schedule(model, ddim_num_steps, ddim_discretize="uniform", ddim_eta=0., device=None, dtype=torch.float32):
+    """
+    DDIM/PLMS sampling tables for a model, cached on the model per (steps, eta, discretization,
+    device, dtype) and shared by all sampler instances. The alphas_cumprod buffer is identified by
+    its storage and in-place version counter, so a lookup never copies it off the device, and
+    replacing or modifying it invalidates the entries.
+
+    Besides the per-timestep buffers that DDIMSampler.make_schedule used to build, the per-step
+    scalars a_t, a_prev, sigma_t and sqrt_one_minus_at are precomputed as [S, 1, 1, 1] device
+    tensors (indexed by the DDIM step index), so sampling steps do not allocate them.
+
+    Returns:
+        dict of attribute name -> tensor (ddim_timesteps stays a numpy array)
+    """
+    if device is None:
+        device = next(model.parameters()).device
+    buffer = model.alphas_cumprod
+    key = (ddim_num_steps, float(ddim_eta), ddim_discretize, str(device), dtype, buffer.data_ptr(), buffer._version)
+    with _ddim_schedule_lock:
+        # in __dict__ rather than a module-level dict keyed by id(model), so it goes away with the model
+        cache = model.__dict__.setdefault('_ddim_schedule_cache', OrderedDict())
+        if key in cache:
+            cache.move_to_end(key)
+            return cache[key]
+
+    alphas_cumprod = buffer.detach().cpu().float()
+    alphas_np = alphas_cumprod.numpy().astype(np.float32)
+    num_ddpm_timesteps = alphas_np.shape[0]
+    ddim_timesteps = make_ddim_timesteps(ddim_discr_method=ddim_discretize, num_ddim_timesteps=ddim_num_steps,
+                                         num_ddpm_timesteps=num_ddpm_timesteps, verbose=False)
+    ddim_sigmas, ddim_alphas, ddim_alphas_prev = make_ddim_sampling_parameters(alphacums=alphas_np,
+                                                                               ddim_timesteps=ddim_timesteps,
+                                                                               eta=ddim_eta, verbose=False)
+    to_torch = lambda x: torch.as_tensor(np.asarray(x, dtype=np.float32)).to(device=device, dtype=dtype)
+    alphas_cumprod_prev = model.alphas_cumprod_prev.detach().cpu().float()
+
+    schedule = {
+        'ddim_timesteps': ddim_timesteps,
+        'betas': model.betas.detach().to(device=device, dtype=dtype),
+        'alphas_cumprod': alphas_cumprod.to(device=device, dtype=dtype),
+        'alphas_cumprod_prev': alphas_cumprod_prev.to(device=device, dtype=dtype),
+        'sqrt_alphas_cumprod': to_torch(np.sqrt(alphas_np)),
+        'sqrt_one_minus_alphas_cumprod': to_torch(np.sqrt(1. - alphas_np)),
+        'log_one_minus_alphas_cumprod': to_torch(np.log(1. - alphas_np)),
+        'sqrt_recip_alphas_cumprod': to_torch(np.sqrt(1. / alphas_np)),
+        'sqrt_recipm1_alphas_cumprod': to_torch(np.sqrt(1. / alphas_np - 1)),
+        'ddim_sigmas': to_torch(ddim_sigmas),
+        'ddim_alphas': to_torch(ddim_alphas),
+        'ddim_alphas_prev': to_torch(ddim_alphas_prev),
+        'ddim_sqrt_one_minus_alphas': to_torch(np.sqrt(1. - ddim_alphas)),
+        'ddim_sigmas_for_original_num_steps': (ddim_eta * torch.sqrt(
+            (1 - alphas_cumprod_prev) / (1 - alphas_cumprod) * (1 - alphas_cumprod / alphas_cumprod_prev)
+        )).to(device=device, dtype=dtype),
+    }
+    # per-step scalars, broadcast against [B, C, H, W]
+    schedule['step_a_t'] = schedule['ddim_alphas'].reshape(-1, 1, 1, 1)
+    schedule['step_a_prev'] = schedule['ddim_alphas_prev'].reshape(-1, 1, 1, 1)
+    schedule['step_sigma_t'] = schedule['ddim_sigmas'].reshape(-1, 1, 1, 1)
+    schedule['step_sqrt_one_minus_at'] = schedule['ddim_sqrt_one_minus_alphas'].reshape(-1, 1, 1, 1)
+    schedule['step_timesteps'] = torch.as_tensor(ddim_timesteps.astype(np.int64), device=device)
+
+    with _ddim_schedule_lock:
+        cache[key] = schedule
+        while len(cache) > DDIM_SCHEDULE_CACHE_SIZE:
+            cache.popitem(last=False)
+    return schedule
+
+
 def betas_for_alpha_bar(num_diffusion_timesteps, alpha_bar, max_beta=0.999):
     """
     Create a beta schedule that discretizes the given alpha_t_bar function,
@@ -161,6 +236,24 @@ def checkpoint(func, inputs, params, flag):
         return func(*inputs)
 
 
+def set_inference_mode(module, enabled=True):
+    """
+    Inference fast path for the diffusion UNets. checkpoint() builds an autograd Function and
+    collects self.parameters() on every call, even under torch.no_grad(); in inference mode the
+    checkpointed blocks (those with an `inference` flag) call their _forward directly, and every
+    TimestepEmbedSequential resolves its per-layer dispatch once. Disabling restores the
+    checkpointed path used for training.
+    """
+    for m in module.modules():
+        if hasattr(type(m), 'inference'):
+            m.inference = enabled
+    # after the flags, so the fused dispatch sees them
+    for m in module.modules():
+        if hasattr(type(m), 'fuse_dispatch'):
+            m.fuse_dispatch(enabled)
+    return module
+
+
 class CheckpointFunction(torch.autograd.Function):
     @staticmethod
     def forward(ctx, run_function, length, *args):
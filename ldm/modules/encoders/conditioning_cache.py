@@ -0,0 +1,109 @@
+"""LRU (plus optional on-disk) cache of text conditionings."""
+import os
+import hashlib
+import threading
+from collections import OrderedDict
+
+import torch
+
+
+def normalize_prompt(prompt):
+    """
+    Collapse whitespace and lowercase, as the CLIP tokenizer does before encoding.
+    """
+    return ' '.join(prompt.split()).lower()
+
+
+class ConditioningCache(object):
+    """
+    Maps prompts to their encoded conditioning, keyed by (encoder version, normalized prompt).
+
+    Args:
+        version: Identifies the encoder and its settings; entries of other versions never match
+        capacity: Max prompts kept in memory, least recently used are evicted first
+        cache_dir: Optional directory where every encoded prompt is also stored as a .pt file
+        batch_size: Max prompts per encoder call when encoding misses
+    """
+    def __init__(self, version, capacity=1024, cache_dir=None, batch_size=64):
+        self.version = version
+        self.capacity = capacity
+        self.cache_dir = cache_dir
+        self.batch_size = batch_size
+        self.entries = OrderedDict()
+        # the generation daemon encodes prompts from several threads
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    def key(self, prompt):
+        payload = f"{self.version}\0{normalize_prompt(prompt)}"
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()[:32]
+
+    def path(self, key):
+        return os.path.join(self.cache_dir, f"{key}.pt")
+
+    def put(self, key, value):
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.capacity:
+                self.entries.popitem(last=False)
+
+    def lookup(self, key, device):
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                return self.entries[key]
+        if self.cache_dir is not None and os.path.exists(self.path(key)):
+            try:
+                value = torch.load(self.path(key), map_location=device)
+            except Exception:
+                return None
+            self.put(key, value)
+            return value
+        return None
+
+    def store(self, key, value):
+        self.put(key, value)
+        if self.cache_dir is not None:
+            tmp_path = self.path(key) + '.tmp'
+            torch.save(value.detach().cpu(), tmp_path)
+            os.replace(tmp_path, self.path(key))
+
+    def get(self, prompts, encode_fn, device=None):
+        """
+        Conditioning for a list of prompts, encoding only the ones not cached yet.
+
+        Args:
+            prompts: List of prompts
+            encode_fn: Encoder for a list of prompts, returning one row per prompt
+            device: Device for entries loaded from disk
+
+        Returns:
+            Tensor with one row per prompt, in order
+        """
+        keys = [self.key(p) for p in prompts]
+        found = {}
+        missing = OrderedDict()
+        for key, prompt in zip(keys, prompts):
+            if key in found or key in missing:
+                continue
+            value = self.lookup(key, device)
+            if value is None:
+                missing[key] = prompt
+            else:
+                found[key] = value
+        self.hits += len(found)
+        self.misses += len(missing)
+
+        missing = list(missing.items())
+        for p in range(0, len(missing), self.batch_size):
+            chunk = missing[p:p+self.batch_size]
+            encoded = encode_fn([prompt for _, prompt in chunk])
+            for i, (key, _) in enumerate(chunk):
+                value = encoded[i:i+1].detach().clone()
+                self.store(key, value)
+                found[key] = value
+        return torch.cat([found[key] for key in keys])
@@ -2,11 +2,14 @@ import torch
 import torch.nn as nn
 from functools import partial
 import clip
+from clip.model import build_model
+from safetensors.torch import load_file, save_file
 from einops import rearrange, repeat
 from transformers import CLIPTokenizer, CLIPTextModel
 import kornia
 
 from ldm.modules.x_transformer import Encoder, TransformerWrapper  # TODO: can we directly rely on lucidrains code and simply add this as a reuirement? --> test
+from utility.model_loader import empty_init_enabled, real_weights, safetensors_meta_state_dict
 
 
 class AbstractEncoder(nn.Module):
@@ -243,13 +246,44 @@ def tokenize_with_truncation(texts: Union[str, List[str]], context_length: int =
 
     return result
 
+def clip_weights_path(version, download_root=None):
+    """
+    Where the safetensors copy of a CLIP model's weights is kept (next to clip's own downloads).
+    """
+    root = download_root or os.path.expanduser("~/.cache/clip")
+    return os.path.join(root, version.replace('/', '-') + '.safetensors')
+
+
+def load_clip_model(version, download_root=None):
+    """
+    CLIP model in float32 on the CPU, as clip.load(version, jit=False, device="cpu") returns it.
+
+    The first call goes through clip.load and stores the weights as safetensors; later calls build
+    the model from that file and never unpack the original archive. Inside init_empty_weights only
+    the tensor shapes are read, since the weights come from the diffusion checkpoint.
+    """
+    path = clip_weights_path(version, download_root)
+    if os.path.exists(path):
+        state_dict = safetensors_meta_state_dict(path) if empty_init_enabled() else load_file(path)
+        return build_model(state_dict).float()
+
+    with real_weights():
+        model, _ = clip.load(version, jit=False, device="cpu", download_root=download_root)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = path + '.tmp'
+    save_file({k: v.contiguous() for k, v in model.state_dict().items()}, tmp_path)
+    os.replace(tmp_path, path)
+    return model
+
+
 class FrozenCLIPTextEmbedder(nn.Module):
     """
     Uses the CLIP transformer encoder for text.
     """
     def __init__(self, version='ViT-L/14', device="cuda", max_length=77, n_repeat=1, normalize=True):
         super().__init__()
-        self.model, _ = clip.load(version, jit=False, device="cpu")
+        self.model = load_clip_model(version)
+        self.version = version
         self.device = device
         self.max_length = max_length
         self.n_repeat = n_repeat
@@ -286,6 +286,56 @@ class AutoencoderKL(pl.LightningModule):
             rec_img_list.append(rec_img)
         return torch.cat(rec_img_list, 0), psnr_list
 
+    def render_triplane_eg3d_decoder_views(self, triplane, batch_rays, ray_budget=2**15, occupancy=False, termination_eps=0.):
+        """
+        Render many views of a batch of triplanes, packing rays from several views into each
+        renderer call instead of rendering one view at a time.
+
+        Args:
+            triplane: [B, C, H, W] decoded triplanes
+            batch_rays: [V, 2, H*W, 3] ray origins and directions per view
+            ray_budget: max rays per renderer call, summed over the batch
+            occupancy: skip empty space using an occupancy grid built once for all views
+            termination_eps: stop evaluating rays once their transmittance drops below this (0 disables)
+
+        Returns:
+            rgb [B, V, H, W, 3] in [0, 1]
+        """
+        B = triplane.shape[0]
+        V, _, M, _ = batch_rays.shape
+        H = W = int(M ** 0.5)
+        res = triplane.shape[-2]
+        planes = triplane.reshape(B, 3, -1, res, res)
+        batch_rays = batch_rays.to(triplane.device, triplane.dtype)
+
+        # ray limits per view, so packing does not change how rays that miss the box are handled
+        ray_start, ray_end = self.triplane_decoder.ray_limits(batch_rays[:, 0], batch_rays[:, 1], self.triplane_render_kwargs, per_row=True)
+        ray_o = batch_rays[:, 0].reshape(1, V * M, 3)
+        ray_d = batch_rays[:, 1].reshape(1, V * M, 3)
+        ray_start = ray_start.reshape(1, V * M, 1)
+        ray_end = ray_end.reshape(1, V * M, 1)
+
+        base_kwargs = dict(self.triplane_render_kwargs)
+        if occupancy:
+            base_kwargs['occupancy_grid'] = self.triplane_decoder.build_occupancy_grid(planes, base_kwargs)
+        if termination_eps > 0:
+            base_kwargs['termination_eps'] = termination_eps
+
+        chunk = max(1, ray_budget // B)
+        rgb_list = []
+        for p in range(0, V * M, chunk):
+            render_kwargs = dict(base_kwargs)
+            render_kwargs['ray_limits'] = (
+                ray_start[:, p:p+chunk].expand(B, -1, -1),
+                ray_end[:, p:p+chunk].expand(B, -1, -1),
+            )
+            with torch.no_grad():
+                render_out = self.triplane_decoder(planes,
+                            ray_o[:, p:p+chunk].expand(B, -1, -1), ray_d[:, p:p+chunk].expand(B, -1, -1),
+                            render_kwargs, whole_img=False, tvloss=False)
+            rgb_list.append(render_out['rgb_marched'])
+        return torch.cat(rgb_list, 1).reshape(B, V, H, W, 3)
+
     def render_triplane_eg3d_decoder_sample_pixel(self, triplane, batch_rays, target, sample_num=1024):
         assert batch_rays.shape[1] == 1
         sel = torch.randint(batch_rays.shape[-2], [sample_num])
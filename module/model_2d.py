@@ -6,6 +6,7 @@ import numpy as np
 from einops import rearrange
 
 from utility.initialize import instantiate_from_config
+from utility.attention import attention
 from .nn_2d import LinearAttention
 
 
@@ -182,20 +183,13 @@ class AttnBlock(nn.Module):
         k = self.k(h_)
         v = self.v(h_)
 
-        # compute attention
+        # compute attention (backend: see utility.attention)
         b,c,h,w = q.shape
-        q = q.reshape(b,c,h*w)
-        q = q.permute(0,2,1)   # b,hw,c
-        k = k.reshape(b,c,h*w) # b,c,hw
-        w_ = torch.bmm(q,k)     # b,hw,hw    w[b,i,j]=sum_c q[b,i,c]k[b,c,j]
-        w_ = w_ * (int(c)**(-0.5))
-        w_ = torch.nn.functional.softmax(w_, dim=2)
-
-        # attend to values
-        v = v.reshape(b,c,h*w)
-        w_ = w_.permute(0,2,1)   # b,hw,hw (first hw of k, second of q)
-        h_ = torch.bmm(v,w_)     # b, c,hw (hw of q) h_[b,c,j] = sum_i v[b,c,i] w_[b,i,j]
-        h_ = h_.reshape(b,c,h,w)
+        q = q.reshape(b,c,h*w).permute(0,2,1)   # b,hw,c
+        k = k.reshape(b,c,h*w).permute(0,2,1)   # b,hw,c
+        v = v.reshape(b,c,h*w).permute(0,2,1)   # b,hw,c
+        h_ = attention(q, k, v, int(c)**(-0.5))  # b,hw,c
+        h_ = h_.permute(0,2,1).reshape(b,c,h,w)
 
         h_ = self.proj_out(h_)
 
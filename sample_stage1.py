@@ -5,13 +5,10 @@ os.environ['KMP_DUPLICATE_LIB_OK'] = 'TRUE'
 import cv2
 import json
 import torch
-import mcubes
-import trimesh
 import argparse
 import numpy as np
 import random
 import re
-from tqdm import tqdm
 import imageio.v2 as imageio
 import pytorch_lightning as pl
 from omegaconf import OmegaConf
@@ -19,14 +16,20 @@ from omegaconf import OmegaConf
 from ldm.models.diffusion.ddim import DDIMSampler
 from ldm.models.diffusion.plms import PLMSSampler
 from ldm.models.diffusion.dpm_solver import DPMSolverSampler
+from ldm.models.diffusion.uni_pc import UniPCSampler
 
 from utility.initialize import instantiate_from_config, get_obj_from_str
-from utility.triplane_renderer.eg3d_renderer import sample_from_planes, generate_planes
-from utility.triplane_renderer.renderer import get_rays, to8b
-from utility.device_utils import get_device, get_dtype, empty_cache, to_device
+from utility.triplane_renderer.renderer import to8b
+from utility.device_utils import get_device, get_dtype, empty_cache, to_device, PrecisionPolicy
 from utility.refinement import refine_mesh_automatic, refine_with_threefiner, check_threefiner_available, check_cuda_available, check_mps_available
 from utility.refinement_mps import refine_mesh_mps
-from safetensors.torch import load_file
+from utility.mesh_extractor import MeshExtractor
+from utility.camera_bank import get_view_rays, num_views, THUMBNAIL_VIEW
+from utility.model_loader import load_safetensors_model
+from utility.attention import BACKENDS, set_attention_backend
+from utility.compile import compile_model
+from utility.quantization import quantize_model_int8, compare_outputs, print_report
+from utility.latent_cache import LatentCache, make_cache_key, load_cache_entry, list_cache_entries
 from huggingface_hub import hf_hub_download
 
 import warnings
@@ -87,23 +90,547 @@ def add_text(rgb, caption):
         cv2.putText(rgb, bci, (gap, gap*(i+1)), font, fontScale, color, thickness, cv2.LINE_AA)
     return rgb
 
-def main():
+class DummySampler:
+    def __init__(self, model):
+        self.model = model
+
+    def sample(self, S, batch_size, shape, verbose, conditioning=None, *args, **kwargs):
+        return self.model.sample(
+            conditioning, batch_size, shape=[batch_size, ] + shape, *args, **kwargs
+        ), None
+
+
+# Few-step samplers: solver settings plus the step count used when --steps is not given
+SAMPLER_PRESETS = {
+    'dpm++2m': {'steps': 15, 'order': 2, 'skip_type': 'logSNR'},
+    'dpm++3m': {'steps': 10, 'order': 3, 'skip_type': 'logSNR'},
+    'unipc': {'steps': 10, 'order': 2, 'skip_type': 'logSNR', 'variant': 'bh2'},
+}
+SAMPLERS = ['ddpm', 'ddim', 'plms', 'dpm', 'dpm_solver'] + list(SAMPLER_PRESETS.keys())
+
+
+def resolve_steps(sampler, steps=None):
+    """
+    Sampling steps: the given value, else the preset's for few-step samplers, else 1000.
+    """
+    if steps is not None:
+        return steps
+    return SAMPLER_PRESETS.get(sampler, {}).get('steps', 1000)
+
+
+def get_sampler(model, name):
+    if name in SAMPLER_PRESETS:
+        solver_kwargs = {k: v for k, v in SAMPLER_PRESETS[name].items() if k != 'steps'}
+        if name == 'unipc':
+            return UniPCSampler(model, **solver_kwargs)
+        return DPMSolverSampler(model, **solver_kwargs)
+    elif name == 'dpm' or name == 'dpm_solver':
+        return DPMSolverSampler(model)
+    elif name == 'plms':
+        return PLMSSampler(model)
+    elif name == 'ddim':
+        return DDIMSampler(model)
+    elif name == 'ddpm':
+        return DummySampler(model)
+    else:
+        raise NotImplementedError(f"Unknown sampler: {name}")
+
+
+def load_model(config='configs/default.yaml', ckpt=None, cond_cache_dir=None):
+    """
+    Build the LatentDiffusion model, load its weights and move it to the best device.
+    Prompt conditionings are cached in memory, and in cond_cache_dir when given.
+
+    Returns:
+        (model, configs, device)
+    """
+    configs = OmegaConf.load(config)
+
+    if ckpt == None:
+        ckpt = hf_hub_download(repo_id="hongfz16/3DTopia", filename="model.safetensors")
+
+    if ckpt.endswith(".ckpt"):
+        model = get_obj_from_str(configs.model["target"]).load_from_checkpoint(ckpt, map_location='cpu', strict=False, **configs.model.params)
+    elif ckpt.endswith(".safetensors"):
+        model = load_safetensors_model(get_obj_from_str(configs.model["target"]), configs.model.params, ckpt)
+    else:
+        raise NotImplementedError
+
+    device = get_device(prefer_mps=True)
+    # Use float32 for MPS (MPS supports float32, and mixing float16/float32 causes errors)
+    dtype = torch.float32
+    print(f"Using device: {device}, dtype: {dtype}")
+
+    model = to_device(model, device, dtype)
+
+    # Update cond_stage_model device to match main model device
+    if hasattr(model, 'cond_stage_model') and model.cond_stage_model is not None:
+        if hasattr(model.cond_stage_model, 'device'):
+            # Update device attribute to torch.device object
+            model.cond_stage_model.device = device
+        # Ensure cond_stage_model is on the correct device
+        model.cond_stage_model = to_device(model.cond_stage_model, device)
+
+    # Keep model in float32 for MPS compatibility (avoids dtype mixing errors)
+    print("Model using float32 for MPS compatibility")
+
+    # CLIP conditioning is a single token, so cross-attention can be computed once per prompt
+    model.set_context_cache(True)
+    model.set_conditioning_cache(True, cache_dir=cond_cache_dir)
+
+    return model, configs, device
+
+
+def get_latent_shape(configs):
+    img_size = configs.model.params.unet_config.params.image_size
+    channels = configs.model.params.unet_config.params.in_channels
+    return [channels, img_size, img_size * 3]
+
+
+def build_rays(render_res, views=None):
+    """
+    Rays for the given views (all views by default) at render_res, from the camera bank.
+
+    Returns:
+        Tensor [V, 2, render_res**2, 3]
+    """
+    if views is None:
+        views = range(num_views())
+    return get_view_rays(views, render_res)
+
+
+# options of get_sampler_kwargs that a sampler would ignore
+UNSUPPORTED_SAMPLER_OPTIONS = {
+    'ddpm': ('feature_reuse', 'guidance_interval', 'guidance_reuse', 'early_stop_tol'),
+    'plms': ('early_stop_tol',),
+}
+
+
+def get_sampler_kwargs(args):
+    """
+    Optional sampler.sample() keyword arguments selected on the command line.
+    Options the selected sampler does not implement raise a ValueError, so they are never
+    ignored and never end up in a latent cache key.
+    """
+    kwargs = {}
+    if getattr(args, 'feature_reuse', 0) > 1:
+        kwargs['feature_reuse'] = args.feature_reuse
+        kwargs['feature_reuse_layer'] = args.feature_reuse_layer
+    if getattr(args, 'guidance_interval', None) is not None:
+        kwargs['guidance_interval'] = list(args.guidance_interval)
+    if getattr(args, 'guidance_reuse', 0) > 0:
+        kwargs['guidance_reuse'] = args.guidance_reuse
+    if getattr(args, 'early_stop_tol', 0) > 0:
+        kwargs['early_stop_tol'] = args.early_stop_tol
+    unsupported = [k for k in UNSUPPORTED_SAMPLER_OPTIONS.get(getattr(args, 'sampler', None), ()) if k in kwargs]
+    if unsupported:
+        raise ValueError(f"Not supported by the {args.sampler} sampler: {', '.join(unsupported)}")
+    return kwargs
+
+
+def sample_latents(model, sampler, prompt, steps, batch_size, shape, cfg_scale=1, x_T=None, progress=None, sampler_kwargs=None):
+    """
+    Run the diffusion sampler for one prompt and decode the result to triplanes.
+
+    Args:
+        progress: Optional callable progress(stage, **info) receiving per-step events
+        sampler_kwargs: Extra keyword arguments for sampler.sample (see get_sampler_kwargs)
+
+    Returns:
+        (sample, decode_res): latents [B, 8, 32, 96] and decoded triplanes
+    """
+    return sample_latents_rows(model, sampler, [prompt] * batch_size, steps, shape, cfg_scale, x_T, progress, sampler_kwargs)
+
+
+def sample_latents_rows(model, sampler, prompts, steps, shape, cfg_scale=1, x_T=None, progress=None, sampler_kwargs=None):
+    """
+    Run the diffusion sampler on one batch whose rows may use different prompts.
+    Each distinct prompt is encoded once; with CFG the unconditional and conditional rows of
+    all prompts go through the same apply_model call.
+
+    Args:
+        prompts: One prompt per batch row
+
+    Returns:
+        (sample, decode_res): latents [len(prompts), 8, 32, 96] and decoded triplanes
+    """
+    batch_size = len(prompts)
+    sampler_kwargs = sampler_kwargs or {}
+    callback = None
+    if progress is not None:
+        if isinstance(sampler, DummySampler):
+            # DDPM counts timesteps down from num_timesteps - 1
+            total = model.num_timesteps
+            callback = lambda i: progress('sampling', step=total - i, total=total)
+        else:
+            total = steps
+            callback = lambda i: progress('sampling', step=i + 1, total=total)
+        progress('sampling', step=0, total=total)
+
+    with torch.no_grad():
+        # with model.ema_scope():
+        unique_prompts = list(dict.fromkeys(prompts))
+        c = model.get_learned_conditioning(unique_prompts)
+        c = c[torch.tensor([unique_prompts.index(p) for p in prompts], device=c.device)]
+        unconditional_c = torch.zeros_like(c)
+        if cfg_scale != 1:
+            # All samplers support CFG scale
+            sample, _ = sampler.sample(
+                S=steps,
+                batch_size=batch_size,
+                shape=shape,
+                verbose=False,
+                x_T = x_T,
+                conditioning = c,
+                unconditional_guidance_scale=cfg_scale,
+                unconditional_conditioning=unconditional_c,
+                callback=callback,
+                **sampler_kwargs
+            )
+        else:
+            sample, _ = sampler.sample(
+                S=steps,
+                batch_size=batch_size,
+                shape=shape,
+                verbose=False,
+                x_T = x_T,
+                conditioning = c,
+                callback=callback,
+                **sampler_kwargs
+            )
+        if progress is not None:
+            progress('decoding')
+        decode_res = model.decode_first_stage(sample)
+    return sample, decode_res
+
+
+def sample_or_load(model, sampler, prompt, s, args, shape, device, latent_cache=None, progress=None):
+    """
+    Sample latents for one prompt, reusing a cached entry when the same settings were sampled before.
+
+    With a seed, each sample is seeded with seed + s whether or not a cache is used, so a cache
+    hit returns exactly what an uncached run samples, regardless of which other samples were
+    hits. Unseeded samples can never be hit again, so they are not cached.
+
+    Returns:
+        (sample, decode_res)
+    """
+    if args.seed is not None:
+        pl.seed_everything(args.seed + s)
+    if latent_cache is None or args.seed is None:
+        if latent_cache is not None and s == 0:
+            print("⚠ Warning: --cache_dir needs --seed, unseeded samples are not cached")
+        return sample_latents(model, sampler, prompt, args.steps, args.batch_size, shape, args.cfg_scale,
+                              progress=progress, sampler_kwargs=get_sampler_kwargs(args))
+
+    precision = getattr(args, 'precision', 'fp32')
+    key = make_cache_key(prompt, args.seed, args.sampler, args.steps, args.cfg_scale, args.ckpt, s, args.batch_size,
+                         get_sampler_kwargs(args), precision, args.config)
+    entry = latent_cache.load(key, device)
+    if entry is not None:
+        print(f"✓ Loaded cached latent: {latent_cache.path(key)}")
+        sample = entry['latent']
+        decode_res = entry['triplane']
+        if decode_res is None:
+            with torch.no_grad():
+                decode_res = model.decode_first_stage(sample)
+        return sample, decode_res
+
+    sample, decode_res = sample_latents(model, sampler, prompt, args.steps, args.batch_size, shape, args.cfg_scale,
+                                        progress=progress, sampler_kwargs=get_sampler_kwargs(args))
+    meta = {
+        'prompt': prompt, 'seed': args.seed, 'sampler': args.sampler, 'steps': args.steps,
+        'cfg_scale': args.cfg_scale, 'ckpt': args.ckpt, 'index': s, 'batch_size': args.batch_size,
+        'sampler_kwargs': get_sampler_kwargs(args), 'precision': precision, 'config': args.config,
+    }
+    path = latent_cache.save(key, sample, decode_res if args.cache_triplane else None, meta)
+    print(f"✓ Cached latent: {path}")
+    return sample, decode_res
+
+
+def sample_prompt_batches(model, sampler, text, args, shape, device):
+    """
+    Pack (prompt, sample, batch index) rows of all prompts into sampler batches of up to
+    args.prompt_batch rows, and fan each batch out to per-prompt output files.
+    """
+    file_basenames = [generate_short_filename(text_i) for text_i in text]
+    rows = [(t, s, b) for t in range(len(text)) for s in range(args.samples) for b in range(args.batch_size)]
+    log_dir = os.path.join('results', args.config.split('/')[-1].split('.')[0], args.test_folder)
+
+    for p in range(0, len(rows), args.prompt_batch):
+        group = rows[p:p+args.prompt_batch]
+        prompts = [text[t] for t, _, _ in group]
+        print(f"Sampling rows {p + 1}-{p + len(group)} of {len(rows)} ({len(set(prompts))} prompts)")
+        sample, decode_res = sample_latents_rows(model, sampler, prompts, args.steps, shape, args.cfg_scale,
+                                                 sampler_kwargs=get_sampler_kwargs(args))
+        frames = render_previews(model, decode_res, args, device)
+
+        for r, (t, s, b) in enumerate(group):
+            postprocess_sample(model, decode_res, r, log_dir, f"{file_basenames[t]}_{s}_{b}", args, device, text[t],
+                               frames=frames[r], latents=sample)
+        del decode_res
+        empty_cache(device)
+
+
+def preview_views(view_num, video=True):
+    """
+    View indices used for the preview video, or the single thumbnail view.
+    """
+    if video:
+        return list(range(view_num//4, view_num//4 * 3, 2))
+    return [THUMBNAIL_VIEW]
+
+
+def render_views(model, triplanes, batch_rays, ray_budget=2**15, occupancy=False, termination_eps=0.):
+    """
+    Render [V, 2, H*W, 3] camera rays for a batch of triplanes in packed renderer calls.
+
+    Returns:
+        uint8 numpy array [B, V, H, W, 3] (channel order matches the exported videos)
+    """
+    with torch.no_grad():
+        rgb_sample = model.first_stage_model.render_triplane_eg3d_decoder_views(triplanes, batch_rays, ray_budget, occupancy, termination_eps)
+    rgb_sample = to8b(rgb_sample.detach().cpu().numpy())
+    # rgb_sample = add_text(rgb_sample, text_i)
+    return np.ascontiguousarray(rgb_sample[..., ::-1])
+
+
+def render_img(model, triplane, render_res, v, device):
+    return render_views(model, triplane, get_view_rays([v], render_res).to(device))[0, 0]
+
+
+def render_previews(model, decode_res, args, device):
+    """
+    Render the preview video frames (or thumbnail) for every sample of a batch at once.
+
+    Returns:
+        uint8 numpy array [B, V, H, W, 3]
+    """
+    views = preview_views(num_views(), not args.no_video)
+    return render_views(model, decode_res, get_view_rays(views, args.render_res).to(device), args.render_ray_budget,
+                        args.occupancy, args.termination_eps)
+
+
+def extract_colored_mesh(model, triplane, ply_path, mcubes_res, device, memory_budget_mb=2048, sparse=False, color_mode='render', occupancy=False, termination_eps=0.):
+    """
+    Run marching cubes on the density of one triplane, color the vertices from six views and export a PLY.
+    """
+    extractor = MeshExtractor(
+        model.first_stage_model.triplane_decoder, res=mcubes_res, iso=10,
+        memory_budget_mb=memory_budget_mb, device=device, sparse=sparse,
+        color_mode=color_mode, occupancy=occupancy, termination_eps=termination_eps
+    )
+    return extractor.export(triplane, ply_path)
+
+
+def refine_mesh(model, ply_path, prompt, log_dir, save_name, args, latent=None):
+    """
+    Run the stage 2 refinement on an exported mesh. Returns the refined path or None.
+    With the mesh's stage-1 latent, the MPS refinement warm-starts from it (see --refine_strength).
+    """
+    print(f"\n{'='*60}")
+    print(f"🔨 Starting automatic refinement...")
+    print(f"{'='*60}")
+
+    refined_path = None
+
+    # Try threefiner first (CUDA only)
+    if check_threefiner_available() and check_cuda_available():
+        print("Using threefiner for refinement (CUDA)...")
+        stage2_dir = os.path.join(os.path.dirname(log_dir), 'stage2')
+        os.makedirs(stage2_dir, exist_ok=True)
+
+        refined_path = refine_with_threefiner(
+            mesh_path=ply_path,
+            prompt=prompt,
+            refinement_mode=args.refine_mode,
+            outdir=stage2_dir,
+            save_name=save_name,
+            iters=args.refine_iters,
+            front_dir='-y',
+            text_dir=True,
+            verbose=True
+        )
+
+    # Fallback to MPS-compatible refinement (Mac)
+    elif check_mps_available() or get_device(prefer_mps=True).type == 'mps':
+        print("Using MPS-compatible refinement (Mac)...")
+        stage2_dir = os.path.join(os.path.dirname(log_dir), 'stage2')
+        os.makedirs(stage2_dir, exist_ok=True)
+
+        if latent is not None:
+            refinement_steps = args.refine_steps
+        else:
+            # Use refinement steps as iterations equivalent
+            refinement_steps = max(200, args.refine_iters // 5)  # Convert iters to steps
+        mcubes_res = 256 if args.refine_iters >= 1000 else 128
+
+        refined_path = refine_mesh_mps(
+            model=model,
+            mesh_path=ply_path,
+            prompt=prompt,
+            refinement_steps=refinement_steps,
+            mcubes_res=mcubes_res,
+            cfg_scale=args.cfg_scale,
+            sampler=args.sampler,
+            outdir=stage2_dir,
+            save_name=save_name,
+            verbose=True,
+            latent=latent,
+            strength=args.refine_strength,
+            occupancy=args.occupancy,
+            termination_eps=args.termination_eps
+        )
+
+    if refined_path:
+        print(f"\n{'='*60}")
+        print(f"✓ Flawless refinement complete!")
+        print(f"  Original: {ply_path}")
+        print(f"  Refined:  {refined_path}")
+        print(f"{'='*60}\n")
+    else:
+        print(f"⚠ Refinement not available or failed.")
+        print(f"  Original mesh saved: {ply_path}")
+        if not check_threefiner_available() and not check_mps_available():
+            print("  - Neither threefiner (CUDA) nor MPS refinement available")
+        elif check_mps_available():
+            print("  - MPS refinement attempted but failed")
+    return refined_path
+
+
+@torch.no_grad()
+def postprocess_sample(model, decode_res, b, log_dir, name, args, device, prompt, progress=None, frames=None, latents=None):
+    """
+    Export the mesh, optional refinement and the preview video/thumbnail for one decoded sample.
+    frames can hold this sample's preview frames if they were already rendered with render_previews;
+    latents are the sampled latents of decode_res, used to warm-start the refinement.
+
+    Returns:
+        List of written output paths
+    """
+    outputs = []
+    triplane = decode_res[b:b+1]
+
+    if not args.no_mcubes:
+        if progress is not None:
+            progress('mesh', sample=b)
+        ply_path = extract_colored_mesh(model, triplane, os.path.join(log_dir, f"{name}.ply"), args.mcubes_res, device, args.mcubes_budget_mb, args.mcubes_sparse, args.color_mode, args.occupancy, args.termination_eps)
+        print(f"✓ Generated mesh: {ply_path}")
+        outputs.append(ply_path)
+
+        # Automatic refinement if requested
+        if args.refine and not args.no_refine:
+            if progress is not None:
+                progress('refine', sample=b)
+            latent = latents[b:b+1] if latents is not None else None
+            refined_path = refine_mesh(model, ply_path, prompt, log_dir, f"{name}_refined", args, latent)
+            if refined_path:
+                outputs.append(refined_path)
+
+    if frames is None:
+        if progress is not None:
+            progress('video', sample=b)
+        frames = render_previews(model, triplane, args, device)[0]
+
+    if not args.no_video:
+        video_path = os.path.join(log_dir, "{}.mp4".format(name))
+        imageio.mimwrite(video_path, frames)
+        outputs.append(video_path)
+    else:
+        img_path = os.path.join(log_dir, "{}.jpg".format(name))
+        imageio.imwrite(img_path, frames[0])
+        outputs.append(img_path)
+    return outputs
+
+
+def int8_report_outputs(model, sampler, prompt, args, shape, device, latent=None):
+    """
+    Density grid and thumbnail of one seeded sample of prompt (or of the given latent) for the int8 report.
+
+    Returns:
+        (latent, {'density': float32 array [64, 64, 64], 'render': uint8 image})
+    """
+    if latent is None:
+        generator = torch.Generator().manual_seed(args.seed if args.seed is not None else 0)
+        x_T = torch.randn([1] + shape, generator=generator).to(device)
+        latent, triplane = sample_latents(model, sampler, prompt, args.steps, 1, shape, args.cfg_scale, x_T=x_T,
+                                          sampler_kwargs=get_sampler_kwargs(args))
+    else:
+        with torch.no_grad():
+            triplane = model.decode_first_stage(latent)
+    extractor = MeshExtractor(model.first_stage_model.triplane_decoder, res=64, device=device, verbose=False)
+    outputs = {
+        'density': extractor.density_grid(triplane[:1]),
+        'render': render_img(model, triplane[:1], args.render_res, THUMBNAIL_VIEW, device),
+    }
+    return latent, outputs
+
+
+def quantize_int8(model, text, args, shape, device, log_dir):
+    """
+    --precision int8, with the optional --int8_report. The report runs the first three prompts in
+    fp32 and int8 twice: end to end, and decoding the fp32 latent with the int8 triplane MLP.
+    """
+    references = []
+    if args.int8_report:
+        sampler = get_sampler(model, args.sampler)
+        print("Rendering fp32 references for the int8 report...")
+        for prompt in text[:3]:
+            references.append((prompt,) + int8_report_outputs(model, sampler, prompt, args, shape, device))
+
+    quantize_model_int8(model, shape=shape)
+
+    if references:
+        rows = []
+        for prompt, latent, reference in references:
+            for case, case_latent in (('end_to_end', None), ('fixed_latent', latent)):
+                _, outputs = int8_report_outputs(model, sampler, prompt, args, shape, device, case_latent)
+                rows.append(dict(prompt=prompt, case=case, **compare_outputs(reference, outputs)))
+        print_report(rows, os.path.join(log_dir, 'int8_report.json'))
+
+
+def get_parser():
     parser = argparse.ArgumentParser()
     parser.add_argument("--config", type=str, default='configs/default.yaml')
     parser.add_argument("--ckpt", type=str, default=None)
     parser.add_argument("--test_folder", type=str, default="stage1")
     parser.add_argument("--seed", type=int, default=None)
-    parser.add_argument("--sampler", type=str, default="ddpm")
+    parser.add_argument("--sampler", type=str, default="ddpm", choices=SAMPLERS,
+                        help="dpm++2m, dpm++3m and unipc are few-step presets (10-15 steps unless --steps is given)")
     parser.add_argument("--samples", type=int, default=1)
     parser.add_argument("--batch_size", type=int, default=1)
-    parser.add_argument("--steps", type=int, default=1000)
-    parser.add_argument("--text", nargs='+', default='a robot')
+    parser.add_argument("--steps", type=int, default=None, help="Sampling steps (default: the sampler preset's, else 1000)")
+    parser.add_argument("--text", nargs='+', default=None, help="Prompt (default: 'a robot')")
     parser.add_argument("--text_file", type=str, default=None)
+    parser.add_argument("--prompt_batch", type=int, default=0,
+                        help="Pack rows of different prompts into sampler batches of up to this size (0: one prompt at a time)")
     parser.add_argument("--no_video", action='store_true', default=False)
     parser.add_argument("--render_res", type=int, default=128)
+    parser.add_argument("--render_ray_budget", type=int, default=2**15,
+                        help="Rays per renderer call when rendering preview frames; views and samples are packed up to this budget")
+    parser.add_argument("--occupancy", action='store_true', default=False,
+                        help="Skip empty space with an occupancy grid when rendering previews and vertex colors (approximate)")
+    parser.add_argument("--termination_eps", type=float, default=0.,
+                        help="Stop evaluating a ray once its transmittance drops below this when rendering previews and vertex colors (0 disables)")
     parser.add_argument("--no_mcubes", action='store_true', default=False)
     parser.add_argument("--mcubes_res", type=int, default=128)
+    parser.add_argument("--mcubes_budget_mb", type=int, default=2048,
+                        help="Approximate working memory for mesh extraction; lower it for 256/512 grids on small machines")
+    parser.add_argument("--mcubes_sparse", action='store_true', default=False,
+                        help="Coarse-to-fine mesh extraction: only evaluate the full-resolution grid near the surface")
+    parser.add_argument("--color_mode", type=str, default='render', choices=['render', 'point'],
+                        help="Vertex coloring: 'render' (six-view volume rendering, best quality) or 'point' (direct triplane query, much faster)")
     parser.add_argument("--cfg_scale", type=float, default=1)
+    parser.add_argument("--guidance_interval", type=float, nargs=2, default=None, metavar=('LO', 'HI'),
+                        help="Only apply CFG while the normalized timestep (1 = pure noise) is in [LO, HI]; conditional-only outside")
+    parser.add_argument("--guidance_reuse", type=int, default=0,
+                        help="Reuse the (cond - uncond) guidance delta for this many model calls after each guided call")
+    parser.add_argument("--early_stop_tol", type=float, default=0.,
+                        help="ddim/dpm: stop once pred_x0 changes by less than this (relative) between steps, e.g. 0.01 (0 disables)")
+    parser.add_argument("--feature_reuse", type=int, default=0,
+                        help="Reuse deep UNet features between full evaluations every N model calls (approximate, faster; 0 disables)")
+    parser.add_argument("--feature_reuse_layer", type=int, default=0,
+                        help="Number of shallow input blocks (minus one) recomputed on reuse steps; higher is slower but closer to exact")
     parser.add_argument("--refine", action='store_true', default=False, 
                         help="Automatically refine mesh after generation (uses threefiner on CUDA, native MPS refinement on Mac)")
     parser.add_argument("--refine_mode", type=str, default='if2', 
@@ -111,9 +638,61 @@ def main():
                         help="Threefiner refinement mode (default: if2 for best quality)")
     parser.add_argument("--refine_iters", type=int, default=1000,
                         help="Number of refinement iterations (default: 1000 for high quality)")
+    parser.add_argument("--refine_strength", type=float, default=0.5,
+                        help="MPS refinement: fraction of the DDIM schedule re-run from the noised stage-1 latent (1 = full re-generation)")
+    parser.add_argument("--refine_steps", type=int, default=50,
+                        help="MPS refinement: DDIM schedule length for the warm start (strength * steps are run)")
     parser.add_argument("--no_refine", action='store_true', default=False,
                         help="Explicitly disable refinement (overrides --refine)")
+    parser.add_argument("--cache_dir", type=str, default=None,
+                        help="Store sampled latents here and reuse them for identical prompt/seed/sampler settings")
+    parser.add_argument("--cache_triplane", action='store_true', default=False,
+                        help="Also store the decoded triplane (float16) so cached runs skip the VAE decoder")
+    parser.add_argument("--cond_cache_dir", type=str, default=None,
+                        help="Also store encoded prompt conditionings here and reuse them across runs")
+    parser.add_argument("--from_cache", type=str, default=None,
+                        help="Skip sampling and post-process a cached .npz/.npy entry or a directory of entries")
+    parser.add_argument("--attention", type=str, default=None, choices=BACKENDS,
+                        help="Attention backend for the UNet and VAE (default: $HEPHAESTUS_ATTENTION, else auto)")
+    parser.add_argument("--compile", type=str, default=None, choices=['compile', 'trace'],
+                        help="Run the UNet, VAE decoder and triplane MLP as compiled graphs (torch.compile or torch.jit.trace)")
+    parser.add_argument("--precision", type=str, default='fp32', choices=['fp32', 'bf16', 'int8'],
+                        help="bf16: bfloat16 autocast for the UNet and VAE decoder (schedules, renderer and density stay fp32); "
+                             "int8: dynamic int8 quantization of the UNet, CLIP and triplane MLP Linear layers (CPU only)")
+    parser.add_argument("--int8_report", action='store_true', default=False,
+                        help="With --precision int8, compare density grids and renders of the first prompts against fp32")
+    return parser
+
+
+def process_cache_entries(model, path, log_dir, args, device):
+    """
+    Run mesh extraction, refinement and video straight from cached latents.
+    """
+    for entry_path in list_cache_entries(path):
+        entry = load_cache_entry(entry_path, device)
+        decode_res = entry['triplane']
+        if decode_res is None:
+            with torch.no_grad():
+                decode_res = model.decode_first_stage(entry['latent'])
+        prompt = entry['meta'].get('prompt', '')
+        name = os.path.splitext(os.path.basename(entry_path))[0]
+        if prompt:
+            name = generate_short_filename(prompt)
+        print(f"Processing cached latent: {entry_path} ({prompt})")
+        for b in range(decode_res.shape[0]):
+            postprocess_sample(model, decode_res, b, log_dir, f"{name}_{b}", args, device, prompt, latents=entry['latent'])
+
+
+def main():
+    parser = get_parser()
     args = parser.parse_args()
+    args.steps = resolve_steps(args.sampler, args.steps)
+    try:
+        get_sampler_kwargs(args)
+    except ValueError as e:
+        parser.error(str(e))
+    if args.attention is not None:
+        set_attention_backend(args.attention)
 
     if args.text is not None:
         text = [' '.join(args.text),]
@@ -126,13 +705,13 @@ def main():
         else:
             with open(args.text_file, 'r') as f:
                 text = f.readlines()
-                text = [l.strip() for l in text]
+                text = [l.strip() for l in text if l.strip()]
     else:
-        raise NotImplementedError
+        text = ['a robot']
 
-    print(text)
+    if args.from_cache is None:
+        print(text)
 
-    configs = OmegaConf.load(args.config)
     if args.seed is not None:
         pl.seed_everything(args.seed)
 
@@ -144,295 +723,45 @@ def main():
         stage2_dir = os.path.join(os.path.dirname(log_dir), 'stage2')
         os.makedirs(stage2_dir, exist_ok=True)
 
-    if args.ckpt == None:
-        ckpt = hf_hub_download(repo_id="hongfz16/3DTopia", filename="model.safetensors")
-    else:
-        ckpt = args.ckpt
-
-    if ckpt.endswith(".ckpt"):
-        model = get_obj_from_str(configs.model["target"]).load_from_checkpoint(ckpt, map_location='cpu', strict=False, **configs.model.params)
-    elif ckpt.endswith(".safetensors"):
-        model = get_obj_from_str(configs.model["target"])(**configs.model.params)
-        model_ckpt = load_file(ckpt)
-        model.load_state_dict(model_ckpt)
-    else:
-        raise NotImplementedError
-    
-    device = get_device(prefer_mps=True)
-    # Use float32 for MPS (MPS supports float32, and mixing float16/float32 causes errors)
-    dtype = torch.float32
-    print(f"Using device: {device}, dtype: {dtype}")
-    
-    model = to_device(model, device, dtype)
-    
-    # Update cond_stage_model device to match main model device
-    if hasattr(model, 'cond_stage_model') and model.cond_stage_model is not None:
-        if hasattr(model.cond_stage_model, 'device'):
-            # Update device attribute to torch.device object
-            model.cond_stage_model.device = device
-        # Ensure cond_stage_model is on the correct device
-        model.cond_stage_model = to_device(model.cond_stage_model, device)
-    
-    # Keep model in float32 for MPS compatibility (avoids dtype mixing errors)
-    print("Model using float32 for MPS compatibility")
-
-    class DummySampler:
-        def __init__(self, model):
-            self.model = model
-
-        def sample(self, S, batch_size, shape, verbose, conditioning=None, *args, **kwargs):
-            return self.model.sample(
-                conditioning, batch_size, shape=[batch_size, ] + shape, *args, **kwargs
-            ), None
-
-    if args.sampler == 'dpm' or args.sampler == 'dpm_solver':
-        sampler = DPMSolverSampler(model)
-    elif args.sampler == 'plms':
-        sampler = PLMSSampler(model)
-    elif args.sampler == 'ddim':
-        sampler = DDIMSampler(model)
-    elif args.sampler == 'ddpm':
-        sampler = DummySampler(model)
-    else:
-        raise NotImplementedError(f"Unknown sampler: {args.sampler}")
-
-    img_size = configs.model.params.unet_config.params.image_size
-    channels = configs.model.params.unet_config.params.in_channels
-    shape = [channels, img_size, img_size * 3]
-    plane_axes = generate_planes()
-
-    pose_folder = 'assets/sample_data/pose'
-    poses_fname = sorted([os.path.join(pose_folder, f) for f in os.listdir(pose_folder)])
-    batch_rays_list = []
-    H = args.render_res
-    ratio = 512 // H
-    for p in poses_fname:
-        c2w = np.loadtxt(p).reshape(4, 4)
-        c2w[:3, 3] *= 2.2
-        c2w = np.array([
-            [1, 0, 0, 0],
-            [0, 0, -1, 0],
-            [0, 1, 0, 0],
-            [0, 0, 0, 1]
-        ]) @ c2w
-
-        k = np.array([
-            [560 / ratio, 0, H * 0.5],
-            [0, 560 / ratio, H * 0.5],
-            [0, 0, 1]
-        ])
-
-        rays_o, rays_d = get_rays(H, H, torch.Tensor(k), torch.Tensor(c2w[:3, :4]))
-        coords = torch.stack(torch.meshgrid(torch.linspace(0, H-1, H), torch.linspace(0, H-1, H), indexing='ij'), -1)
-        coords = torch.reshape(coords, [-1,2]).long()
-        rays_o = rays_o[coords[:, 0], coords[:, 1]]
-        rays_d = rays_d[coords[:, 0], coords[:, 1]]
-        batch_rays = torch.stack([rays_o, rays_d], 0)
-        batch_rays_list.append(batch_rays)
-    batch_rays_list = torch.stack(batch_rays_list, 0)
+    model, configs, device = load_model(args.config, args.ckpt, args.cond_cache_dir)
+    if args.precision == 'int8':
+        quantize_int8(model, text, args, get_latent_shape(configs), device, log_dir)
+    elif args.precision == 'bf16':
+        policy = PrecisionPolicy(args.precision, device)
+        model.set_precision(policy)
+        # cache entries record the precision that actually ran
+        args.precision = policy.precision
+    if args.compile is not None:
+        compile_model(model, args.compile)
+
+    if args.from_cache is not None:
+        process_cache_entries(model, args.from_cache, log_dir, args, device)
+        return
+
+    sampler = get_sampler(model, args.sampler)
+    shape = get_latent_shape(configs)
+    if len(text) > 1:
+        # encode every prompt of a prompt file up front, in batched encoder calls
+        with torch.no_grad():
+            model.get_learned_conditioning(text)
+    if args.prompt_batch > 0:
+        if args.cache_dir is not None:
+            print("⚠ Warning: --cache_dir is not used with --prompt_batch")
+        sample_prompt_batches(model, sampler, text, args, shape, device)
+        return
+
+    latent_cache = LatentCache(args.cache_dir) if args.cache_dir is not None else None
 
     for text_idx, text_i in enumerate(text):
-        text_connect = '_'.join(text_i.split(' '))
         # Generate short filename for file paths (first 3 words + random number)
         file_basename = generate_short_filename(text_i)
         for s in range(args.samples):
-            batch_size = args.batch_size
-            with torch.no_grad():
-                # with model.ema_scope():
-                noise = None
-                c = model.get_learned_conditioning([text_i])
-                unconditional_c = torch.zeros_like(c)
-                if args.cfg_scale != 1:
-                    # All samplers support CFG scale
-                    sample, _ = sampler.sample(
-                        S=args.steps,
-                        batch_size=batch_size,
-                        shape=shape,
-                        verbose=False,
-                        x_T = noise,
-                        conditioning = c.repeat(batch_size, 1, 1),
-                        unconditional_guidance_scale=args.cfg_scale,
-                        unconditional_conditioning=unconditional_c.repeat(batch_size, 1, 1)
-                    )
-                else:
-                    sample, _ = sampler.sample(
-                        S=args.steps,
-                        batch_size=batch_size,
-                        shape=shape,
-                        verbose=False,
-                        x_T = noise,
-                        conditioning = c.repeat(batch_size, 1, 1),
-                    )
-                decode_res = model.decode_first_stage(sample)
+            sample, decode_res = sample_or_load(model, sampler, text_i, s, args, shape, device, latent_cache)
+            frames = render_previews(model, decode_res, args, device)
 
-                for b in range(batch_size):
-                    def render_img(v):
-                        rgb_sample, _ = model.first_stage_model.render_triplane_eg3d_decoder(
-                            decode_res[b:b+1], batch_rays_list[v:v+1].to(device), torch.zeros(1, H, H, 3).to(device),
-                        )
-                        rgb_sample = to8b(rgb_sample.detach().cpu().numpy())[0]
-                        rgb_sample = np.stack(
-                            [rgb_sample[..., 2], rgb_sample[..., 1], rgb_sample[..., 0]], -1
-                        )
-                        # rgb_sample = add_text(rgb_sample, text_i)
-                        return rgb_sample
-
-                    if not args.no_mcubes:
-                        # prepare volumn for marching cube
-                        res = args.mcubes_res
-                        c_list = torch.linspace(-1.2, 1.2, steps=res)
-                        grid_x, grid_y, grid_z = torch.meshgrid(
-                            c_list, c_list, c_list, indexing='ij'
-                        )
-                        coords = torch.stack([grid_x, grid_y, grid_z], -1).to(device)
-                        plane_axes = generate_planes()
-                        feats = sample_from_planes(
-                            plane_axes, decode_res[b:b+1].reshape(1, 3, -1, 256, 256), coords.reshape(1, -1, 3), padding_mode='zeros', box_warp=2.4
-                        )
-                        fake_dirs = torch.zeros_like(coords)
-                        fake_dirs[..., 0] = 1
-                        out = model.first_stage_model.triplane_decoder.decoder(feats, fake_dirs)
-                        u = out['sigma'].reshape(res, res, res).detach().cpu().numpy()
-                        del out
-
-                        # marching cube
-                        vertices, triangles = mcubes.marching_cubes(u, 10)
-                        min_bound = np.array([-1.2, -1.2, -1.2])
-                        max_bound = np.array([1.2, 1.2, 1.2])
-                        vertices = vertices / (res - 1) * (max_bound - min_bound)[None, :] + min_bound[None, :]
-                        # Convert to float32 before moving to MPS (MPS doesn't support float64)
-                        pt_vertices = torch.from_numpy(vertices.astype(np.float32)).to(device)
-
-                        # extract vertices color
-                        res_triplane = 256
-                        render_kwargs = {
-                            'depth_resolution': 128,
-                            'disparity_space_sampling': False,
-                            'box_warp': 2.4,
-                            'depth_resolution_importance': 128,
-                            'clamp_mode': 'softplus',
-                            'white_back': True,
-                            'det': True
-                        }
-                        rays_o_list = [
-                            np.array([0, 0, 2]),
-                            np.array([0, 0, -2]),
-                            np.array([0, 2, 0]),
-                            np.array([0, -2, 0]),
-                            np.array([2, 0, 0]),
-                            np.array([-2, 0, 0]),
-                        ]
-                        rgb_final = None
-                        diff_final = None
-                        for rays_o in tqdm(rays_o_list):
-                            rays_o = torch.from_numpy(rays_o.reshape(1, 3)).repeat(vertices.shape[0], 1).float().to(device)
-                            rays_d = pt_vertices.reshape(-1, 3) - rays_o
-                            rays_d = rays_d / torch.norm(rays_d, dim=-1).reshape(-1, 1)
-                            dist = torch.norm(pt_vertices.reshape(-1, 3) - rays_o, dim=-1).cpu().numpy().reshape(-1)
-
-                            render_out = model.first_stage_model.triplane_decoder(
-                                decode_res[b:b+1].reshape(1, 3, -1, res_triplane, res_triplane),
-                                rays_o.unsqueeze(0), rays_d.unsqueeze(0), render_kwargs,
-                                whole_img=False, tvloss=False
-                            )
-                            rgb = render_out['rgb_marched'].reshape(-1, 3).detach().cpu().numpy()
-                            depth = render_out['depth_final'].reshape(-1).detach().cpu().numpy()
-                            depth_diff = np.abs(dist - depth)
-
-                            if rgb_final is None:
-                                rgb_final = rgb.copy()
-                                diff_final = depth_diff.copy()
-
-                            else:
-                                ind = diff_final > depth_diff
-                                rgb_final[ind] = rgb[ind]
-                                diff_final[ind] = depth_diff[ind]
-
-
-                        # bgr to rgb
-                        rgb_final = np.stack([
-                            rgb_final[:, 2], rgb_final[:, 1], rgb_final[:, 0]
-                        ], -1)
-
-                        # export to ply
-                        mesh = trimesh.Trimesh(vertices, triangles, vertex_colors=(rgb_final * 255).astype(np.uint8))
-                        ply_path = os.path.join(log_dir, f"{file_basename}_{s}_{b}.ply")
-                        trimesh.exchange.export.export_mesh(mesh, ply_path, file_type='ply')
-                        print(f"✓ Generated mesh: {ply_path}")
-                        
-                        # Automatic refinement if requested
-                        if args.refine and not args.no_refine:
-                            print(f"\n{'='*60}")
-                            print(f"🔨 Starting automatic refinement...")
-                            print(f"{'='*60}")
-                            
-                            refined_path = None
-                            
-                            # Try threefiner first (CUDA only)
-                            if check_threefiner_available() and check_cuda_available():
-                                print("Using threefiner for refinement (CUDA)...")
-                                stage2_dir = os.path.join(os.path.dirname(log_dir), 'stage2')
-                                os.makedirs(stage2_dir, exist_ok=True)
-                                
-                                refined_path = refine_with_threefiner(
-                                    mesh_path=ply_path,
-                                    prompt=text_i,
-                                    refinement_mode=args.refine_mode,
-                                    outdir=stage2_dir,
-                                    save_name=f"{file_basename}_{s}_{b}_refined",
-                                    iters=args.refine_iters,
-                                    front_dir='-y',
-                                    text_dir=True,
-                                    verbose=True
-                                )
-                            
-                            # Fallback to MPS-compatible refinement (Mac)
-                            elif check_mps_available() or get_device(prefer_mps=True).type == 'mps':
-                                print("Using MPS-compatible refinement (Mac)...")
-                                stage2_dir = os.path.join(os.path.dirname(log_dir), 'stage2')
-                                os.makedirs(stage2_dir, exist_ok=True)
-                                
-                                # Use refinement steps as iterations equivalent
-                                refinement_steps = max(200, args.refine_iters // 5)  # Convert iters to steps
-                                mcubes_res = 256 if args.refine_iters >= 1000 else 128
-                                
-                                refined_path = refine_mesh_mps(
-                                    model=model,
-                                    mesh_path=ply_path,
-                                    prompt=text_i,
-                                    refinement_steps=refinement_steps,
-                                    mcubes_res=mcubes_res,
-                                    cfg_scale=args.cfg_scale,
-                                    sampler=args.sampler,
-                                    outdir=stage2_dir,
-                                    save_name=f"{file_basename}_{s}_{b}_refined",
-                                    verbose=True
-                                )
-                            
-                            if refined_path:
-                                print(f"\n{'='*60}")
-                                print(f"✓ Flawless refinement complete!")
-                                print(f"  Original: {ply_path}")
-                                print(f"  Refined:  {refined_path}")
-                                print(f"{'='*60}\n")
-                            else:
-                                print(f"⚠ Refinement not available or failed.")
-                                print(f"  Original mesh saved: {ply_path}")
-                                if not check_threefiner_available() and not check_mps_available():
-                                    print("  - Neither threefiner (CUDA) nor MPS refinement available")
-                                elif check_mps_available():
-                                    print("  - MPS refinement attempted but failed")
-
-                    if not args.no_video:
-                        view_num = len(batch_rays_list)
-                        video_list = []
-                        for v in tqdm(range(view_num//4, view_num//4 * 3, 2)):
-                            rgb_sample = render_img(v)
-                            video_list.append(rgb_sample)
-                        imageio.mimwrite(os.path.join(log_dir, "{}_{}_{}.mp4".format(file_basename, s, b)), np.stack(video_list, 0))
-                    else:
-                        rgb_sample = render_img(104)
-                        imageio.imwrite(os.path.join(log_dir, "{}_{}_{}.jpg".format(file_basename, s, b)), rgb_sample)
+            for b in range(args.batch_size):
+                postprocess_sample(model, decode_res, b, log_dir, f"{file_basename}_{s}_{b}", args, device, text_i,
+                                   frames=frames[b], latents=sample)
 
 if __name__ == '__main__':
-    main()
+    main()
\ No newline at end of file
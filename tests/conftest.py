@@ -0,0 +1,121 @@
+"""Shared fixtures: a tiny stand-in for LatentDiffusion that the samplers can drive on CPU."""
+import os
+import sys
+import time
+import threading
+from contextlib import contextmanager
+
+import pytest
+import torch
+import torch.nn as nn
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from ldm.modules.diffusionmodules.util import make_beta_schedule
+from utility.triplane_renderer.eg3d_renderer import Renderer_TriPlane
+
+
+class ToyDiffusion(nn.Module):
+    """
+    The parts of LatentDiffusion the samplers use, with a cheap row-wise eps model: each output
+    row only depends on its own latent, timestep and conditioning, so batching rows of different
+    requests together does not change them. Counts concurrent apply_model calls in `overlaps`.
+    """
+    def __init__(self, timesteps=1000, delay=0.):
+        super().__init__()
+        betas = make_beta_schedule('linear', timesteps, linear_start=0.00085, linear_end=0.012)
+        alphas_cumprod = torch.cumprod(1. - betas, dim=0)
+        self.register_buffer('betas', betas)
+        self.register_buffer('alphas_cumprod', alphas_cumprod)
+        self.register_buffer('alphas_cumprod_prev', torch.cat([torch.ones(1), alphas_cumprod[:-1]]))
+        self.register_buffer('sqrt_one_minus_alphas_cumprod', (1. - alphas_cumprod).sqrt())
+        self.weight = nn.Parameter(torch.ones(1))
+        self.num_timesteps = timesteps
+        self.parameterization = 'eps'
+        self.delay = delay
+        self.calls = 0
+        self.active = 0
+        self.overlaps = 0
+        self.counter_lock = threading.Lock()
+
+    def apply_model(self, x, t, c):
+        with self.counter_lock:
+            self.active += 1
+            self.calls += 1
+            if self.active > 1:
+                self.overlaps += 1
+        try:
+            if self.delay:
+                time.sleep(self.delay)
+            t = t.float().reshape(-1, 1, 1, 1) / self.num_timesteps
+            c = c.float().mean(dim=tuple(range(1, c.dim()))).reshape(-1, 1, 1, 1)
+            return self.weight * (0.2 * x * (1. - t) + 0.1 * c + 0.05 * t)
+        finally:
+            with self.counter_lock:
+                self.active -= 1
+
+    @contextmanager
+    def inference_mode(self):
+        yield self
+
+    @contextmanager
+    def feature_reuse(self, interval=3, layer=0):
+        yield
+
+
+@pytest.fixture
+def toy_model():
+    return ToyDiffusion()
+
+
+@pytest.fixture
+def slow_toy_model():
+    # long enough apply_model calls that unsynchronized threads would overlap
+    return ToyDiffusion(delay=0.002)
+
+
+class SphereDecoder(nn.Module):
+    """
+    Analytic stand-in for the triplane MLP. The first channel of each plane holds u² + v², so
+    the three sampled values sum to 2r² and the density describes a sphere (density `iso` at
+    radius 0.5 in normalized coordinates, growing inwards); the second channel holds (u + 1) / 2
+    and sets the color. Counts the points it is evaluated on in `points`.
+    """
+    def __init__(self, iso=10.):
+        super().__init__()
+        self.iso = iso
+        self.points = 0
+
+    def query_sigma(self, feats):
+        self.points += feats.shape[0] * feats.shape[2]
+        r2 = feats[..., 0].sum(1) / 2
+        return (self.iso + 40. * (0.25 - r2)).unsqueeze(-1)
+
+    def query_rgb(self, feats):
+        c = feats[..., 1].mean(1)
+        return torch.stack([c, 1. - c, torch.full_like(c, 0.5)], -1)
+
+    def forward(self, feats, viewdir):
+        rgb = self.query_rgb(feats)
+        return {'rgb': rgb, 'sigma': self.query_sigma(feats)}
+
+
+def make_sphere_triplane(size=64):
+    """Triplane [1, 3 * 2, size, size] for SphereDecoder."""
+    u = (torch.arange(size, dtype=torch.float32) + 0.5) / size * 2 - 1
+    radius = u.reshape(1, -1) ** 2 + u.reshape(-1, 1) ** 2
+    color = ((u.reshape(1, -1) + 1) / 2).expand(size, size)
+    plane = torch.stack([radius, color], 0)
+    return plane.unsqueeze(0).expand(3, -1, -1, -1).reshape(1, 6, size, size).clone()
+
+
+@pytest.fixture
+def sphere_triplane():
+    return make_sphere_triplane()
+
+
+@pytest.fixture
+def sphere_renderer():
+    renderer = Renderer_TriPlane(rgbnet_width=8)
+    renderer.decoder = SphereDecoder()
+    return renderer
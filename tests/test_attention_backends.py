@@ -0,0 +1,68 @@
+import pytest
+import torch
+
+from utility import attention as attention_backends
+from utility.attention import attention, math_attention, set_attention_backend, sdpa_available
+from ldm.modules.attention import CrossAttention
+
+
+@pytest.fixture
+def backend():
+    previous = attention_backends.get_attention_backend()
+    previous_budget = attention_backends._chunk_budget
+
+    def select(name, chunk_budget=None):
+        if name == 'sdpa' and not sdpa_available():
+            pytest.skip("scaled_dot_product_attention needs torch >= 2.0")
+        set_attention_backend(name, chunk_budget)
+
+    yield select
+    set_attention_backend(previous, previous_budget)
+
+
+def qkv(b=3, n=37, m=11, d=16, seed=0):
+    generator = torch.Generator().manual_seed(seed)
+    return [torch.randn(b, length, d, generator=generator) for length in (n, m, m)]
+
+
+@pytest.mark.parametrize('name, chunk_budget', [
+    ('math', None),
+    ('chunked', None),
+    ('chunked', 3 * 11 * 5),  # tiles of 5 queries, the last one partial
+    ('sdpa', None),
+    ('auto', None),
+])
+@pytest.mark.parametrize('masked', [False, True])
+def test_backends_match_math(backend, name, chunk_budget, masked):
+    q, k, v = qkv()
+    scale = 0.3
+    mask = None
+    if masked:
+        mask = torch.rand(3, 1, 11, generator=torch.Generator().manual_seed(1)) > 0.3
+        mask[..., 0] = True
+    expected = math_attention(q, k, v, scale, mask)
+    backend(name, chunk_budget)
+    torch.testing.assert_close(attention(q, k, v, scale, mask), expected, rtol=1e-5, atol=1e-5)
+
+
+def test_chunked_per_query_mask(backend):
+    q, k, v = qkv()
+    mask = torch.rand(3, 37, 11, generator=torch.Generator().manual_seed(2)) > 0.3
+    mask[..., 0] = True
+    backend('chunked', 3 * 11 * 4)
+    torch.testing.assert_close(attention(q, k, v, mask=mask), math_attention(q, k, v, 16 ** -0.5, mask),
+                               rtol=1e-5, atol=1e-5)
+
+
+@pytest.mark.parametrize('name', ['sdpa', 'chunked'])
+def test_cross_attention_layers_match_math(backend, name):
+    torch.manual_seed(0)
+    attn = CrossAttention(query_dim=32, context_dim=24, heads=4, dim_head=8).eval()
+    x = torch.randn(2, 10, 32)
+    context = torch.randn(2, 7, 24)
+    with torch.no_grad():
+        backend('math')
+        expected = attn(x, context)
+        backend(name, 2 * 4 * 7 * 3)
+        out = attn(x, context)
+    torch.testing.assert_close(out, expected, rtol=1e-5, atol=1e-5)
@@ -0,0 +1,68 @@
+import math
+from types import SimpleNamespace
+
+import pytest
+import torch
+
+from model.triplane_vae import AutoencoderKL
+
+RENDER_KWARGS = {
+    'depth_resolution': 24,
+    'disparity_space_sampling': False,
+    'box_warp': 2.4,
+    'depth_resolution_importance': 24,
+    'clamp_mode': 'softplus',
+    'white_back': True,
+    'det': True
+}
+
+
+def orbit_rays(views, H=6):
+    """Rays [V, 2, H*H, 3] of pinhole cameras circling the origin; the outer pixels miss the box."""
+    rays = []
+    for v in range(views):
+        angle = 2 * math.pi * v / views
+        origin = torch.tensor([2 * math.cos(angle), 0.5, 2 * math.sin(angle)])
+        forward = -origin / origin.norm()
+        right = torch.linalg.cross(forward, torch.tensor([0., 1., 0.]))
+        right = right / right.norm()
+        up = torch.linalg.cross(right, forward)
+        s = torch.linspace(-1.2, 1.2, H)
+        dirs = forward + s.reshape(-1, 1, 1) * up + s.reshape(1, -1, 1) * right
+        dirs = (dirs / dirs.norm(dim=-1, keepdim=True)).reshape(-1, 3)
+        rays.append(torch.stack([origin.expand_as(dirs), dirs], 0))
+    return torch.stack(rays, 0)
+
+
+@pytest.fixture
+def vae(sphere_renderer):
+    # the parts of AutoencoderKL the view renderer uses
+    return SimpleNamespace(triplane_decoder=sphere_renderer, triplane_render_kwargs=dict(RENDER_KWARGS))
+
+
+def render_one_view_at_a_time(vae, triplane, batch_rays):
+    planes = triplane.reshape(triplane.shape[0], 3, -1, triplane.shape[-2], triplane.shape[-1])
+    frames = []
+    for v in range(batch_rays.shape[0]):
+        ray_o = batch_rays[v:v+1, 0].expand(planes.shape[0], -1, -1)
+        ray_d = batch_rays[v:v+1, 1].expand(planes.shape[0], -1, -1)
+        with torch.no_grad():
+            out = vae.triplane_decoder(planes, ray_o, ray_d, vae.triplane_render_kwargs, whole_img=False, tvloss=False)
+        frames.append(out['rgb_marched'])
+    return torch.stack(frames, 1)
+
+
+@pytest.mark.parametrize('ray_budget', [2 ** 15, 50, 7])
+def test_packed_views_match_single_views(vae, sphere_triplane, ray_budget):
+    triplane = torch.cat([sphere_triplane, sphere_triplane.flip(-1)], 0)
+    batch_rays = orbit_rays(5)
+    packed = AutoencoderKL.render_triplane_eg3d_decoder_views(vae, triplane, batch_rays, ray_budget=ray_budget)
+    assert packed.shape == (2, 5, 6, 6, 3)
+    expected = render_one_view_at_a_time(vae, triplane, batch_rays).reshape(packed.shape)
+    torch.testing.assert_close(packed, expected, rtol=1e-4, atol=1e-5)
+
+
+def test_packed_views_do_not_change_the_render_options(vae, sphere_triplane):
+    AutoencoderKL.render_triplane_eg3d_decoder_views(vae, sphere_triplane, orbit_rays(2), ray_budget=10,
+                                                     occupancy=True, termination_eps=1e-3)
+    assert vae.triplane_render_kwargs == RENDER_KWARGS
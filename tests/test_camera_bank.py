@@ -0,0 +1,76 @@
+import os
+
+import numpy as np
+import pytest
+import torch
+
+from utility import camera_bank
+from utility.camera_bank import default_bank_path, get_view_rays, load_pose_bank, view_rays
+
+
+def write_pose(path, shift):
+    c2w = np.eye(4)
+    c2w[:3, 3] = [0., 0., 1. + shift]
+    np.savetxt(path, c2w)
+
+
+@pytest.fixture
+def pose_folder(tmp_path):
+    folder = tmp_path / 'pose'
+    folder.mkdir()
+    for i in range(3):
+        write_pose(folder / f'{i:06d}.txt', i)
+    load_pose_bank.cache_clear()
+    view_rays.cache_clear()
+    yield str(folder)
+    load_pose_bank.cache_clear()
+    view_rays.cache_clear()
+
+
+def test_default_bank_path():
+    assert default_bank_path('assets/sample_data/pose/') == os.path.normpath('assets/sample_data/pose_bank.npy')
+    assert camera_bank.POSE_BANK == default_bank_path(camera_bank.POSE_FOLDER)
+
+
+def test_bank_is_written_and_reused(pose_folder, monkeypatch):
+    bank = load_pose_bank(pose_folder)
+    assert bank.shape == (3, 4, 4)
+    assert bank[:, 2, 3].tolist() == [1., 2., 3.]
+    assert os.path.exists(default_bank_path(pose_folder))
+    assert os.path.exists(default_bank_path(pose_folder) + '.json')
+
+    load_pose_bank.cache_clear()
+
+    def fail(*args, **kwargs):
+        raise AssertionError('pose files parsed again')
+    monkeypatch.setattr(np, 'loadtxt', fail)
+    np.testing.assert_array_equal(load_pose_bank(pose_folder), bank)
+
+
+def test_bank_is_rebuilt_when_poses_change(pose_folder):
+    load_pose_bank(pose_folder)
+    load_pose_bank.cache_clear()
+    path = os.path.join(pose_folder, '000001.txt')
+    write_pose(path, 10)
+    stat = os.stat(path)
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+    assert load_pose_bank(pose_folder)[1, 2, 3] == 11.
+
+    load_pose_bank.cache_clear()
+    write_pose(os.path.join(pose_folder, '000003.txt'), 3)
+    assert load_pose_bank(pose_folder).shape == (4, 4, 4)
+
+
+def test_bank_path_none_writes_nothing(pose_folder):
+    load_pose_bank(pose_folder, bank_path=None)
+    assert not os.path.exists(default_bank_path(pose_folder))
+
+
+def test_rays_are_built_per_view(pose_folder):
+    rays = get_view_rays([2, 0], 8, pose_folder)
+    assert rays.shape == (2, 2, 64, 3)
+    assert torch.equal(rays[0], view_rays(2, 8, pose_folder))
+    assert torch.equal(rays[1], view_rays(0, 8, pose_folder))
+    # origins are scaled by 2.2 and moved into the triplane frame
+    torch.testing.assert_close(rays[1, 0, 0], torch.tensor([0., -2.2, 0.]))
+    assert view_rays.cache_info().currsize == 2
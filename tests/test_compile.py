@@ -0,0 +1,88 @@
+import pytest
+import torch
+import torch.nn as nn
+
+from ldm.modules.diffusionmodules.openaimodel import UNetModel
+from ldm.modules.diffusionmodules.util import set_inference_mode
+from utility.compile import CompiledForward, no_grad_only, unet_accepts
+
+
+class Counting(nn.Module):
+    """Small MLP counting its eager forward calls; scale is a non-tensor option."""
+    def __init__(self):
+        super().__init__()
+        self.net = nn.Sequential(nn.Linear(6, 16), nn.SiLU(), nn.Linear(16, 3))
+        self.calls = 0
+
+    def forward(self, x, bias=None, scale=1.):
+        self.calls += 1
+        out = self.net(x) * scale
+        return out if bias is None else out + bias
+
+
+@pytest.fixture
+def mlp():
+    torch.manual_seed(0)
+    return Counting().eval()
+
+
+@torch.no_grad()
+def test_trace_matches_eager(mlp):
+    x, bias = torch.randn(5, 6), torch.randn(3)
+    expected = mlp(x), mlp(x, bias)
+    wrapper = CompiledForward(mlp, backend='trace', accept=no_grad_only)
+    torch.testing.assert_close(mlp(x), expected[0])
+    torch.testing.assert_close(mlp(x, bias=bias), expected[1])
+    assert len(wrapper.graphs) == 2
+
+    # cached graphs do not run the eager forward again
+    calls = mlp.calls
+    torch.testing.assert_close(mlp(x), expected[0])
+    torch.testing.assert_close(mlp(x * 2), mlp.net(x * 2))
+    assert mlp.calls == calls
+
+
+def test_calls_without_a_graph_run_eagerly(mlp):
+    x = torch.randn(5, 6)
+    wrapper = CompiledForward(mlp, backend='trace', accept=no_grad_only, max_graphs=1)
+    calls = mlp.calls
+    mlp(x)
+    assert wrapper.graphs == {} and mlp.calls == calls + 1
+    with torch.no_grad():
+        # non-tensor options are not baked into a graph
+        torch.testing.assert_close(mlp(x, scale=2.), mlp.net(x) * 2)
+        assert wrapper.graphs == {}
+        mlp(x)
+        calls = mlp.calls
+        # beyond max_graphs
+        mlp(torch.randn(7, 6))
+    assert len(wrapper.graphs) == 1 and mlp.calls == calls + 1
+
+    wrapper.remove()
+    assert 'forward' not in mlp.__dict__ and wrapper.graphs == {}
+
+
+@torch.no_grad()
+def test_unet_graph():
+    torch.manual_seed(0)
+    unet = UNetModel(image_size=8, in_channels=4, model_channels=32, out_channels=4, num_res_blocks=1,
+                     attention_resolutions=[2], channel_mult=(1, 2), num_heads=2, use_checkpoint=True,
+                     use_spatial_transformer=True, context_dim=16).eval()
+    x, t, context = torch.randn(2, 4, 8, 8), torch.tensor([10, 700]), torch.randn(2, 1, 16)
+    expected = unet(x, t, context)
+    wrapper = CompiledForward(unet, backend='trace', name='UNet')
+    wrapper.accept = unet_accepts(unet, wrapper)
+
+    # checkpointed path: not accepted
+    unet(x, t, context)
+    assert wrapper.graphs == {}
+    set_inference_mode(unet, True)
+    torch.testing.assert_close(unet(x, t, context), expected, rtol=1e-5, atol=1e-5)
+    torch.testing.assert_close(unet(x, t + 1, context * 2), wrapper.eager(x, t + 1, context * 2),
+                               rtol=1e-5, atol=1e-5)
+    assert len(wrapper.graphs) == 1
+
+    unet.set_feature_reuse(3)
+    assert not wrapper.accept((x, t, context), {})
+    unet.set_feature_reuse(0)
+    assert wrapper.accept((x, t, context), {})
@@ -0,0 +1,66 @@
+import torch
+
+from ldm.modules.encoders.conditioning_cache import ConditioningCache
+
+
+class CountingEncoder(object):
+    """Encodes a prompt as [1, 2, 4] rows filled with its length, recording every call."""
+    def __init__(self):
+        self.calls = []
+
+    def __call__(self, prompts):
+        self.calls.append(list(prompts))
+        return torch.stack([torch.full((2, 4), float(len(p))) for p in prompts])
+
+
+def test_hits_and_prompt_normalization():
+    encode = CountingEncoder()
+    cache = ConditioningCache('clip-l', capacity=8)
+    first = cache.get(['a cat', 'a dog', 'a cat'], encode)
+    assert first.shape == (3, 2, 4)
+    assert encode.calls == [['a cat', 'a dog']]
+    assert (cache.hits, cache.misses) == (0, 2)
+
+    second = cache.get(['A  Dog', 'a cat'], encode)
+    assert len(encode.calls) == 1
+    assert (cache.hits, cache.misses) == (2, 2)
+    assert torch.equal(second, first[[1, 0]])
+
+
+def test_versions_do_not_share_entries():
+    encode = CountingEncoder()
+    ConditioningCache('clip-l').get(['a cat'], encode)
+    ConditioningCache('clip-l-penultimate').get(['a cat'], encode)
+    assert len(encode.calls) == 2
+
+
+def test_least_recently_used_is_evicted():
+    encode = CountingEncoder()
+    cache = ConditioningCache('clip-l', capacity=2)
+    cache.get(['a'], encode)
+    cache.get(['bb'], encode)
+    cache.get(['a'], encode)
+    cache.get(['ccc'], encode)
+    assert len(cache.entries) == 2
+    cache.get(['a'], encode)
+    assert len(encode.calls) == 3
+    cache.get(['bb'], encode)
+    assert encode.calls[-1] == ['bb']
+
+
+def test_misses_are_encoded_in_batches():
+    encode = CountingEncoder()
+    cache = ConditioningCache('clip-l', batch_size=2)
+    out = cache.get(['a', 'bb', 'ccc', 'dddd', 'eeeee'], encode)
+    assert encode.calls == [['a', 'bb'], ['ccc', 'dddd'], ['eeeee']]
+    assert out[:, 0, 0].tolist() == [1., 2., 3., 4., 5.]
+
+
+def test_disk_entries_survive_a_new_cache(tmp_path):
+    encode = CountingEncoder()
+    expected = ConditioningCache('clip-l', cache_dir=str(tmp_path)).get(['a cat', 'a dog'], encode)
+    cache = ConditioningCache('clip-l', cache_dir=str(tmp_path))
+    out = cache.get(['a dog', 'a cat'], encode)
+    assert len(encode.calls) == 1
+    assert cache.hits == 2
+    assert torch.equal(out, expected[[1, 0]])
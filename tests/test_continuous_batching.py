@@ -0,0 +1,144 @@
+import threading
+
+import pytest
+import torch
+
+from ldm.models.diffusion.ddim import DDIMSampler
+from ldm.models.diffusion.plms import PLMSSampler
+from ldm.models.diffusion.dpm_solver import DPMSolverSampler
+from ldm.models.diffusion.continuous_batching import ContinuousBatchScheduler
+
+SHAPE = [2, 4, 6]
+
+
+def conditioning(value, batch_size=1):
+    return torch.full((batch_size, 1, 8), float(value))
+
+
+def plms_sample(model, x_T, steps=10):
+    sampler = PLMSSampler(model)
+    samples, _ = sampler.sample(S=steps, batch_size=x_T.shape[0], shape=SHAPE, conditioning=conditioning(1.),
+                                x_T=x_T.clone(), verbose=False, unconditional_guidance_scale=3.,
+                                unconditional_conditioning=conditioning(0.))
+    return samples
+
+
+def noise(seed, batch_size=1):
+    return torch.randn([batch_size] + SHAPE, generator=torch.Generator().manual_seed(seed))
+
+
+def solo_sample(sampler, steps, c, uc, scale, x_T):
+    samples, _ = sampler.sample(S=steps, batch_size=x_T.shape[0], shape=SHAPE, conditioning=c, x_T=x_T.clone(),
+                                verbose=False, unconditional_guidance_scale=scale, unconditional_conditioning=uc)
+    return samples
+
+
+@pytest.mark.parametrize('name, sampler_cls, steps', [
+    ('ddim', DDIMSampler, 20),
+    ('dpm', DPMSolverSampler, 10),
+    ('dpm', DPMSolverSampler, 20),
+])
+def test_steppers_match_samplers(toy_model, name, sampler_cls, steps):
+    # two requests with different prompts, guidance and batch sizes share every tick
+    requests = [
+        (conditioning(1., 2), conditioning(0., 2), 3., noise(0, 2)),
+        (conditioning(-0.5), None, 1., noise(1)),
+    ]
+    scheduler = ContinuousBatchScheduler(toy_model, max_batch=8)
+    scheduler.start()
+    try:
+        pending = [scheduler.submit(c, steps, SHAPE, name, guidance_scale=scale, uncond=uc, x_T=x_T.clone())
+                   for c, uc, scale, x_T in requests]
+        batched = [request.wait(timeout=60) for request in pending]
+    finally:
+        scheduler.stop()
+
+    for (c, uc, scale, x_T), result in zip(requests, batched):
+        expected = solo_sample(sampler_cls(toy_model), steps, c, uc, scale, x_T)
+        torch.testing.assert_close(result, expected, rtol=1e-4, atol=1e-4)
+
+
+def test_failing_callback_only_fails_its_request(toy_model):
+    def broken_pipe(i):
+        if i == 2:
+            raise BrokenPipeError("client went away")
+
+    scheduler = ContinuousBatchScheduler(toy_model, max_batch=8)
+    scheduler.start()
+    try:
+        broken = scheduler.submit(conditioning(1.), 10, SHAPE, 'ddim', x_T=noise(0), callback=broken_pipe)
+        healthy = scheduler.submit(conditioning(1.), 10, SHAPE, 'ddim', x_T=noise(0), callback=lambda i: None)
+        with pytest.raises(BrokenPipeError):
+            broken.wait(timeout=60)
+        result = healthy.wait(timeout=60)
+    finally:
+        scheduler.stop()
+    expected = solo_sample(DDIMSampler(toy_model), 10, conditioning(1.), None, 1., noise(0))
+    torch.testing.assert_close(result, expected, rtol=1e-4, atol=1e-4)
+
+
+def test_shared_lock_serializes_plms_and_scheduler(slow_toy_model):
+    model = slow_toy_model
+    x_T = noise(0)
+    reference = plms_sample(model, x_T)
+
+    lock = threading.Lock()
+    scheduler = ContinuousBatchScheduler(model, max_batch=8, lock=lock)
+    scheduler.start()
+    results = {}
+
+    def run_plms():
+        # what GenerationService does for jobs that bypass the scheduler
+        with lock:
+            results['plms'] = plms_sample(model, x_T)
+
+    def run_scheduled():
+        results['ddim'] = scheduler.sample(conditioning(1.), 20, SHAPE, 'ddim', guidance_scale=3.,
+                                           uncond=conditioning(0.), x_T=torch.randn([1] + SHAPE))
+
+    try:
+        model.overlaps = 0
+        threads = [threading.Thread(target=run_scheduled), threading.Thread(target=run_plms)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(timeout=60)
+    finally:
+        scheduler.stop()
+
+    assert model.overlaps == 0
+    assert torch.equal(results['plms'], reference)
+    assert torch.isfinite(results['ddim']).all()
+
+
+@pytest.mark.parametrize('options', [
+    {'early_stop_tol': 0.01},
+    {'feature_reuse': 3, 'feature_reuse_layer': 0},
+    {'guidance_interval': [0.2, 0.8]},
+    {'guidance_reuse': 1},
+])
+def test_submit_rejects_unsupported_sampler_options(toy_model, options):
+    scheduler = ContinuousBatchScheduler(toy_model)
+    with pytest.raises(ValueError, match=sorted(options)[0]):
+        scheduler.submit(conditioning(1.), 10, SHAPE, 'ddim', **options)
+
+
+def test_callbacks_run_outside_the_model_lock(toy_model):
+    lock = threading.Lock()
+    calls = []
+
+    def progress(i):
+        # a callback that needs the model lock would deadlock if it ran inside tick()
+        acquired = lock.acquire(timeout=5)
+        if acquired:
+            lock.release()
+        calls.append((i, acquired))
+
+    scheduler = ContinuousBatchScheduler(toy_model, max_batch=8, lock=lock)
+    scheduler.start()
+    try:
+        scheduler.sample(conditioning(1.), 10, SHAPE, 'ddim', x_T=noise(0), callback=progress)
+    finally:
+        scheduler.stop()
+    # every step was reported before sample() returned
+    assert calls == [(i, True) for i in range(10)]
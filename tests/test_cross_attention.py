@@ -0,0 +1,40 @@
+import torch
+
+from ldm.modules.attention import CrossAttention, set_context_cache
+
+
+def full_cross_attention(attn, x, context):
+    # the regular path: an all-true mask keeps forward() off the single-token shortcut
+    return attn(x, context, mask=torch.ones(context.shape[0], context.shape[1], dtype=torch.bool))
+
+
+def test_single_token_context_matches_full_attention():
+    torch.manual_seed(0)
+    attn = CrossAttention(query_dim=32, context_dim=24, heads=4, dim_head=8).eval()
+    x = torch.randn(2, 10, 32)
+    context = torch.randn(2, 1, 24)
+    with torch.no_grad():
+        fast = attn(x, context)
+        full = full_cross_attention(attn, x, context)
+    assert fast.shape == full.shape == (2, 10, 32)
+    torch.testing.assert_close(fast, full, rtol=1e-5, atol=1e-5)
+
+
+def test_context_cache_reuses_and_refreshes():
+    torch.manual_seed(0)
+    attn = set_context_cache(CrossAttention(query_dim=32, context_dim=24, heads=4, dim_head=8).eval(),
+                             max_entries=2)
+    x = torch.randn(2, 10, 32)
+    contexts = [torch.randn(2, 1, 24) for _ in range(3)]
+    with torch.no_grad():
+        for context in contexts + contexts[1:]:
+            torch.testing.assert_close(attn(x, context), full_cross_attention(attn, x, context),
+                                       rtol=1e-5, atol=1e-5)
+    assert len(attn._context_cache) == 2
+    assert all(torch.equal(cached, context) for (cached, _), context in zip(attn._context_cache, contexts[1:]))
+
+
+def test_context_cache_is_bypassed_with_grad():
+    attn = set_context_cache(CrossAttention(query_dim=32, context_dim=24, heads=4, dim_head=8))
+    attn(torch.randn(1, 10, 32), torch.randn(1, 1, 24))
+    assert attn._context_cache == []
@@ -0,0 +1,38 @@
+import numpy as np
+import pytest
+import torch
+
+from ldm.modules.diffusionmodules.util import (DDIM_SCHEDULE_CACHE_SIZE, get_ddim_schedule, make_ddim_timesteps,
+                                               make_ddim_sampling_parameters)
+
+
+@pytest.mark.parametrize('steps, discretize, eta', [(50, 'uniform', 0.), (20, 'quad', 0.5)])
+def test_ddim_schedule_matches_sampling_parameters(toy_model, steps, discretize, eta):
+    schedule = get_ddim_schedule(toy_model, steps, ddim_discretize=discretize, ddim_eta=eta)
+    timesteps = make_ddim_timesteps(discretize, steps, toy_model.num_timesteps, verbose=False)
+    sigmas, alphas, alphas_prev = make_ddim_sampling_parameters(toy_model.alphas_cumprod.numpy(), timesteps,
+                                                                eta=eta, verbose=False)
+    np.testing.assert_array_equal(schedule['ddim_timesteps'], timesteps)
+    for name, expected in [('ddim_sigmas', sigmas), ('ddim_alphas', alphas), ('ddim_alphas_prev', alphas_prev),
+                           ('ddim_sqrt_one_minus_alphas', np.sqrt(1. - alphas))]:
+        torch.testing.assert_close(schedule[name], torch.from_numpy(np.asarray(expected, dtype=np.float32)))
+    torch.testing.assert_close(schedule['step_a_t'].flatten(), schedule['ddim_alphas'])
+    torch.testing.assert_close(schedule['step_sigma_t'].flatten(), schedule['ddim_sigmas'])
+    assert schedule['step_timesteps'].tolist() == timesteps.tolist()
+    torch.testing.assert_close(schedule['alphas_cumprod'], toy_model.alphas_cumprod)
+
+
+def test_ddim_schedule_cache(toy_model):
+    schedule = get_ddim_schedule(toy_model, 50)
+    assert get_ddim_schedule(toy_model, 50) is schedule
+    assert get_ddim_schedule(toy_model, 50, ddim_eta=1.) is not schedule
+
+    # modifying the buffer in place invalidates the entry
+    toy_model.alphas_cumprod.mul_(0.5)
+    updated = get_ddim_schedule(toy_model, 50)
+    assert updated is not schedule
+    torch.testing.assert_close(updated['ddim_alphas'], schedule['ddim_alphas'] * 0.5)
+
+    for steps in range(1, 2 * DDIM_SCHEDULE_CACHE_SIZE):
+        get_ddim_schedule(toy_model, steps)
+    assert len(toy_model._ddim_schedule_cache) == DDIM_SCHEDULE_CACHE_SIZE
@@ -0,0 +1,39 @@
+import torch
+
+from ldm.models.diffusion.early_stopping import EarlyStopping
+
+
+def calm_predictions(steps, jump_at=()):
+    x0 = torch.ones(2, 4)
+    out = []
+    for i in range(steps):
+        if i in jump_at:
+            x0 = x0 * 2.
+        out.append(x0.clone())
+    return out
+
+
+def first_stop(stopping, predictions):
+    for i, pred_x0 in enumerate(predictions):
+        if stopping(pred_x0, i, len(predictions)):
+            return i
+    return None
+
+
+def test_early_stopping_waits_for_patience_and_min_fraction():
+    # calm from step 1 on, patience is met at step 2 but min_fraction only at step 4
+    assert first_stop(EarlyStopping(tol=0.01, patience=2, min_fraction=0.5), calm_predictions(10)) == 4
+    assert first_stop(EarlyStopping(tol=0.01, patience=2, min_fraction=0.), calm_predictions(10)) == 2
+    assert first_stop(EarlyStopping(tol=0.01, patience=4, min_fraction=0.), calm_predictions(10)) == 4
+
+
+def test_early_stopping_resets_on_change():
+    stopping = EarlyStopping(tol=0.01, patience=3, min_fraction=0.)
+    assert first_stop(stopping, calm_predictions(10, jump_at=(3,))) == 6
+    assert stopping.last_change == 0.
+
+
+def test_early_stopping_disabled():
+    stopping = EarlyStopping()
+    assert not stopping.enabled
+    assert first_stop(stopping, calm_predictions(10)) is None
@@ -0,0 +1,78 @@
+from types import SimpleNamespace
+
+import pytest
+import torch
+
+from ldm.models.diffusion.ddpm import LatentDiffusion
+from ldm.modules.diffusionmodules.openaimodel import UNetModel
+
+
+@pytest.fixture
+def unet():
+    torch.manual_seed(0)
+    return UNetModel(image_size=8, in_channels=4, model_channels=32, out_channels=4, num_res_blocks=1,
+                     attention_resolutions=[], channel_mult=(1, 2), num_heads=2).eval()
+
+
+def inputs(batch_size=2, t=500):
+    generator = torch.Generator().manual_seed(batch_size + t)
+    return torch.randn(batch_size, 4, 8, 8, generator=generator), torch.full((batch_size,), t)
+
+
+@torch.no_grad()
+def test_interval_one_is_the_baseline(unet):
+    x, t = inputs()
+    expected = [unet(x, t + s) for s in range(4)]
+    unet.set_feature_reuse(1)
+    for s in range(4):
+        assert torch.equal(unet(x, t + s), expected[s])
+    assert (unet.full_calls, unet.partial_calls) == (0, 0)
+
+
+@torch.no_grad()
+@pytest.mark.parametrize('layer', [0, 1])
+def test_partial_calls_reuse_deep_features(unet, layer):
+    x, t = inputs()
+    expected = unet(x, t)
+    unet.set_feature_reuse(3, layer)
+    outputs = [unet(x, t) for _ in range(6)]
+    assert (unet.full_calls, unet.partial_calls) == (2, 4)
+    # same input and timestep, so the cached deep features are exactly the ones a full call computes
+    for out in outputs:
+        torch.testing.assert_close(out, expected)
+    # a different timestep on a partial call only changes the shallow blocks
+    assert not torch.equal(unet(x, t - 100), expected)
+    assert unet.partial_calls == 5
+
+
+@torch.no_grad()
+def test_features_are_kept_per_batch_size(unet):
+    unet.set_feature_reuse(3)
+    uncond_and_cond = inputs(4)
+    cond_only = inputs(2)
+    expected = {4: unet(*uncond_and_cond), 2: unet(*cond_only)}
+    assert (unet.full_calls, unet.partial_calls) == (2, 0)
+    torch.testing.assert_close(unet(*uncond_and_cond), expected[4])
+    torch.testing.assert_close(unet(*cond_only), expected[2])
+    assert (unet.full_calls, unet.partial_calls) == (2, 2)
+
+
+def test_no_reuse_with_grad(unet):
+    unet.set_feature_reuse(3)
+    x, t = inputs()
+    unet(x, t)
+    unet(x, t)
+    assert (unet.full_calls, unet.partial_calls) == (0, 0)
+
+
+def test_latent_diffusion_context(unet, capsys):
+    model = SimpleNamespace(model=SimpleNamespace(diffusion_model=unet))
+    with LatentDiffusion.feature_reuse(model, interval=4, layer=1) as reused:
+        assert reused is unet
+        assert (unet.reuse_interval, unet.reuse_layer) == (4, 1)
+    assert unet.reuse_interval == 0
+
+    model.model.diffusion_model = torch.nn.Identity()
+    with LatentDiffusion.feature_reuse(model, interval=4) as reused:
+        assert reused is None
+    assert "does not support feature reuse" in capsys.readouterr().out
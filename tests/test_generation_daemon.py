@@ -0,0 +1,70 @@
+import threading
+
+import pytest
+
+from generation_daemon import GenerationService, JobHandler, ThreadingTCPServer, submit_job
+
+
+@pytest.fixture
+def service():
+    # the job handling parts of GenerationService, without loading a model
+    from sample_stage1 import get_parser
+    service = GenerationService.__new__(GenerationService)
+    service.defaults = vars(get_parser().parse_args([]))
+    service.defaults['config'] = 'configs/default.yaml'
+    service.defaults['test_folder'] = 'daemon'
+    service.defaults['cache_dir'] = None
+    service.lock = threading.Lock()
+    service.counter_lock = threading.Lock()
+    service.samplers = {}
+    service.job_counter = 0
+    service.scheduler = None
+    return service
+
+
+@pytest.fixture
+def server(service):
+    server = ThreadingTCPServer(('127.0.0.1', 0), JobHandler)
+    server.service = service
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def send(server, job):
+    return list(submit_job(job, host='127.0.0.1', port=server.server_address[1]))
+
+
+def test_make_args_applies_job_options(service):
+    args = service.make_args({'prompt': 'a robot', 'sampler': 'dpm++2m', 'seed': 3, 'cfg_scale': 5.,
+                              'video': False, 'mcubes': True})
+    assert (args.sampler, args.seed, args.cfg_scale) == ('dpm++2m', 3, 5.)
+    assert args.steps == 15
+    assert args.no_video and not args.no_mcubes
+    assert args.config == 'configs/default.yaml'
+
+
+@pytest.mark.parametrize('key, value', [('ckpt', 'other.ckpt'), ('config', 'other.yaml'), ('precision', 'bf16'),
+                                        ('cache_dir', '/tmp/anywhere'), ('test_folder', '../..')])
+def test_make_args_rejects_process_wide_options(service, key, value):
+    with pytest.raises(ValueError, match=f"{key} is fixed"):
+        service.make_args({'prompt': 'a robot', key: value})
+
+
+def test_make_args_rejects_unknown_options(service):
+    with pytest.raises(ValueError, match="Unknown job option: stepz"):
+        service.make_args({'prompt': 'a robot', 'stepz': 10})
+
+
+def test_job_ids(service):
+    assert [service.next_job_id({}), service.next_job_id({'id': 'mine'}), service.next_job_id({})] == [1, 'mine', 3]
+
+
+def test_errors_carry_the_job_id(server):
+    assert send(server, {'op': 'ping'}) == [{'event': 'pong'}]
+    events = send(server, {'id': 'job-a', 'prompt': 'a robot', 'ckpt': 'other.ckpt'})
+    assert events == [{'event': 'error', 'job': 'job-a', 'message': "Job option ckpt is fixed when the daemon starts"}]
+    events = send(server, {'sampler': 'ddim'})
+    assert events == [{'event': 'error', 'job': 2, 'message': "Job is missing a 'prompt'"}]
@@ -0,0 +1,60 @@
+import torch
+
+from ldm.models.diffusion.guidance import GuidanceSchedule
+
+
+class LinearModel(object):
+    """fn(x, t, c) = x + c, recording the batch size of every call."""
+    def __init__(self):
+        self.batches = []
+
+    def __call__(self, x, t, c):
+        self.batches.append(x.shape[0])
+        return x + c
+
+
+def guide(schedule, fn, t_frac, x=None):
+    x = torch.zeros(2, 3) if x is None else x
+    c, uc = torch.full((2, 3), 2.), torch.full((2, 3), -1.)
+    return schedule(fn, x, torch.zeros(2), c, uc, t_frac)
+
+
+def test_guidance_matches_inline_cfg():
+    fn = LinearModel()
+    schedule = GuidanceSchedule(scale=3.)
+    x = torch.randn(2, 3)
+    # e_uncond + scale * (e_cond - e_uncond)
+    torch.testing.assert_close(guide(schedule, fn, 0.5, x), (x - 1.) + 3. * 3.)
+    assert fn.batches == [4]
+    assert not schedule.scheduled
+
+
+def test_guidance_window():
+    fn = LinearModel()
+    schedule = GuidanceSchedule(scale=3., interval=(0.2, 0.8))
+    outputs = [guide(schedule, fn, t_frac) for t_frac in (1., 0.8, 0.5, 0.2, 0.1)]
+    assert fn.batches == [2, 4, 4, 4, 2]
+    assert (schedule.guided_calls, schedule.cond_calls) == (3, 2)
+    assert torch.equal(outputs[0], torch.full((2, 3), 2.))
+    assert torch.equal(outputs[2], torch.full((2, 3), 8.))
+    assert schedule.scheduled
+
+
+def test_guidance_reuse():
+    fn = LinearModel()
+    schedule = GuidanceSchedule(scale=3., reuse=2)
+    outputs = [guide(schedule, fn, 1. - i / 7) for i in range(7)]
+    assert fn.batches == [4, 2, 2, 4, 2, 2, 4]
+    assert (schedule.guided_calls, schedule.cond_calls) == (3, 4)
+    # the model is linear, so the reused delta is exact
+    for out in outputs:
+        assert torch.equal(out, torch.full((2, 3), 8.))
+
+
+def test_guidance_reuse_is_dropped_when_the_batch_changes():
+    fn = LinearModel()
+    schedule = GuidanceSchedule(scale=3., reuse=2)
+    guide(schedule, fn, 1.)
+    x = torch.zeros(1, 3)
+    schedule(fn, x, torch.zeros(1), torch.full((1, 3), 2.), torch.full((1, 3), -1.), 0.9)
+    assert fn.batches == [4, 2]
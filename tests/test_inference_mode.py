@@ -0,0 +1,67 @@
+import threading
+from types import SimpleNamespace
+
+import pytest
+import torch
+
+from ldm.models.diffusion.ddpm import LatentDiffusion
+from ldm.modules.diffusionmodules.openaimodel import TimestepEmbedSequential, UNetModel
+from ldm.modules.diffusionmodules.util import set_inference_mode
+
+
+@pytest.fixture
+def unet():
+    torch.manual_seed(0)
+    return UNetModel(image_size=8, in_channels=4, model_channels=32, out_channels=4, num_res_blocks=1,
+                     attention_resolutions=[1, 2], channel_mult=(1, 2), num_heads=2, use_checkpoint=True,
+                     use_spatial_transformer=True, context_dim=16).eval()
+
+
+def inputs():
+    return torch.randn(2, 4, 8, 8), torch.tensor([10, 700]), torch.randn(2, 3, 16)
+
+
+def flags(unet):
+    inference = [m.inference for m in unet.modules() if hasattr(type(m), 'inference')]
+    fused = [m.dispatch is not None for m in unet.modules() if isinstance(m, TimestepEmbedSequential)]
+    return inference, fused
+
+
+def test_inference_mode_matches_checkpointed_forward(unet):
+    x, t, context = inputs()
+    with torch.no_grad():
+        expected = unet(x, t, context)
+        set_inference_mode(unet, True)
+        assert all(all(f) for f in flags(unet))
+        out = unet(x, t, context)
+    torch.testing.assert_close(out, expected, rtol=1e-5, atol=1e-5)
+
+    set_inference_mode(unet, False)
+    assert not any(any(f) for f in flags(unet))
+    # the checkpointed training path still backpropagates
+    unet(x, t, context).sum().backward()
+    assert unet.out[-1].weight.grad is not None
+
+
+def latent_diffusion(unet):
+    # the parts of LatentDiffusion inference_mode uses
+    return SimpleNamespace(model=unet, inference_lock=threading.Lock(), inference_depth=0)
+
+
+def test_latent_diffusion_inference_mode_is_reentrant(unet):
+    model = latent_diffusion(unet)
+    with LatentDiffusion.inference_mode(model) as outer:
+        assert outer is unet
+        with LatentDiffusion.inference_mode(model):
+            assert model.inference_depth == 2
+        assert all(all(f) for f in flags(unet))
+    assert model.inference_depth == 0
+    assert not any(any(f) for f in flags(unet))
+
+
+def test_training_with_grad_keeps_checkpointing(unet):
+    model = latent_diffusion(unet.train())
+    with LatentDiffusion.inference_mode(model) as entered:
+        assert entered is None
+        assert not any(any(f) for f in flags(unet))
+    assert model.inference_depth == 0
@@ -0,0 +1,47 @@
+import pytest
+
+from utility.latent_cache import make_cache_key
+
+BASE = dict(prompt='a robot', seed=42, sampler='ddim', steps=50, cfg_scale=7.5, ckpt=None)
+
+
+def test_key_is_stable():
+    # keys of existing cache entries must not change between releases
+    assert make_cache_key(**BASE) == '80b00431eb8e19f3edd03884b75854a5'
+    assert make_cache_key(**BASE) == make_cache_key(**dict(reversed(list(BASE.items()))))
+
+
+def test_defaults_do_not_change_the_key():
+    key = make_cache_key(**BASE)
+    assert make_cache_key(**BASE, index=0, batch_size=1, sampler_kwargs={}, precision='fp32') == key
+    assert make_cache_key(**dict(BASE, steps='50', cfg_scale=7.5)) == key
+
+
+@pytest.mark.parametrize('change', [
+    {'prompt': 'a robot '},
+    {'seed': 43},
+    {'seed': None},
+    {'sampler': 'plms'},
+    {'steps': 51},
+    {'cfg_scale': 7.0},
+    {'ckpt': 'checkpoints/model.safetensors'},
+    {'index': 1},
+    {'batch_size': 2},
+    {'sampler_kwargs': {'feature_reuse': 3}},
+    {'precision': 'fp16'},
+])
+def test_every_setting_changes_the_key(change):
+    assert make_cache_key(**dict(BASE, **change)) != make_cache_key(**BASE)
+
+
+def test_config_is_hashed_by_content(tmp_path):
+    a, b, c = tmp_path / 'a.yaml', tmp_path / 'b.yaml', tmp_path / 'c.yaml'
+    a.write_text('model:\n  scale_factor: 0.5\n')
+    b.write_text('model:\n  scale_factor: 0.5\n')
+    c.write_text('model:\n  scale_factor: 0.25\n')
+    key = make_cache_key(**BASE, config=str(a))
+    assert key != make_cache_key(**BASE)
+    assert make_cache_key(**BASE, config=str(b)) == key
+    assert make_cache_key(**BASE, config=str(c)) != key
+    a.write_text(c.read_text())
+    assert make_cache_key(**BASE, config=str(a)) != key
@@ -0,0 +1,60 @@
+import numpy as np
+import pytest
+import torch
+
+from utility.mesh_extractor import MeshExtractor
+
+ISO = 10.
+
+
+def extract(renderer, triplane, **kwargs):
+    extractor = MeshExtractor(renderer, res=48, iso=ISO, verbose=False, **kwargs)
+    return extractor.extract_geometry(triplane)
+
+
+def test_dense_extraction_finds_the_sphere(sphere_renderer, sphere_triplane):
+    vertices, triangles = extract(sphere_renderer, sphere_triplane)
+    assert len(triangles) > 0
+    # density ISO at radius 0.5 in normalized coordinates, i.e. 0.6 in world units for box_warp 2.4
+    np.testing.assert_allclose(np.linalg.norm(vertices, axis=1), 0.6, atol=0.01)
+
+
+def test_memory_budget_does_not_change_the_mesh(sphere_renderer, sphere_triplane):
+    # 1 MB forces many decoder chunks and density slabs
+    small_budget = extract(sphere_renderer, sphere_triplane, memory_budget_mb=1)
+    large_budget = extract(sphere_renderer, sphere_triplane, memory_budget_mb=4096)
+    np.testing.assert_array_equal(small_budget[0], large_budget[0])
+    np.testing.assert_array_equal(small_budget[1], large_budget[1])
+
+
+def test_query_field_matches_one_decoder_pass(sphere_renderer, sphere_triplane):
+    extractor = MeshExtractor(sphere_renderer, verbose=False, memory_budget_mb=1)
+    coords = torch.rand(3 * extractor.points_per_chunk() + 17, 3) * 2.4 - 1.2
+    chunked = extractor.query_density(sphere_triplane, coords)
+    extractor.memory_budget_mb = 4096
+    assert extractor.points_per_chunk() > coords.shape[0]
+    torch.testing.assert_close(chunked, extractor.query_density(sphere_triplane, coords))
+    assert chunked.shape == (coords.shape[0],)
+
+
+@pytest.mark.parametrize('block_size', [4, 5, 8])
+def test_sparse_matches_dense(sphere_renderer, sphere_triplane, block_size):
+    dense_vertices, dense_triangles = extract(sphere_renderer, sphere_triplane, memory_budget_mb=1)
+    sparse_vertices, sparse_triangles = extract(sphere_renderer, sphere_triplane, memory_budget_mb=1,
+                                                sparse=True, block_size=block_size)
+    assert len(dense_triangles) > 0
+    assert len(sparse_triangles) == len(dense_triangles)
+    assert sparse_vertices.shape == dense_vertices.shape
+
+    def rounded(vertices):
+        vertices = np.round(vertices, 5)
+        return vertices[np.lexsort(vertices.T[::-1])]
+    np.testing.assert_allclose(rounded(sparse_vertices), rounded(dense_vertices), atol=1e-5)
+
+
+def test_sparse_skips_empty_blocks(sphere_renderer, sphere_triplane):
+    extractor = MeshExtractor(sphere_renderer, res=48, iso=ISO, verbose=False, sparse=True)
+    active = extractor.active_blocks(sphere_triplane)
+    _, evaluated = extractor.sparse_density_grid(sphere_triplane, active)
+    assert 0 < active.sum() < active.size
+    assert evaluated < extractor.res ** 3
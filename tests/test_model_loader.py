@@ -0,0 +1,75 @@
+import torch
+import torch.nn as nn
+from safetensors.torch import load_file, save_file
+
+from utility.model_loader import (init_empty_weights, load_model_empty, load_safetensors_model, mmap_safetensors,
+                                  real_weights, safetensors_meta_state_dict)
+
+
+class TinyModel(nn.Module):
+    def __init__(self, width=8, with_head=False):
+        super().__init__()
+        self.linear = nn.Linear(4, width)
+        self.norm = nn.LayerNorm(width)
+        self.register_buffer('scale', torch.arange(width, dtype=torch.float32))
+        if with_head:
+            self.head = nn.Linear(width, 1)
+
+    def forward(self, x):
+        return self.norm(self.linear(x)) * self.scale
+
+
+def save_checkpoint(path, **params):
+    torch.manual_seed(0)
+    state_dict = {k: v.contiguous() for k, v in TinyModel(**params).state_dict().items()}
+    save_file(state_dict, str(path))
+
+
+def test_empty_weights_keep_buffers():
+    register_parameter = nn.Module.register_parameter
+    with init_empty_weights():
+        model = TinyModel()
+        with real_weights():
+            real = nn.Linear(2, 2)
+    assert all(p.is_meta for p in model.parameters())
+    assert not model.scale.is_meta and model.scale[-1].item() == 7.
+    assert not real.weight.is_meta
+    assert nn.Module.register_parameter is register_parameter
+    assert not nn.Linear(2, 2).weight.is_meta
+
+
+def test_mmap_matches_load_file(tmp_path):
+    path = tmp_path / 'tiny.safetensors'
+    save_checkpoint(path)
+    expected = load_file(str(path))
+    mapped = mmap_safetensors(str(path))
+    meta = safetensors_meta_state_dict(str(path))
+    assert mapped.keys() == expected.keys() == meta.keys()
+    for name, tensor in expected.items():
+        assert torch.equal(mapped[name], tensor)
+        assert meta[name].is_meta and meta[name].shape == tensor.shape and meta[name].dtype == tensor.dtype
+
+
+def test_empty_model_round_trip(tmp_path):
+    path = tmp_path / 'tiny.safetensors'
+    save_checkpoint(path)
+    model = load_model_empty(TinyModel, {'width': 8}, str(path))
+    assert model is not None
+    assert not any(t.is_meta for t in model.state_dict().values())
+    for name, tensor in load_file(str(path)).items():
+        assert torch.equal(model.state_dict()[name], tensor)
+
+    x = torch.randn(3, 4)
+    regular = load_safetensors_model(TinyModel, {'width': 8}, str(path), fast=False)
+    fast = load_safetensors_model(TinyModel, {'width': 8}, str(path))
+    assert torch.equal(fast(x), regular(x))
+
+
+def test_empty_model_falls_back(tmp_path, capsys):
+    path = tmp_path / 'tiny.safetensors'
+    save_checkpoint(path)
+    # the checkpoint has no weights for the head
+    assert load_model_empty(TinyModel, {'with_head': True}, str(path)) is None
+    # shape mismatch
+    assert load_model_empty(TinyModel, {'width': 16}, str(path)) is None
+    assert capsys.readouterr().out.count('falling back to regular loading') == 2
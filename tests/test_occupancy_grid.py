@@ -0,0 +1,61 @@
+import torch
+
+RENDER_KWARGS = {
+    'depth_resolution': 32,
+    'disparity_space_sampling': False,
+    'box_warp': 2.4,
+    'depth_resolution_importance': 32,
+    'clamp_mode': 'softplus',
+    'white_back': True,
+    'det': True
+}
+
+
+def front_rays(H=12):
+    """Rays from z = 2 through a square of side 2.4 on the z = 0 plane; the corner rays miss the sphere."""
+    s = torch.linspace(-1.2, 1.2, H)
+    target = torch.stack([s.reshape(-1, 1).expand(H, H), s.reshape(1, -1).expand(H, H), torch.zeros(H, H)], -1)
+    ray_o = torch.tensor([0., 0., 2.]).expand(H * H, 3)
+    ray_d = target.reshape(-1, 3) - ray_o
+    ray_d = ray_d / ray_d.norm(dim=-1, keepdim=True)
+    return ray_o.unsqueeze(0), ray_d.unsqueeze(0)
+
+
+def render(renderer, planes, **options):
+    ray_o, ray_d = front_rays()
+    renderer.decoder.points = 0
+    with torch.no_grad():
+        out = renderer(planes, ray_o, ray_d, dict(RENDER_KWARGS, **options), whole_img=False, tvloss=False)
+    return out['rgb_marched'], renderer.decoder.points
+
+
+def test_grid_marks_the_sphere(sphere_renderer, sphere_triplane):
+    planes = sphere_triplane.reshape(1, 3, 2, 64, 64)
+    grid = sphere_renderer.build_occupancy_grid(planes, RENDER_KWARGS, resolution=16)
+    assert grid.shape == (1, 16, 16, 16) and grid.dtype == torch.bool
+    assert grid[0, 7:9, 7:9, 7:9].all()
+    assert not grid[0, 0, 0, 0] and not grid[0, -1, -1, -1]
+    assert 0 < grid.float().mean() < 0.75
+
+    center = torch.zeros(1, 1, 3)
+    corner = torch.full((1, 1, 3), 1.15)
+    assert sphere_renderer.occupancy_mask(grid, center, 2.4).item()
+    assert not sphere_renderer.occupancy_mask(grid, corner, 2.4).item()
+
+
+def test_occupancy_render_matches_plain_render(sphere_renderer, sphere_triplane):
+    planes = sphere_triplane.reshape(1, 3, 2, 64, 64)
+    grid = sphere_renderer.build_occupancy_grid(planes, RENDER_KWARGS)
+    plain, plain_points = render(sphere_renderer, planes)
+    skipped, skipped_points = render(sphere_renderer, planes, occupancy_grid=grid)
+    torch.testing.assert_close(skipped, plain, rtol=0, atol=1e-3)
+    assert skipped_points < 0.75 * plain_points
+
+
+def test_empty_grid_skips_the_decoder(sphere_renderer, sphere_triplane):
+    planes = sphere_triplane.reshape(1, 3, 2, 64, 64)
+    grid = torch.zeros(1, 64, 64, 64, dtype=torch.bool)
+    rgb, points = render(sphere_renderer, planes, occupancy_grid=grid)
+    assert points == 0
+    # white background everywhere
+    torch.testing.assert_close(rgb, torch.ones_like(rgb), rtol=0, atol=1e-3)
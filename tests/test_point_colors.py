@@ -0,0 +1,47 @@
+import numpy as np
+import trimesh
+
+from utility.mesh_extractor import MeshExtractor
+
+
+def make_extractor(renderer, **kwargs):
+    return MeshExtractor(renderer, res=32, iso=10., verbose=False, **kwargs)
+
+
+def test_normals_point_outwards(sphere_renderer, sphere_triplane):
+    extractor = make_extractor(sphere_renderer)
+    vertices, _ = extractor.extract_geometry(sphere_triplane)
+    normals = extractor.vertex_normals(sphere_triplane, vertices).numpy()
+    radial = vertices / np.linalg.norm(vertices, axis=1, keepdims=True)
+    assert np.allclose(np.linalg.norm(normals, axis=1), 1., atol=1e-5)
+    assert (np.sum(normals * radial, axis=1) > 0.99).all()
+
+
+def test_point_colors_are_rgb(sphere_renderer, sphere_triplane):
+    # SphereDecoder returns (c, 1 - c, 0.5) in the decoder's BGR order
+    extractor = make_extractor(sphere_renderer, color_mode='point')
+    vertices, _ = extractor.extract_geometry(sphere_triplane)
+    for samples in (1, 3):
+        extractor.color_samples = samples
+        rgb = extractor.point_colors(sphere_triplane, vertices)
+        assert rgb.shape == (vertices.shape[0], 3)
+        np.testing.assert_allclose(rgb[:, 0], 0.5, atol=1e-6)
+        np.testing.assert_allclose(rgb[:, 1] + rgb[:, 2], 1., atol=1e-6)
+        assert rgb[:, 2].std() > 0.05
+
+
+def test_point_colors_match_rendered_colors(sphere_renderer, sphere_triplane):
+    extractor = make_extractor(sphere_renderer)
+    vertices, _ = extractor.extract_geometry(sphere_triplane)
+    rendered = extractor.vertex_colors(sphere_triplane, vertices)
+    point = extractor.point_colors(sphere_triplane, vertices)
+    assert np.abs(rendered - point).mean() < 0.05
+
+
+def test_extract_in_point_mode(sphere_renderer, sphere_triplane):
+    mesh = make_extractor(sphere_renderer, color_mode='point').extract(sphere_triplane)
+    assert isinstance(mesh, trimesh.Trimesh)
+    assert len(mesh.faces) > 0
+    colors = mesh.visual.vertex_colors
+    assert colors.shape == (len(mesh.vertices), 4)
+    assert (colors[:, 0] == 127).all()
@@ -0,0 +1,45 @@
+import pytest
+import torch
+
+from utility import device_utils
+from utility.device_utils import PrecisionPolicy
+
+CPU = torch.device('cpu')
+
+
+def matmul_dtype(policy, part):
+    a = torch.randn(4, 8)
+    with policy.autocast(part):
+        return (a @ a.t()).dtype
+
+
+def test_fp32_runs_everything_in_float32():
+    policy = PrecisionPolicy('fp32', CPU)
+    assert not policy.enabled
+    assert all(policy.dtype_for(part) == torch.float32 for part in ('unet', 'vae_decoder', 'clip', 'renderer'))
+    assert matmul_dtype(policy, 'unet') == torch.float32
+
+
+def test_bf16_autocasts_unet_and_decoder_only(monkeypatch):
+    monkeypatch.setattr(device_utils, 'bf16_supported', lambda device=None: True)
+    policy = PrecisionPolicy('bf16', CPU)
+    assert policy.enabled
+    for part in ('unet', 'vae_decoder'):
+        assert policy.dtype_for(part) == torch.bfloat16
+        assert matmul_dtype(policy, part) == torch.bfloat16
+    for part in ('clip', 'schedule', 'renderer', 'density'):
+        assert policy.dtype_for(part) == torch.float32
+        assert matmul_dtype(policy, part) == torch.float32
+
+
+def test_bf16_falls_back_without_hardware_support(monkeypatch, capsys):
+    monkeypatch.setattr(device_utils, 'bf16_supported', lambda device=None: False)
+    policy = PrecisionPolicy('bf16', CPU)
+    assert policy.precision == 'fp32' and not policy.enabled
+    assert "bfloat16 is not supported" in capsys.readouterr().out
+
+
+def test_int8_keeps_float32_activations():
+    assert PrecisionPolicy('int8', CPU).dtype_for('unet') == torch.float32
+    with pytest.raises(AssertionError):
+        PrecisionPolicy('fp16', CPU)
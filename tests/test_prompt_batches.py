@@ -0,0 +1,43 @@
+import pytest
+import torch
+
+from ldm.models.diffusion.ddim import DDIMSampler
+from sample_stage1 import sample_latents, sample_latents_rows
+
+SHAPE = [2, 4, 6]
+STEPS = 6
+
+
+@pytest.fixture
+def model(toy_model):
+    # a prompt encodes to rows filled with its length; decoding doubles the latents
+    toy_model.encoded = []
+
+    def get_learned_conditioning(prompts):
+        toy_model.encoded.append(list(prompts))
+        return torch.stack([torch.full((1, 8), float(len(p))) for p in prompts])
+    toy_model.get_learned_conditioning = get_learned_conditioning
+    toy_model.decode_first_stage = lambda x: x * 2
+    return toy_model
+
+
+@pytest.mark.parametrize('cfg_scale', [1., 5.])
+def test_rows_match_per_prompt_batches(model, cfg_scale):
+    prompts = ['a cat', 'a dog', 'a cat', 'a robot']
+    x_T = torch.randn([len(prompts)] + SHAPE)
+    sampler = DDIMSampler(model)
+    sample, decoded = sample_latents_rows(model, sampler, prompts, STEPS, SHAPE, cfg_scale, x_T=x_T)
+    assert model.encoded == [['a cat', 'a dog', 'a robot']]
+    assert model.calls == STEPS
+    torch.testing.assert_close(decoded, sample * 2)
+
+    for r, prompt in enumerate(prompts):
+        expected, _ = sample_latents(model, sampler, prompt, STEPS, 1, SHAPE, cfg_scale, x_T=x_T[r:r+1])
+        torch.testing.assert_close(sample[r:r+1], expected)
+
+
+def test_progress_reports_every_step(model):
+    events = []
+    sample_latents_rows(model, DDIMSampler(model), ['a', 'b'], STEPS, SHAPE, 3.,
+                        progress=lambda stage, **kwargs: events.append((stage, kwargs.get('step'))))
+    assert events == [('sampling', s) for s in range(STEPS + 1)] + [('decoding', None)]
@@ -0,0 +1,70 @@
+import pytest
+import torch
+import torch.nn as nn
+
+from utility.quantization import (fold_weight_gain, quantization_errors, quantize_linears, record_linear_inputs,
+                                  set_quantized_engine)
+from utility.triplane_renderer.eg3d_renderer import FullyConnectedLayer, Renderer_TriPlane
+
+
+@pytest.fixture(autouse=True)
+def engine():
+    set_quantized_engine()
+
+
+@torch.no_grad()
+def test_fold_weight_gain_matches_fully_connected_layers():
+    torch.manual_seed(0)
+    renderer = Renderer_TriPlane(rgbnet_width=16, sigma_dim=4, c_dim=4)
+    renderer.decoder.sigmanet.append(FullyConnectedLayer(1, 1, lr_multiplier=0.5, bias_init=1.))
+    for m in renderer.modules():
+        if isinstance(m, FullyConnectedLayer):
+            m.bias.normal_()
+    renderer.decoder.rgbnet[0].activation = 'relu'
+    feats = torch.randn(1, 3, 50, 8)
+    expected = renderer.decoder.query_sigma(feats)
+
+    assert fold_weight_gain(renderer) == 6
+    # non-linear activations are left alone
+    assert isinstance(renderer.decoder.rgbnet[0], FullyConnectedLayer)
+    assert type(renderer.decoder.sigmanet[0]) is nn.Linear
+    torch.testing.assert_close(renderer.decoder.query_sigma(feats), expected, rtol=1e-5, atol=1e-5)
+
+
+def mlp():
+    torch.manual_seed(0)
+    return nn.Sequential(nn.Linear(32, 64), nn.SiLU(), nn.Linear(64, 8), nn.SiLU(), nn.Linear(8, 4))
+
+
+def test_record_linear_inputs():
+    module = mlp()
+    x = torch.randn(4, 100, 32)
+    inputs = record_linear_inputs(module, lambda: [module(x) for _ in range(3)], rows_per_call=50, max_rows=120)
+    assert sorted(inputs) == ['0', '2', '4']
+    assert [inputs[n].shape for n in ('0', '2', '4')] == [(120, 32), (120, 64), (120, 8)]
+    assert all(len(m._forward_pre_hooks) == 0 for m in module.modules())
+
+
+@torch.no_grad()
+def test_quantized_layers_stay_within_tolerance():
+    module = mlp()
+    x = torch.randn(256, 32)
+    expected = module(x)
+    errors = quantization_errors(module, record_linear_inputs(module, lambda: module(x)))
+    assert all(0 < e < 0.05 for e in errors.values())
+
+    summary = quantize_linears(module, lambda: module(x), tol=0.05)
+    assert summary['quantized'] == summary['linear_layers'] == 3 and summary['kept_fp32'] == []
+    assert not any(type(m) is nn.Linear for m in module.modules())
+    out = module(x)
+    assert ((out - expected).norm() / expected.norm()).item() < 0.05
+
+
+@torch.no_grad()
+def test_layers_above_tolerance_are_kept():
+    module = mlp()
+    x = torch.randn(256, 32)
+    summary = quantize_linears(module, lambda: module[:3](x), tol=0.)
+    assert summary['quantized'] == 0
+    assert summary['kept_fp32'] == ['0', '2']
+    assert sum(type(m) is nn.Linear for m in module.modules()) == 3
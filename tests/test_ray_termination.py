@@ -0,0 +1,74 @@
+import pytest
+import torch
+
+from utility.triplane_renderer.eg3d_renderer import MipRayMarcher2
+
+RENDER_KWARGS = {
+    'depth_resolution': 48,
+    'disparity_space_sampling': False,
+    'box_warp': 2.4,
+    'depth_resolution_importance': 48,
+    'clamp_mode': 'softplus',
+    'white_back': True,
+    'det': True
+}
+
+
+def front_rays(H=12):
+    """Rays from z = 2 through a square of side 2.4 on the z = 0 plane; the corner rays miss the sphere."""
+    s = torch.linspace(-1.2, 1.2, H)
+    target = torch.stack([s.reshape(-1, 1).expand(H, H), s.reshape(1, -1).expand(H, H), torch.zeros(H, H)], -1)
+    ray_o = torch.tensor([0., 0., 2.]).expand(H * H, 3)
+    ray_d = target.reshape(-1, 3) - ray_o
+    ray_d = ray_d / ray_d.norm(dim=-1, keepdim=True)
+    return ray_o.unsqueeze(0), ray_d.unsqueeze(0)
+
+
+def render(renderer, planes, **options):
+    ray_o, ray_d = front_rays()
+    renderer.decoder.points = 0
+    with torch.no_grad():
+        out = renderer(planes, ray_o, ray_d, dict(RENDER_KWARGS, **options), whole_img=False, tvloss=False)
+    return out, renderer.decoder.points
+
+
+def test_marcher_drops_samples_behind_an_opaque_one():
+    depths = torch.linspace(0, 1, 8).reshape(1, 1, 8, 1)
+    densities = torch.full((1, 1, 8, 1), -5.)
+    densities[:, :, 3:5] = 200.
+    colors = torch.rand(1, 1, 8, 3)
+    options = {'clamp_mode': 'softplus'}
+    _, _, weights = MipRayMarcher2()(colors, densities, depths, options)
+    _, _, terminated = MipRayMarcher2()(colors, densities, depths, dict(options, termination_eps=1e-3))
+    # the interval between samples 2 and 3 is opaque
+    assert (weights[0, 0, 3:] > 0).all()
+    assert (terminated[0, 0, 3:] == 0).all()
+    torch.testing.assert_close(terminated[0, 0, :3], weights[0, 0, :3])
+
+
+def test_zero_eps_is_the_plain_render(sphere_renderer, sphere_triplane):
+    planes = sphere_triplane.reshape(1, 3, 2, 64, 64)
+    plain, plain_points = render(sphere_renderer, planes)
+    off, off_points = render(sphere_renderer, planes, termination_eps=0)
+    assert torch.equal(off['rgb_marched'], plain['rgb_marched'])
+    assert torch.equal(off['depth_final'], plain['depth_final'])
+    assert off_points == plain_points
+
+
+@pytest.mark.parametrize('chunk', [16, 5])
+def test_terminated_render_is_close_with_fewer_points(sphere_renderer, sphere_triplane, chunk):
+    planes = sphere_triplane.reshape(1, 3, 2, 64, 64)
+    plain, plain_points = render(sphere_renderer, planes)
+    terminated, terminated_points = render(sphere_renderer, planes, termination_eps=1e-3, termination_chunk=chunk)
+    torch.testing.assert_close(terminated['rgb_marched'], plain['rgb_marched'], rtol=0, atol=5e-3)
+    torch.testing.assert_close(terminated['depth_final'], plain['depth_final'], rtol=0, atol=2e-2)
+    assert terminated_points < plain_points
+
+
+def test_termination_with_occupancy(sphere_renderer, sphere_triplane):
+    planes = sphere_triplane.reshape(1, 3, 2, 64, 64)
+    grid = sphere_renderer.build_occupancy_grid(planes, RENDER_KWARGS)
+    plain, plain_points = render(sphere_renderer, planes)
+    both, both_points = render(sphere_renderer, planes, termination_eps=1e-3, occupancy_grid=grid)
+    torch.testing.assert_close(both['rgb_marched'], plain['rgb_marched'], rtol=0, atol=5e-3)
+    assert both_points < plain_points
@@ -0,0 +1,51 @@
+import pytest
+import torch
+
+from ldm.models.diffusion.dpm_solver import DPMSolverSampler
+from ldm.models.diffusion.uni_pc import UniPCSampler
+
+SHAPE = [2, 4, 6]
+
+
+@pytest.mark.parametrize('sampler_cls, order', [
+    (DPMSolverSampler, 2),
+    (DPMSolverSampler, 3),
+    (UniPCSampler, 2),
+])
+def test_solver_callback_once_per_step(toy_model, sampler_cls, order):
+    steps = 8
+    calls = []
+    c = torch.ones(1, 1, 8)
+    sampler_cls(toy_model, order=order).sample(S=steps, batch_size=1, shape=SHAPE, conditioning=c,
+                                               unconditional_conditioning=torch.zeros_like(c),
+                                               unconditional_guidance_scale=3., verbose=False,
+                                               x_T=torch.randn([1] + SHAPE), callback=calls.append)
+    assert calls == list(range(steps))
+
+
+@pytest.mark.parametrize('name, sampler_cls, steps, order', [
+    ('dpm++2m', DPMSolverSampler, 15, 2),
+    ('dpm++3m', DPMSolverSampler, 10, 3),
+    ('unipc', UniPCSampler, 10, 2),
+])
+def test_presets(toy_model, name, sampler_cls, steps, order):
+    from sample_stage1 import get_sampler, resolve_steps
+    assert resolve_steps(name) == steps
+    assert resolve_steps(name, 25) == 25
+    sampler = get_sampler(toy_model, name)
+    assert type(sampler) is sampler_cls
+    assert (sampler.order, sampler.skip_type) == (order, 'logSNR')
+
+    c = torch.ones(1, 1, 8)
+    sample, _ = sampler.sample(S=steps, batch_size=1, shape=SHAPE, conditioning=c, verbose=False,
+                               x_T=torch.randn([1] + SHAPE))
+    assert sample.shape == tuple([1] + SHAPE)
+    assert torch.isfinite(sample).all()
+    # one model evaluation per step, the multistep solvers reuse earlier ones
+    assert sampler.nfe == steps
+
+
+def test_default_steps():
+    from sample_stage1 import resolve_steps
+    assert resolve_steps('ddim') == 1000
+    assert resolve_steps('ddpm', 50) == 50
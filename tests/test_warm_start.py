@@ -0,0 +1,33 @@
+import pytest
+import torch
+
+from ldm.models.diffusion.ddim import DDIMSampler
+from utility.refinement_mps import warm_start_latent
+
+SHAPE = [2, 4, 6]
+STEPS = 20
+
+
+def warm_start(model, latent, strength):
+    cond = torch.ones(1, 1, 8)
+    return warm_start_latent(DDIMSampler(model), latent, cond, torch.zeros_like(cond), STEPS, strength,
+                             cfg_scale=3., verbose=False)
+
+
+@pytest.mark.parametrize('strength, denoising_steps', [(0.5, 10), (0., 1), (0.01, 1), (1., STEPS), (2., STEPS)])
+def test_only_the_remaining_steps_are_run(toy_model, strength, denoising_steps):
+    latent = torch.randn([3] + SHAPE)
+    out = warm_start(toy_model, latent, strength)
+    assert out.shape == latent.shape
+    assert torch.isfinite(out).all()
+    # one batched CFG call per step
+    assert toy_model.calls == denoising_steps
+
+
+def test_low_strength_keeps_the_latent(toy_model):
+    latent = torch.randn([2] + SHAPE)
+    torch.manual_seed(0)
+    low = warm_start(toy_model, latent, 0.1)
+    torch.manual_seed(0)
+    high = warm_start(toy_model, latent, 0.9)
+    assert (low - latent).abs().mean() < (high - latent).abs().mean()
@@ -0,0 +1,105 @@
+"""Attention backends shared by the UNet, cross-attention and VAE attention layers."""
+import os
+import math
+import torch
+import torch.nn.functional as F
+
+BACKENDS = ['auto', 'sdpa', 'chunked', 'math']
+
+# max entries of the attention matrix materialized at once by the chunked backend (128 MB in fp32)
+DEFAULT_CHUNK_BUDGET = 2**25
+
+_backend = os.environ.get('HEPHAESTUS_ATTENTION', 'auto')
+_chunk_budget = DEFAULT_CHUNK_BUDGET
+_sdpa_failed = False
+
+
+def set_attention_backend(name='auto', chunk_budget=None):
+    """
+    Select the attention implementation for this process (default from $HEPHAESTUS_ATTENTION).
+
+    Args:
+        name: 'sdpa' (torch scaled_dot_product_attention, fused and memory-efficient where the
+            build supports it), 'chunked' (query-tiled, the attention matrix is never
+            materialized in full), 'math' (the reference einsum + softmax) or 'auto' (sdpa when
+            available, else chunked for large attention matrices)
+        chunk_budget: Max attention matrix entries per tile for the chunked backend
+    """
+    global _backend, _chunk_budget
+    assert name in BACKENDS, f"attention backend must be one of {BACKENDS}, got {name}"
+    _backend = name
+    if chunk_budget is not None:
+        _chunk_budget = chunk_budget
+
+
+def get_attention_backend():
+    return _backend
+
+
+def sdpa_available():
+    return hasattr(F, 'scaled_dot_product_attention')
+
+
+def math_attention(q, k, v, scale, mask=None):
+    sim = torch.bmm(q, k.transpose(1, 2)) * scale
+    if mask is not None:
+        sim = sim.masked_fill(~mask, -torch.finfo(sim.dtype).max)
+    # softmax in fp32, as the UNet attention always did for fp16
+    attn = sim.float().softmax(dim=-1).type(v.dtype)
+    return torch.bmm(attn, v)
+
+
+def chunked_attention(q, k, v, scale, mask=None):
+    b, n, _ = q.shape
+    m = k.shape[1]
+    tile = max(1, _chunk_budget // max(1, b * m))
+    if tile >= n:
+        return math_attention(q, k, v, scale, mask)
+    out = torch.empty(b, n, v.shape[-1], dtype=v.dtype, device=v.device)
+    for i in range(0, n, tile):
+        mask_i = mask if mask is None or mask.shape[-2] == 1 else mask[:, i:i+tile]
+        out[:, i:i+tile] = math_attention(q[:, i:i+tile], k, v, scale, mask_i)
+    return out
+
+
+def sdpa_attention(q, k, v, scale, mask=None):
+    # pre-scale q instead of passing scale=, which older torch versions do not accept
+    default_scale = q.shape[-1] ** -0.5
+    if not math.isclose(scale, default_scale):
+        q = q * (scale / default_scale)
+    return F.scaled_dot_product_attention(q, k, v, attn_mask=mask)
+
+
+def attention(q, k, v, scale=None, mask=None):
+    """
+    softmax(q k^T * scale) v with the selected backend.
+
+    Args:
+        q: [B, N, D] queries
+        k, v: [B, M, D] keys and values
+        scale: Logit scale (default 1 / sqrt(D))
+        mask: Optional bool mask broadcastable to [B, N, M], True where attention is allowed
+
+    Returns:
+        [B, N, D] tensor
+    """
+    global _sdpa_failed
+    if scale is None:
+        scale = q.shape[-1] ** -0.5
+    backend = _backend
+    if backend == 'auto':
+        if sdpa_available() and not _sdpa_failed:
+            backend = 'sdpa'
+        else:
+            backend = 'chunked'
+    if backend == 'sdpa':
+        if sdpa_available() and not _sdpa_failed:
+            try:
+                return sdpa_attention(q, k, v, scale, mask)
+            except RuntimeError as e:
+                _sdpa_failed = True
+                print(f"⚠ Warning: scaled_dot_product_attention failed ({e}), using chunked attention")
+        backend = 'chunked'
+    if backend == 'chunked':
+        return chunked_attention(q, k, v, scale, mask)
+    return math_attention(q, k, v, scale, mask)
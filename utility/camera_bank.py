@@ -0,0 +1,110 @@
+"""Packed camera poses and on-demand ray generation for preview rendering."""
+import os
+import json
+import functools
+import numpy as np
+import torch
+
+from utility.triplane_renderer.renderer import get_rays
+
+POSE_FOLDER = 'assets/sample_data/pose'
+POSE_BANK = 'assets/sample_data/pose_bank.npy'  # default_bank_path(POSE_FOLDER)
+THUMBNAIL_VIEW = 104
+
+# Swaps the y and z axes of the dataset poses into the triplane frame
+AXIS_SWAP = np.array([
+    [1, 0, 0, 0],
+    [0, 0, -1, 0],
+    [0, 1, 0, 0],
+    [0, 0, 0, 1]
+])
+
+
+def default_bank_path(pose_folder):
+    """
+    Bank file next to the pose folder, e.g. assets/sample_data/pose -> assets/sample_data/pose_bank.npy.
+    """
+    return os.path.normpath(pose_folder) + '_bank.npy'
+
+
+def pose_folder_signature(poses_fname):
+    """
+    Sorted pose file names and their latest mtime; the bank is rebuilt when either changes.
+    """
+    return {
+        'files': [os.path.basename(p) for p in poses_fname],
+        'mtime_ns': max((os.stat(p).st_mtime_ns for p in poses_fname), default=0),
+    }
+
+
+@functools.lru_cache(maxsize=4)
+def load_pose_bank(pose_folder=POSE_FOLDER, bank_path='auto'):
+    """
+    Load all camera-to-world matrices as one [V, 4, 4] array.
+
+    The packed bank file ('auto': default_bank_path(pose_folder), None: never written) is used
+    when the signature stored next to it (<bank>.json) matches the pose files; otherwise the
+    individual pose files are parsed once and the bank is written for next time.
+    """
+    if bank_path == 'auto':
+        bank_path = default_bank_path(pose_folder)
+    poses_fname = sorted([os.path.join(pose_folder, f) for f in os.listdir(pose_folder)])
+    signature = pose_folder_signature(poses_fname)
+    signature_path = f"{bank_path}.json" if bank_path is not None else None
+    if bank_path is not None and os.path.exists(bank_path) and os.path.exists(signature_path):
+        try:
+            with open(signature_path) as f:
+                stored = json.load(f)
+            if stored == signature:
+                return np.load(bank_path)
+        except (OSError, ValueError) as e:
+            print(f"⚠ Warning: Could not read camera bank {bank_path}: {e}")
+
+    bank = np.stack([np.loadtxt(p).reshape(4, 4) for p in poses_fname], 0)
+    if bank_path is not None:
+        try:
+            np.save(bank_path, bank)
+            with open(signature_path, 'w') as f:
+                json.dump(signature, f)
+        except OSError as e:
+            print(f"⚠ Warning: Could not write camera bank {bank_path}: {e}")
+    return bank
+
+
+def num_views(pose_folder=POSE_FOLDER):
+    return load_pose_bank(pose_folder).shape[0]
+
+
+@functools.lru_cache(maxsize=512)
+def view_rays(view, H, pose_folder=POSE_FOLDER):
+    """
+    Rays of one view at resolution H x H.
+
+    Returns:
+        Tensor [2, H*H, 3] of ray origins and directions (CPU)
+    """
+    c2w = load_pose_bank(pose_folder)[view].copy()
+    c2w[:3, 3] *= 2.2
+    c2w = AXIS_SWAP @ c2w
+
+    ratio = 512 // H
+    k = np.array([
+        [560 / ratio, 0, H * 0.5],
+        [0, 560 / ratio, H * 0.5],
+        [0, 0, 1]
+    ])
+
+    rays_o, rays_d = get_rays(H, H, torch.Tensor(k), torch.Tensor(c2w[:3, :4]))
+    rays_o = rays_o.reshape(-1, 3)
+    rays_d = rays_d.reshape(-1, 3)
+    return torch.stack([rays_o, rays_d], 0)
+
+
+def get_view_rays(views, H, pose_folder=POSE_FOLDER):
+    """
+    Rays of the requested views, built on demand and cached per (view, resolution).
+
+    Returns:
+        Tensor [V, 2, H*H, 3]
+    """
+    return torch.stack([view_rays(int(v), H, pose_folder) for v in views], 0)
@@ -0,0 +1,211 @@
+"""Opt-in compiled graphs for the fixed-shape inference paths: UNet, VAE decoder and triplane MLP."""
+import time
+import inspect
+import threading
+import torch
+
+BACKENDS = ['compile', 'trace']
+
+# TriPlane_Decoder_Decompose.forward evaluates the MLP in chunks of this many points
+DECODER_CHUNK = 256 * 256
+
+
+def compile_available():
+    return hasattr(torch, 'compile')
+
+
+class CompiledForward(object):
+    """
+    Replaces module.<method> with a dispatcher that runs a compiled graph per input signature
+    (tensor shapes and dtypes, i.e. batch size and dtype for the fixed-shape sampling paths).
+    Graphs are built on first use; calls that `accept` rejects, failed builds and signatures
+    beyond `max_graphs` run the original method.
+
+    Args:
+        module: Module owning the method
+        method: Name of the method to replace ('forward' or '_forward')
+        backend: 'compile' (torch.compile, falling back to trace if it fails) or 'trace' (torch.jit.trace)
+        accept: Optional predicate accept(args, kwargs) deciding whether a call may use a graph
+        max_graphs: Max number of cached graphs
+        name: Name used in log messages
+    """
+    def __init__(self, module, method='forward', backend='compile', accept=None, max_graphs=4, name=None):
+        assert backend in BACKENDS, f"compile backend must be one of {BACKENDS}, got {backend}"
+        self.module = module
+        self.method = method
+        self.eager = getattr(module, method)
+        self.signature = inspect.signature(self.eager)
+        self.backend = backend
+        self.accept = accept
+        self.max_graphs = max_graphs
+        self.name = name or type(module).__name__
+        self.graphs = {}
+        self.compiled = None
+        self.lock = threading.Lock()
+        # an instance attribute shadows the class method, so module(...) dispatches here
+        setattr(module, method, self)
+
+    def remove(self):
+        """
+        Restore the original method and drop the graphs.
+        """
+        if self.module.__dict__.get(self.method) is self:
+            del self.module.__dict__[self.method]
+        self.graphs = {}
+        self.compiled = None
+
+    def bind(self, args, kwargs):
+        """
+        Positional tensors of a call in signature order, or None if it has other non-None arguments.
+        """
+        bound = self.signature.bind(*args, **kwargs)
+        names = []
+        tensors = []
+        for name, value in bound.arguments.items():
+            if torch.is_tensor(value):
+                names.append(name)
+                tensors.append(value)
+            elif value is not None and value != {}:
+                return None, None
+        return tuple(names), tuple(tensors)
+
+    def build(self, names, tensors, args, kwargs):
+        """
+        Returns:
+            (graph, kind), or (False, None) when no graph can serve the call
+        """
+        eager = self.eager
+        if self.backend == 'compile':
+            try:
+                if self.compiled is None:
+                    # one compiled function, specialized (dynamic=False) per signature by torch.compile
+                    self.compiled = torch.compile(eager, dynamic=False)
+                compiled = self.compiled
+
+                def graph(*tensors):
+                    return compiled(**dict(zip(names, tensors)))
+                # torch.compile compiles lazily, so failures only show up on the first call
+                graph(*tensors)
+                return graph, 'compile'
+            except Exception as e:
+                print(f"⚠ Warning: torch.compile failed for {self.name} ({type(e).__name__}: {e}), tracing instead")
+                self.backend = 'trace'
+                if self.accept is not None and not self.accept(args, kwargs):
+                    return False, None
+
+        def fn(*tensors):
+            return eager(**dict(zip(names, tensors)))
+        return torch.jit.trace(fn, tensors, check_trace=False, strict=False), 'trace'
+
+    def __call__(self, *args, **kwargs):
+        if self.accept is not None and not self.accept(args, kwargs):
+            return self.eager(*args, **kwargs)
+        names, tensors = self.bind(args, kwargs)
+        if names is None:
+            return self.eager(*args, **kwargs)
+        key = (names, tuple((tuple(t.shape), t.dtype, t.device.type) for t in tensors))
+        graph = self.graphs.get(key)
+        if graph is None:
+            with self.lock:
+                if key not in self.graphs:
+                    if len(self.graphs) >= self.max_graphs:
+                        return self.eager(*args, **kwargs)
+                    start = time.time()
+                    try:
+                        with torch.no_grad():
+                            graph, kind = self.build(names, tensors, args, kwargs)
+                        if graph is not False:
+                            print(f"✓ {self.name}: {kind} graph for {[tuple(t.shape) for t in tensors]} "
+                                  f"built in {time.time() - start:.1f}s")
+                    except Exception as e:
+                        print(f"⚠ Warning: could not build a graph for {self.name} ({type(e).__name__}: {e}), running eagerly")
+                        graph = False
+                    self.graphs[key] = graph
+                graph = self.graphs[key]
+        if graph is False:
+            return self.eager(*args, **kwargs)
+        return graph(*tensors)
+
+
+def unet_accepts(unet, wrapper):
+    """
+    The UNet graph is only valid for the plain inference path: no gradients, inference mode
+    (checkpointing bypassed) and feature reuse off. Traced graphs also bake in Python-side state,
+    so they are not used while the cross-attention context cache is on.
+    """
+    blocks = [m for m in unet.modules() if hasattr(type(m), 'inference')]
+    cached = [m for m in unet.modules() if hasattr(m, 'cache_context')]
+
+    def accept(args, kwargs):
+        if torch.is_grad_enabled() or getattr(unet, 'reuse_interval', 0) > 1:
+            return False
+        if blocks and not blocks[0].inference:
+            return False
+        return wrapper.backend != 'trace' or not any(m.cache_context for m in cached)
+    return accept
+
+
+def no_grad_only(args, kwargs):
+    return not torch.is_grad_enabled()
+
+
+def decoder_chunk_only(args, kwargs):
+    # full chunks only, the remainders and occupancy-masked batches vary in size
+    features = args[0] if args else kwargs.get('sampled_features')
+    return not torch.is_grad_enabled() and features.shape[-2] == DECODER_CHUNK
+
+
+def compile_model(model, backend='compile'):
+    """
+    Compile the UNet, the VAE decoder and the triplane MLP of a LatentDiffusion model. Graphs are
+    built lazily per (batch size, dtype); call warmup_compiled to build them up front.
+
+    Returns:
+        dict of name -> CompiledForward
+    """
+    if backend == 'compile' and not compile_available():
+        print("⚠ Warning: torch.compile is not available in this torch version, using torch.jit.trace")
+        backend = 'trace'
+    unet = model.model.diffusion_model
+    compiled = {'unet': CompiledForward(unet, 'forward', backend, name='UNet')}
+    compiled['unet'].accept = unet_accepts(unet, compiled['unet'])
+    first_stage = model.first_stage_model
+    if hasattr(first_stage, 'decoder'):
+        compiled['vae_decoder'] = CompiledForward(first_stage.decoder, 'forward', backend,
+                                                  accept=no_grad_only, name='VAE decoder')
+    mlp = getattr(getattr(first_stage, 'triplane_decoder', None), 'decoder', None)
+    if mlp is not None and hasattr(mlp, '_forward'):
+        compiled['triplane_mlp'] = CompiledForward(mlp, '_forward', backend,
+                                                   accept=decoder_chunk_only, name='Triplane MLP')
+    print(f"✓ Compiling {', '.join(compiled)} with {backend} (graphs are built on first use)")
+    return compiled
+
+
+@torch.no_grad()
+def warmup_compiled(model, compiled, latent_shape, batch_sizes=(1,), guided=True):
+    """
+    Build the graphs used by sampling batch_sizes samples of latent_shape ([C, H, W]), with and
+    without classifier-free guidance (which doubles the UNet batch).
+    """
+    start = time.time()
+    device = model.device
+    unet = model.model.diffusion_model
+    dtype = next(unet.parameters()).dtype
+    context = model.get_learned_conditioning([''])
+    unet_batches = sorted(set(b * k for b in batch_sizes for k in ((1, 2) if guided else (1,))))
+    with model.inference_mode():
+        for b in unet_batches:
+            x = torch.zeros([b] + list(latent_shape), device=device, dtype=dtype)
+            t = torch.full((b,), model.num_timesteps - 1, device=device, dtype=torch.long)
+            model.apply_model(x, t, context.repeat(b, 1, 1))
+    for b in batch_sizes:
+        z = torch.zeros([b] + list(latent_shape), device=device, dtype=dtype)
+        if 'vae_decoder' in compiled:
+            # under the same autocast as decode_first_stage, so the graph matches the precision policy
+            with model.autocast('vae_decoder'):
+                model.first_stage_model.decoder(z)
+    if 'triplane_mlp' in compiled:
+        mlp = compiled['triplane_mlp'].module
+        features = torch.zeros(1, 3, DECODER_CHUNK, mlp.sigma_dim + mlp.c_dim, device=device, dtype=dtype)
+        mlp._forward(features)
+    print(f"✓ Compiled graphs warmed up in {time.time() - start:.1f}s")
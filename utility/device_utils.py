@@ -1,6 +1,13 @@
 """Device utilities for Mac MPS support with float16."""
+from contextlib import nullcontext
+
 import torch
 
+PRECISIONS = ['fp32', 'bf16', 'int8']
+
+# parts of the model that run in bfloat16 under --precision bf16, everything else stays float32
+BF16_PARTS = ('unet', 'vae_decoder')
+
 def get_device(prefer_mps=True):
     """
     Get the best available device, preferring MPS on Mac.
@@ -90,3 +97,75 @@ def to_device(tensor_or_module, device=None, dtype=None):
     
     return result
 
+
+def bf16_supported(device=None):
+    """
+    Check whether bfloat16 matmuls and convolutions are fast on the device.
+    On CPU this needs native bf16 instructions (AVX512-BF16 or AMX), otherwise they are emulated.
+
+    Args:
+        device: torch.device or None (will auto-detect)
+
+    Returns:
+        bool
+    """
+    if device is None:
+        device = get_device()
+
+    if device.type == "cuda":
+        return torch.cuda.is_bf16_supported()
+    elif device.type == "cpu":
+        try:
+            return bool(torch.ops.mkldnn._is_mkldnn_bf16_supported())
+        except (AttributeError, RuntimeError):
+            pass
+        try:
+            with open('/proc/cpuinfo') as f:
+                flags = f.read()
+        except OSError:
+            return False
+        return 'avx512_bf16' in flags or 'amx_bf16' in flags
+    else:
+        # MPS autocast only supports float16
+        return False
+
+class PrecisionPolicy(object):
+    """
+    Per-module dtype selection. With 'bf16' the UNet and the VAE decoder run under bfloat16
+    autocast; the sampler schedules, the triplane renderer and density thresholding stay in
+    float32, and autocast outputs are cast back to float32 before they reach them.
+    'int8' (dynamic quantization, see utility/quantization.py) uses float32 activations.
+
+    Args:
+        precision: One of PRECISIONS
+        device: torch.device or None (will auto-detect)
+    """
+    def __init__(self, precision='fp32', device=None):
+        assert precision in PRECISIONS, f"precision must be one of {PRECISIONS}, got {precision}"
+        if device is None:
+            device = get_device()
+        self.device = device
+        self.precision = precision
+        if precision == 'bf16' and not bf16_supported(device):
+            print(f"⚠ Warning: bfloat16 is not supported on this {device.type} device, using fp32")
+            self.precision = 'fp32'
+
+    @property
+    def enabled(self):
+        return self.precision == 'bf16'
+
+    def dtype_for(self, part):
+        """
+        Compute dtype of a model part ('unet', 'vae_decoder', 'clip', 'schedule', 'renderer', 'density').
+        """
+        if self.enabled and part in BF16_PARTS:
+            return torch.bfloat16
+        return torch.float32
+
+    def autocast(self, part):
+        """
+        Autocast context for a model part, a no-op for parts that run in float32.
+        """
+        if self.dtype_for(part) == torch.float32:
+            return nullcontext()
+        return torch.autocast(device_type=self.device.type, dtype=self.dtype_for(part))
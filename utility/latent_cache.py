@@ -0,0 +1,132 @@
+"""Content-addressed cache of sampled latents and decoded triplanes."""
+import os
+import json
+import hashlib
+import numpy as np
+import torch
+
+DEFAULT_CKPT_ID = 'hongfz16/3DTopia/model.safetensors'
+
+def checkpoint_id(ckpt):
+    """
+    Identify a checkpoint for cache keys. None means the default Hugging Face checkpoint.
+    """
+    if ckpt is None:
+        return DEFAULT_CKPT_ID
+    return os.path.abspath(ckpt)
+
+def config_id(config):
+    """
+    Identify a model config for cache keys by its contents, so configs sharing a checkpoint never collide.
+    """
+    try:
+        with open(config, 'rb') as f:
+            return hashlib.sha256(f.read()).hexdigest()[:16]
+    except OSError:
+        return os.path.abspath(config)
+
+def make_cache_key(prompt, seed, sampler, steps, cfg_scale, ckpt, index=0, batch_size=1, sampler_kwargs=None,
+                   precision='fp32', config=None):
+    """
+    Hash the settings that determine a sampled latent.
+
+    Args:
+        prompt: Text prompt
+        seed: Random seed (None means the sample is not reproducible)
+        sampler: Sampler name
+        steps: Sampling steps
+        cfg_scale: Classifier-free guidance scale
+        ckpt: Checkpoint path or None for the default checkpoint
+        index: Sample index within the run
+        batch_size: Batch size used when sampling
+        sampler_kwargs: Extra sampler options that change the result (e.g. feature reuse)
+        precision: Inference precision (see --precision)
+        config: Model config path (hashed by content)
+
+    Returns:
+        Hex digest string
+    """
+    settings = {
+        'prompt': prompt,
+        'seed': seed,
+        'sampler': sampler,
+        'steps': int(steps),
+        'cfg_scale': float(cfg_scale),
+        'ckpt': checkpoint_id(ckpt),
+        'index': int(index),
+        'batch_size': int(batch_size),
+    }
+    # only hashed when set, so keys of plain runs stay the same
+    if sampler_kwargs:
+        settings['sampler_kwargs'] = sampler_kwargs
+    if precision != 'fp32':
+        settings['precision'] = precision
+    if config is not None:
+        settings['config'] = config_id(config)
+    payload = json.dumps(settings, sort_keys=True)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()[:32]
+
+def save_cache_entry(path, latent, triplane=None, meta=None):
+    """
+    Save a latent (float32) and optionally its decoded triplane (float16) to a compressed .npz.
+    """
+    arrays = {'latent': latent.detach().float().cpu().numpy()}
+    if triplane is not None:
+        arrays['triplane'] = triplane.detach().cpu().numpy().astype(np.float16)
+    arrays['meta'] = np.array(json.dumps(meta or {}))
+    tmp_path = path + '.tmp.npz'
+    np.savez_compressed(tmp_path, **arrays)
+    os.replace(tmp_path, path)
+    return path
+
+def load_cache_entry(path, device=None, dtype=torch.float32):
+    """
+    Load a cache entry written by save_cache_entry. Plain .npy latents are accepted as well.
+
+    Returns:
+        dict with 'latent', 'triplane' (None if not stored) and 'meta'
+    """
+    if path.endswith('.npy'):
+        latent = torch.from_numpy(np.load(path)).to(device=device, dtype=dtype)
+        return {'latent': latent, 'triplane': None, 'meta': {}}
+
+    with np.load(path) as data:
+        latent = torch.from_numpy(data['latent']).to(device=device, dtype=dtype)
+        triplane = None
+        if 'triplane' in data.files:
+            triplane = torch.from_numpy(data['triplane'].astype(np.float32)).to(device=device, dtype=dtype)
+        meta = json.loads(str(data['meta'])) if 'meta' in data.files else {}
+    return {'latent': latent, 'triplane': triplane, 'meta': meta}
+
+def list_cache_entries(path):
+    """
+    Expand a cache file or directory into a sorted list of entry paths.
+    """
+    if os.path.isdir(path):
+        return sorted([
+            os.path.join(path, f) for f in os.listdir(path)
+            if f.endswith('.npz') and not f.endswith('.tmp.npz')
+        ])
+    return [path]
+
+class LatentCache:
+    """
+    Directory of .npz entries keyed by make_cache_key().
+    """
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def path(self, key):
+        return os.path.join(self.cache_dir, f"{key}.npz")
+
+    def exists(self, key):
+        return os.path.exists(self.path(key))
+
+    def load(self, key, device=None, dtype=torch.float32):
+        if not self.exists(key):
+            return None
+        return load_cache_entry(self.path(key), device, dtype)
+
+    def save(self, key, latent, triplane=None, meta=None):
+        return save_cache_entry(self.path(key), latent, triplane, meta)
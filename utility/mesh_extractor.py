@@ -0,0 +1,470 @@
+"""Bounded-memory marching cubes and vertex coloring for triplane models."""
+import numpy as np
+import torch
+import mcubes
+import trimesh
+from tqdm import tqdm
+
+from utility.device_utils import empty_cache
+from utility.triplane_renderer.eg3d_renderer import sample_from_planes, generate_planes
+
+# Six axis-aligned camera positions used to color vertices
+COLOR_RAY_ORIGINS = [
+    [0, 0, 2],
+    [0, 0, -2],
+    [0, 2, 0],
+    [0, -2, 0],
+    [2, 0, 0],
+    [-2, 0, 0],
+]
+
+COLOR_RENDER_KWARGS = {
+    'depth_resolution': 128,
+    'disparity_space_sampling': False,
+    'box_warp': 2.4,
+    'depth_resolution_importance': 128,
+    'clamp_mode': 'softplus',
+    'white_back': True,
+    'det': True
+}
+
+
+class MeshExtractor:
+    """
+    Extract a colored mesh from a decoded triplane.
+
+    The density grid is evaluated in x-slabs and vertex colors in chunks of rays so that
+    peak memory stays close to memory_budget_mb regardless of the marching cubes resolution.
+
+    Args:
+        renderer: Renderer_TriPlane (e.g. model.first_stage_model.triplane_decoder)
+        res: Marching cubes grid resolution per axis
+        iso: Density iso-level for marching cubes
+        bound: Half size of the extraction box
+        box_warp: Triplane box size used when sampling features
+        memory_budget_mb: Approximate working memory for one decoder pass
+        device: torch.device the triplane lives on
+        verbose: Show progress bars
+        sparse: Evaluate the full-resolution grid only near the surface (coarse-to-fine)
+        block_size: Cells per block edge for sparse extraction
+        dilation: Extra rings of blocks kept around the coarse surface estimate
+        color_mode: 'render' (six-view volume rendering) or 'point' (direct rgb query near each vertex)
+        color_offset: Outward offset of the point query, in voxels
+        color_samples: Number of normal-offset samples blended in point mode
+        occupancy: Skip empty space with an occupancy grid shared by the six coloring passes
+        termination_eps: Early ray termination threshold for the coloring passes (0 disables)
+    """
+    def __init__(self, renderer, res=128, iso=10, bound=1.2, box_warp=2.4,
+                 memory_budget_mb=2048, device=None, verbose=True,
+                 sparse=False, block_size=8, dilation=1,
+                 color_mode='render', color_offset=0.5, color_samples=1, occupancy=False,
+                 termination_eps=0.):
+        assert color_mode in ('render', 'point'), f"Unknown color mode: {color_mode}"
+        self.renderer = renderer
+        self.res = res
+        self.iso = iso
+        self.bound = bound
+        self.box_warp = box_warp
+        self.memory_budget_mb = memory_budget_mb
+        self.device = device
+        self.verbose = verbose
+        self.sparse = sparse
+        self.block_size = block_size
+        self.dilation = dilation
+        self.color_mode = color_mode
+        self.color_offset = color_offset
+        self.color_samples = color_samples
+        self.occupancy = occupancy
+        self.termination_eps = termination_eps
+        self.plane_axes = generate_planes()
+
+    def points_per_chunk(self):
+        """
+        Number of points one decoder pass can handle within the memory budget.
+        """
+        feat_dim = 32
+        width = 128
+        if hasattr(self.renderer.decoder, 'sigma_dim'):
+            feat_dim = self.renderer.decoder.sigma_dim + self.renderer.decoder.c_dim
+        # coordinates + sampled features (grid_sample output and its permuted copy) + MLP activations
+        bytes_per_point = 4 * (3 + 2 * 3 * feat_dim + 4 * width)
+        return max(4096, int(self.memory_budget_mb * 1024 * 1024 // bytes_per_point))
+
+    def _planes(self, triplane):
+        return triplane.reshape(1, 3, -1, triplane.shape[-2], triplane.shape[-1])
+
+    def query_field(self, triplane, coords, field='sigma'):
+        """
+        Evaluate the triplane decoder at arbitrary points.
+
+        Only the requested branch is run when the decoder supports it (TriPlane_Decoder_Decompose).
+
+        Args:
+            triplane: Decoded triplane [1, 3*C, H, W]
+            coords: Points [N, 3] on the triplane device
+            field: 'sigma' or 'rgb'
+
+        Returns:
+            float32 tensor [N] for sigma, [N, 3] for rgb
+        """
+        planes = self._planes(triplane)
+        decoder = self.renderer.decoder
+        chunk = self.points_per_chunk()
+        dim = 1 if field == 'sigma' else 3
+        res = []
+        with torch.no_grad():
+            for p in range(0, coords.shape[0], chunk):
+                c = coords[p:p+chunk].to(planes.dtype).unsqueeze(0)
+                feats = sample_from_planes(self.plane_axes, planes, c, padding_mode='zeros', box_warp=self.box_warp)
+                if field == 'sigma' and hasattr(decoder, 'query_sigma'):
+                    out = decoder.query_sigma(feats)
+                elif field == 'rgb' and hasattr(decoder, 'query_rgb'):
+                    out = decoder.query_rgb(feats)
+                else:
+                    fake_dirs = torch.zeros_like(c)
+                    fake_dirs[..., 0] = 1
+                    out = decoder(feats, fake_dirs)[field]
+                res.append(out.reshape(-1, dim).float())
+                del feats, out
+        if len(res) == 0:
+            return torch.zeros((0,) if dim == 1 else (0, dim), device=coords.device)
+        res = torch.cat(res, 0)
+        return res.reshape(-1) if dim == 1 else res
+
+    def query_density(self, triplane, coords):
+        return self.query_field(triplane, coords, 'sigma')
+
+    def query_color(self, triplane, coords):
+        return self.query_field(triplane, coords, 'rgb')
+
+    def grid_coords(self):
+        return torch.linspace(-self.bound, self.bound, steps=self.res, dtype=torch.float32)
+
+    def lattice_density(self, triplane, xi, yi, zi, desc='Density grid'):
+        """
+        Evaluate density on the tensor-product lattice of fine grid indices xi × yi × zi,
+        one x-slab at a time.
+
+        Returns:
+            float32 numpy array [len(xi), len(yi), len(zi)]
+        """
+        device = triplane.device
+        c_list = self.grid_coords()
+        xi, yi, zi = [torch.as_tensor(np.asarray(idx), dtype=torch.long) for idx in (xi, yi, zi)]
+        u = np.zeros((len(xi), len(yi), len(zi)), dtype=np.float32)
+
+        slab = max(1, min(len(xi), self.points_per_chunk() // (len(yi) * len(zi))))
+        grid_y, grid_z = torch.meshgrid(c_list[yi], c_list[zi], indexing='ij')
+        grid_yz = torch.stack([grid_y, grid_z], -1).reshape(1, -1, 2).to(device)
+        for x0 in tqdm(range(0, len(xi), slab), disable=not self.verbose, desc=desc):
+            xs = c_list[xi[x0:x0+slab]].to(device)
+            coords = torch.cat([
+                xs.reshape(-1, 1, 1).expand(-1, grid_yz.shape[1], 1),
+                grid_yz.expand(xs.shape[0], -1, -1),
+            ], -1).reshape(-1, 3)
+            sigma = self.query_density(triplane, coords)
+            u[x0:x0+xs.shape[0]] = sigma.reshape(xs.shape[0], len(yi), len(zi)).cpu().numpy()
+            del coords, sigma
+        return u
+
+    def density_grid(self, triplane):
+        """
+        Evaluate density on the full res³ grid.
+
+        Returns:
+            float32 numpy array [res, res, res]
+        """
+        idx = np.arange(self.res)
+        return self.lattice_density(triplane, idx, idx, idx)
+
+    def grid_to_world(self, vertices):
+        return vertices / (self.res - 1) * (2 * self.bound) - self.bound
+
+    def active_blocks(self, triplane):
+        """
+        Find the blocks of block_size³ cells that can contain the iso-surface.
+
+        Density is sampled every block_size // 2 cells (every block_size for odd sizes); a block is active when the range of the
+        coarse samples it touches crosses the iso-level. Active blocks are then dilated by
+        self.dilation blocks to catch thin features the coarse grid misses.
+
+        Returns:
+            bool numpy array [nb, nb, nb]
+        """
+        res, B = self.res, self.block_size
+        nb = int(np.ceil((res - 1) / B))
+        stride = B // 2 if B % 2 == 0 else B
+        steps = B // stride
+        coarse_idx = np.minimum(np.arange(steps * nb + 1) * stride, res - 1)
+        coarse = self.lattice_density(triplane, coarse_idx, coarse_idx, coarse_idx, desc='Coarse grid')
+
+        cmin = np.full((nb, nb, nb), np.inf, dtype=np.float32)
+        cmax = np.full((nb, nb, nb), -np.inf, dtype=np.float32)
+        end = steps * (nb - 1) + 1
+        for dx in range(steps + 1):
+            for dy in range(steps + 1):
+                for dz in range(steps + 1):
+                    window = coarse[dx:dx+end:steps, dy:dy+end:steps, dz:dz+end:steps]
+                    cmin = np.minimum(cmin, window)
+                    cmax = np.maximum(cmax, window)
+        active = (cmin <= self.iso) & (cmax >= self.iso)
+
+        for _ in range(self.dilation):
+            dilated = active.copy()
+            dilated[1:] |= active[:-1]
+            dilated[:-1] |= active[1:]
+            dilated[:, 1:] |= active[:, :-1]
+            dilated[:, :-1] |= active[:, 1:]
+            dilated[:, :, 1:] |= active[:, :, :-1]
+            dilated[:, :, :-1] |= active[:, :, 1:]
+            active = dilated
+        return active
+
+    def sparse_density_grid(self, triplane, active):
+        """
+        Evaluate density at full resolution only on the samples touched by active blocks.
+        Samples on faces shared by two blocks are evaluated once.
+
+        Returns:
+            (u, evaluated): float32 grid [res, res, res] (untouched samples are 0) and the number of decoder queries
+        """
+        res, B = self.res, self.block_size
+        nb = active.shape[0]
+        device = triplane.device
+        c_list = self.grid_coords()
+        u = np.zeros((res, res, res), dtype=np.float32)
+
+        def row_mask(bx):
+            cells = np.repeat(np.repeat(active[bx], B, 0), B, 1)[:res-1, :res-1]
+            samples = np.zeros((res, res), dtype=bool)
+            samples[:-1, :-1] |= cells
+            samples[1:, :-1] |= cells
+            samples[:-1, 1:] |= cells
+            samples[1:, 1:] |= cells
+            return samples
+
+        row_masks = {}
+        chunk = self.points_per_chunk()
+        pending, pending_points = [], 0
+        evaluated = 0
+
+        def flush():
+            coords = torch.cat([c for _, _, c in pending], 0).to(device)
+            sigma = self.query_density(triplane, coords).cpu().numpy()
+            p = 0
+            for x, mask, c in pending:
+                u[x][mask] = sigma[p:p+c.shape[0]]
+                p += c.shape[0]
+
+        for x in tqdm(range(res), disable=not self.verbose, desc='Sparse grid'):
+            rows = {min(x // B, nb - 1)}
+            if x % B == 0 and x > 0:
+                rows.add(x // B - 1)
+            mask = None
+            for bx in rows:
+                if not active[bx].any():
+                    continue
+                if bx not in row_masks:
+                    row_masks = {k: v for k, v in row_masks.items() if k >= bx - 1}
+                    row_masks[bx] = row_mask(bx)
+                mask = row_masks[bx] if mask is None else (mask | row_masks[bx])
+            if mask is None or not mask.any():
+                continue
+
+            yi, zi = np.nonzero(mask)
+            yi, zi = torch.from_numpy(yi), torch.from_numpy(zi)
+            coords = torch.stack([c_list[x].expand(yi.shape[0]), c_list[yi], c_list[zi]], -1)
+            pending.append((x, mask, coords))
+            pending_points += coords.shape[0]
+            evaluated += coords.shape[0]
+            if pending_points >= chunk:
+                flush()
+                pending, pending_points = [], 0
+        if len(pending) > 0:
+            flush()
+        return u, evaluated
+
+    def sparse_marching_cubes(self, u, active):
+        """
+        Run marching cubes on each active block and weld the vertices shared across block faces.
+
+        Returns:
+            (vertices, triangles) in grid index coordinates
+        """
+        B = self.block_size
+        vertices_list, triangles_list = [], []
+        offset = 0
+        for bx, by, bz in zip(*np.nonzero(active)):
+            x0, y0, z0 = bx * B, by * B, bz * B
+            block = u[x0:x0+B+1, y0:y0+B+1, z0:z0+B+1]
+            if block.min() > self.iso or block.max() < self.iso:
+                continue
+            v, t = mcubes.marching_cubes(block, self.iso)
+            if len(t) == 0:
+                continue
+            vertices_list.append(v + np.array([x0, y0, z0], dtype=v.dtype))
+            triangles_list.append(t + offset)
+            offset += v.shape[0]
+
+        if len(vertices_list) == 0:
+            return np.zeros((0, 3)), np.zeros((0, 3), dtype=np.int64)
+
+        vertices = np.concatenate(vertices_list, 0)
+        triangles = np.concatenate(triangles_list, 0)
+
+        # Blocks share their boundary samples, so vertices on shared faces coincide exactly
+        quantized = np.round(vertices * 4096).astype(np.int64)
+        _, unique_idx, inverse = np.unique(quantized, axis=0, return_index=True, return_inverse=True)
+        vertices = vertices[unique_idx]
+        triangles = inverse.reshape(-1)[triangles]
+        return vertices, triangles
+
+    def extract_geometry(self, triplane):
+        """
+        Returns:
+            (vertices, triangles) with vertices in world coordinates
+        """
+        if self.sparse:
+            active = self.active_blocks(triplane)
+            u, evaluated = self.sparse_density_grid(triplane, active)
+            if self.verbose:
+                print(f"Sparse extraction: {int(active.sum())}/{active.size} blocks active, "
+                      f"{evaluated}/{self.res ** 3} fine samples evaluated ({100.0 * evaluated / self.res ** 3:.1f}%)")
+                print(f"Running marching cubes on active blocks at {self.res}³ resolution...")
+            vertices, triangles = self.sparse_marching_cubes(u, active)
+        else:
+            u = self.density_grid(triplane)
+            if self.verbose:
+                print(f"Running marching cubes at {self.res}³ resolution...")
+            vertices, triangles = mcubes.marching_cubes(u, self.iso)
+        del u
+        vertices = self.grid_to_world(vertices)
+        return vertices, triangles
+
+    def vertex_colors(self, triplane, vertices):
+        """
+        Color vertices by rendering towards them from six directions and keeping, per vertex,
+        the view whose rendered depth lands closest to the vertex.
+
+        Returns:
+            RGB colors in [0, 1], numpy array [N, 3]
+        """
+        device = triplane.device
+        planes = self._planes(triplane)
+        pt_vertices = torch.from_numpy(vertices.astype(np.float32)).to(device)
+        samples_per_ray = COLOR_RENDER_KWARGS['depth_resolution'] + COLOR_RENDER_KWARGS['depth_resolution_importance']
+        ray_chunk = max(1024, self.points_per_chunk() // samples_per_ray)
+        render_kwargs = dict(COLOR_RENDER_KWARGS)
+        if self.occupancy and hasattr(self.renderer, 'build_occupancy_grid'):
+            render_kwargs['occupancy_grid'] = self.renderer.build_occupancy_grid(planes, render_kwargs)
+        if self.termination_eps > 0:
+            render_kwargs['termination_eps'] = self.termination_eps
+
+        rgb_final = None
+        diff_final = None
+        for origin in tqdm(COLOR_RAY_ORIGINS, disable=not self.verbose, desc='Vertex colors'):
+            rgb = np.zeros((vertices.shape[0], 3), dtype=np.float32)
+            depth_diff = np.zeros(vertices.shape[0], dtype=np.float32)
+            for p in range(0, vertices.shape[0], ray_chunk):
+                pts = pt_vertices[p:p+ray_chunk]
+                rays_o = torch.tensor(origin, dtype=torch.float32, device=device).reshape(1, 3).repeat(pts.shape[0], 1)
+                rays_d = pts - rays_o
+                rays_d = rays_d / torch.norm(rays_d, dim=-1).reshape(-1, 1)
+                dist = torch.norm(pts - rays_o, dim=-1).cpu().numpy().reshape(-1)
+
+                with torch.no_grad():
+                    render_out = self.renderer(
+                        planes, rays_o.unsqueeze(0).to(planes.dtype), rays_d.unsqueeze(0).to(planes.dtype),
+                        render_kwargs, whole_img=False, tvloss=False
+                    )
+                rgb[p:p+ray_chunk] = render_out['rgb_marched'].reshape(-1, 3).float().cpu().numpy()
+                depth = render_out['depth_final'].reshape(-1).float().cpu().numpy()
+                depth_diff[p:p+ray_chunk] = np.abs(dist - depth)
+                del render_out
+
+            if rgb_final is None:
+                rgb_final = rgb
+                diff_final = depth_diff
+            else:
+                ind = diff_final > depth_diff
+                rgb_final[ind] = rgb[ind]
+                diff_final[ind] = depth_diff[ind]
+            empty_cache(device)
+
+        # bgr to rgb
+        rgb_final = np.stack([
+            rgb_final[:, 2], rgb_final[:, 1], rgb_final[:, 0]
+        ], -1)
+        return rgb_final
+
+    def vertex_normals(self, triplane, vertices):
+        """
+        Outward normals from central differences of the density field (density grows inwards).
+
+        Returns:
+            float32 tensor [N, 3] on the triplane device
+        """
+        device = triplane.device
+        pts = torch.from_numpy(vertices.astype(np.float32)).to(device)
+        h = self.bound / (self.res - 1)
+        grad = []
+        for axis in range(3):
+            offset = torch.zeros(1, 3, device=device)
+            offset[0, axis] = h
+            grad.append(self.query_density(triplane, pts + offset) - self.query_density(triplane, pts - offset))
+        grad = torch.stack(grad, -1)
+        return -grad / grad.norm(dim=-1, keepdim=True).clamp(min=1e-8)
+
+    def point_colors(self, triplane, vertices):
+        """
+        Color vertices by querying the rgb branch directly near each vertex.
+
+        The query point is pushed color_offset voxels outward along the density normal. With
+        color_samples > 1, samples spread over [-color_offset, color_offset] voxels are blended,
+        weighted by their activated density.
+
+        Returns:
+            RGB colors in [0, 1], numpy array [N, 3]
+        """
+        device = triplane.device
+        pts = torch.from_numpy(vertices.astype(np.float32)).to(device)
+        normals = self.vertex_normals(triplane, vertices)
+        voxel = 2 * self.bound / (self.res - 1)
+
+        if self.color_samples <= 1:
+            rgb = self.query_color(triplane, pts + normals * self.color_offset * voxel)
+        else:
+            rgb = torch.zeros(pts.shape[0], 3, device=device)
+            weight_total = torch.zeros(pts.shape[0], 1, device=device)
+            for t in np.linspace(-self.color_offset, self.color_offset, self.color_samples):
+                q = pts + normals * float(t) * voxel
+                # same activation as MipRayMarcher2
+                w = torch.nn.functional.softplus(self.query_density(triplane, q) - 1).reshape(-1, 1) + 1e-6
+                rgb += w * self.query_color(triplane, q)
+                weight_total += w
+            rgb = rgb / weight_total
+        rgb = rgb.cpu().numpy()
+
+        # bgr to rgb
+        return np.stack([rgb[:, 2], rgb[:, 1], rgb[:, 0]], -1)
+
+    def extract(self, triplane):
+        """
+        Returns:
+            trimesh.Trimesh with per-vertex colors
+        """
+        vertices, triangles = self.extract_geometry(triplane)
+        if self.color_mode == 'point':
+            if self.verbose:
+                print("Querying vertex colors from the triplane...")
+            rgb = self.point_colors(triplane, vertices)
+        else:
+            if self.verbose:
+                print("Extracting vertex colors from multiple views...")
+            rgb = self.vertex_colors(triplane, vertices)
+        return trimesh.Trimesh(vertices, triangles, vertex_colors=(np.clip(rgb, 0, 1) * 255).astype(np.uint8))
+
+    def export(self, triplane, ply_path):
+        mesh = self.extract(triplane)
+        trimesh.exchange.export.export_mesh(mesh, ply_path, file_type='ply')
+        return ply_path
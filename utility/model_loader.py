@@ -0,0 +1,142 @@
+"""Fast model construction: empty (meta) weights plus a memory-mapped safetensors checkpoint."""
+import os
+import json
+import time
+import struct
+import threading
+from contextlib import contextmanager
+
+import torch
+from safetensors.torch import load_file
+
+SAFETENSORS_DTYPES = {
+    'F64': torch.float64, 'F32': torch.float32, 'F16': torch.float16, 'BF16': torch.bfloat16,
+    'I64': torch.int64, 'I32': torch.int32, 'I16': torch.int16, 'I8': torch.int8,
+    'U8': torch.uint8, 'BOOL': torch.bool,
+}
+
+_state = threading.local()
+
+
+def empty_init_enabled():
+    return getattr(_state, 'empty_init', False)
+
+
+@contextmanager
+def init_empty_weights():
+    """
+    Build modules without allocating or initializing their weights: every nn.Parameter is moved
+    to the meta device as it is registered. Buffers and plain tensors stay real, so schedules and
+    constants computed in __init__ are unaffected. Load the weights with load_state_dict(assign=True).
+    """
+    register_parameter = torch.nn.Module.register_parameter
+
+    def register_empty_parameter(module, name, param):
+        register_parameter(module, name, param)
+        if param is not None and empty_init_enabled():
+            param = module._parameters[name]
+            module._parameters[name] = type(param)(param.to('meta'), requires_grad=param.requires_grad)
+
+    torch.nn.Module.register_parameter = register_empty_parameter
+    _state.empty_init = True
+    try:
+        yield
+    finally:
+        _state.empty_init = False
+        torch.nn.Module.register_parameter = register_parameter
+
+
+@contextmanager
+def real_weights():
+    """
+    Temporarily build real weights inside init_empty_weights (e.g. to cache a pretrained encoder).
+    """
+    previous = empty_init_enabled()
+    _state.empty_init = False
+    try:
+        yield
+    finally:
+        _state.empty_init = previous
+
+
+def read_safetensors_header(path):
+    """
+    Returns:
+        (header dict without '__metadata__', byte offset of the data section)
+    """
+    with open(path, 'rb') as f:
+        n = struct.unpack('<Q', f.read(8))[0]
+        header = json.loads(f.read(n))
+    header.pop('__metadata__', None)
+    return header, 8 + n
+
+
+def mmap_safetensors(path):
+    """
+    Memory-map a safetensors file: tensors are views of a private file mapping, so pages are only
+    read when touched and the data is never copied into a second buffer.
+
+    Returns:
+        dict of name -> CPU tensor
+    """
+    header, data_start = read_safetensors_header(path)
+    storage = torch.UntypedStorage.from_file(path, shared=False, nbytes=os.path.getsize(path))
+    data = torch.empty(0, dtype=torch.uint8).set_(storage)
+    tensors = {}
+    for name, info in header.items():
+        start, end = info['data_offsets']
+        chunk = data[data_start + start:data_start + end]
+        tensors[name] = chunk.view(SAFETENSORS_DTYPES[info['dtype']]).reshape(info['shape'])
+    return tensors
+
+
+def safetensors_meta_state_dict(path):
+    """
+    Meta tensors with the shapes of a safetensors file, read from its header only.
+    """
+    header, _ = read_safetensors_header(path)
+    return {name: torch.empty(info['shape'], dtype=SAFETENSORS_DTYPES[info['dtype']], device='meta')
+            for name, info in header.items()}
+
+
+def load_model_empty(cls, params, ckpt):
+    """
+    cls(**params) built with empty weights and the mmap'd checkpoint assigned in place.
+    Returns None when the model cannot be built this way.
+    """
+    try:
+        with init_empty_weights():
+            model = cls(**params)
+        try:
+            state_dict = mmap_safetensors(ckpt)
+        except Exception as e:
+            print(f"⚠ Warning: could not memory-map {ckpt} ({e}), reading it instead")
+            state_dict = load_file(ckpt)
+        # assign=True (torch >= 2.1) keeps the checkpoint tensors instead of copying into the parameters
+        model.load_state_dict(state_dict, assign=True)
+    except Exception as e:
+        print(f"⚠ Warning: fast model loading failed ({e}), falling back to regular loading")
+        return None
+
+    missing = [name for name, t in list(model.named_parameters()) + list(model.named_buffers()) if t.is_meta]
+    if missing:
+        print(f"⚠ Warning: {len(missing)} tensors were not in the checkpoint (e.g. {missing[0]}), falling back to regular loading")
+        return None
+    return model
+
+
+def load_safetensors_model(cls, params, ckpt, fast=True):
+    """
+    Build cls(**params) and load a .safetensors checkpoint.
+
+    With fast=True the modules are built on the meta device and the memory-mapped checkpoint is
+    assigned without copying, which skips weight initialization and keeps peak memory at about one
+    copy of the weights; it falls back to the regular path if that fails.
+    """
+    start = time.time()
+    model = load_model_empty(cls, params, ckpt) if fast else None
+    if model is None:
+        model = cls(**params)
+        model.load_state_dict(load_file(ckpt))
+    print(f"✓ Model built and loaded in {time.time() - start:.1f}s")
+    return model
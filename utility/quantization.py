@@ -0,0 +1,233 @@
+"""Dynamic int8 quantization for CPU inference: UNet, CLIP text encoder and triplane MLP."""
+import json
+import numpy as np
+import torch
+import torch.nn as nn
+
+try:
+    from torch.ao.quantization import quantize_dynamic, default_dynamic_qconfig
+    from torch.ao.nn.quantized.dynamic import Linear as DynamicQuantizedLinear
+except ImportError:  # torch < 1.13
+    from torch.quantization import quantize_dynamic, default_dynamic_qconfig
+    from torch.nn.quantized.dynamic import Linear as DynamicQuantizedLinear
+
+from utility.triplane_renderer.eg3d_renderer import FullyConnectedLayer
+from utility.mesh_extractor import MeshExtractor
+
+CALIBRATION_PROMPTS = [
+    'a robot',
+    'a wooden chair',
+    'a red sports car',
+    'a cute corgi dog',
+    'a ceramic vase with flowers',
+    'a medieval stone castle',
+]
+
+# calibration runs the UNet at these timesteps, re-noising its own x_0 prediction in between
+CALIBRATION_TIMESTEPS = [999, 750, 500, 250, 50]
+
+
+def set_quantized_engine():
+    """
+    Pick a quantized kernel backend supported by this CPU (fbgemm/x86 on x86, qnnpack on ARM).
+    """
+    engines = torch.backends.quantized.supported_engines
+    if torch.backends.quantized.engine in engines and torch.backends.quantized.engine != 'none':
+        return torch.backends.quantized.engine
+    for engine in ('x86', 'fbgemm', 'qnnpack'):
+        if engine in engines:
+            torch.backends.quantized.engine = engine
+            return engine
+    raise RuntimeError(f"No quantized engine available (supported: {engines})")
+
+
+def fold_weight_gain(module):
+    """
+    Replace every linear-activation FullyConnectedLayer in module by an nn.Linear with weight_gain
+    and bias_gain folded into its parameters, so it can be quantized like any other Linear.
+
+    Returns:
+        Number of folded layers
+    """
+    count = 0
+    for parent in list(module.modules()):
+        for name, child in list(parent.named_children()):
+            if not isinstance(child, FullyConnectedLayer) or child.activation != 'linear':
+                continue
+            linear = nn.Linear(child.in_features, child.out_features, bias=child.bias is not None)
+            with torch.no_grad():
+                linear.weight.copy_(child.weight * child.weight_gain)
+                if child.bias is not None:
+                    linear.bias.copy_(child.bias * child.bias_gain)
+            setattr(parent, name, linear.to(child.weight.device, child.weight.dtype))
+            count += 1
+    return count
+
+
+def record_linear_inputs(module, run_fn, rows_per_call=256, max_rows=2048):
+    """
+    Sample the inputs every nn.Linear of module receives while run_fn() runs.
+
+    Returns:
+        dict of module name -> [rows, in_features] tensor (layers that never ran are missing)
+    """
+    inputs = {}
+    hooks = []
+
+    def make_hook(name):
+        def hook(m, args):
+            rows = args[0].detach().reshape(-1, m.in_features)
+            seen = inputs.setdefault(name, [])
+            if sum(r.shape[0] for r in seen) < max_rows:
+                seen.append(rows[::max(1, rows.shape[0] // rows_per_call)].float().cpu())
+        return hook
+
+    for name, m in module.named_modules():
+        if type(m) is nn.Linear:
+            hooks.append(m.register_forward_pre_hook(make_hook(name)))
+    try:
+        with torch.no_grad():
+            run_fn()
+    finally:
+        for h in hooks:
+            h.remove()
+    return {name: torch.cat(rows)[:max_rows] for name, rows in inputs.items()}
+
+
+def quantization_errors(module, inputs):
+    """
+    Relative output error ||q(x) - f(x)|| / ||f(x)|| of int8 dynamic quantization per Linear,
+    on the recorded calibration inputs.
+    """
+    layers = dict(module.named_modules())
+    errors = {}
+    with torch.no_grad():
+        for name, x in inputs.items():
+            linear = layers[name]
+            reference = nn.Linear(linear.in_features, linear.out_features, bias=linear.bias is not None)
+            reference.load_state_dict({k: v.float().cpu() for k, v in linear.state_dict().items()})
+            reference.qconfig = default_dynamic_qconfig
+            quantized = DynamicQuantizedLinear.from_float(reference)
+            y = reference(x)
+            errors[name] = ((quantized(x) - y).norm() / y.norm().clamp(min=1e-8)).item()
+    return errors
+
+
+def quantize_linears(module, run_fn, tol=0.05, name='module'):
+    """
+    Calibrate and quantize the nn.Linear layers of module to dynamic int8 in place. Layers that
+    run_fn() never reaches, or whose calibration error exceeds tol, stay in fp32.
+
+    Returns:
+        dict summary for the report
+    """
+    inputs = record_linear_inputs(module, run_fn)
+    errors = quantization_errors(module, inputs)
+    selected = sorted(n for n, e in errors.items() if e <= tol)
+    total = sum(1 for m in module.modules() if type(m) is nn.Linear)
+    if selected:
+        quantize_dynamic(module, {n: default_dynamic_qconfig for n in selected}, dtype=torch.qint8, inplace=True)
+    kept = sorted(n for n, e in errors.items() if e > tol)
+    max_error = max((errors[n] for n in selected), default=0.)
+    print(f"✓ int8 {name}: {len(selected)}/{total} Linear layers quantized "
+          f"(max calibration error {max_error:.2%}, {len(kept)} kept in fp32 above {tol:.0%})")
+    return {'quantized': len(selected), 'linear_layers': total, 'max_error': max_error, 'kept_fp32': kept}
+
+
+@torch.no_grad()
+def quantize_model_int8(model, prompts=CALIBRATION_PROMPTS, shape=(8, 32, 96), tol=0.05, seed=0):
+    """
+    int8 CPU inference for a LatentDiffusion model: calibrate on a small prompt set, then quantize
+    the Linear layers of the CLIP text encoder, the UNet and the triplane MLP (after folding the
+    FullyConnectedLayer gains). Convolutions and the VAE decoder stay in fp32.
+
+    Args:
+        prompts: Calibration prompts
+        shape: Latent shape [C, H, W]
+        tol: Max relative calibration error for a layer to be quantized
+
+    Returns:
+        dict of part -> summary
+    """
+    if model.device.type != 'cpu':
+        print(f"⚠ Warning: int8 dynamic quantization only runs on CPU, keeping {model.device.type} in full precision")
+        return {}
+    engine = set_quantized_engine()
+    print(f"Calibrating int8 quantization on {len(prompts)} prompts ({engine} kernels)...")
+    generator = torch.Generator().manual_seed(seed)
+    noise = torch.randn([len(prompts)] + list(shape), generator=generator)
+    renderer = model.first_stage_model.triplane_decoder
+    fold_weight_gain(renderer)
+
+    summary = {}
+    summary['clip'] = quantize_linears(model.cond_stage_model, lambda: model.encode_conditioning(prompts), tol, 'CLIP')
+    if model.conditioning_cache is not None:
+        # conditionings cached in fp32 are not what the quantized encoder returns
+        model.conditioning_cache.version += ':int8'
+        model.conditioning_cache.entries.clear()
+    context = model.encode_conditioning(prompts)
+    latents = []
+
+    def run_unet():
+        x = noise
+        for i, t in enumerate(CALIBRATION_TIMESTEPS):
+            t_in = torch.full((len(prompts),), t, dtype=torch.long)
+            x0 = model.predict_start_from_noise(x, t_in, model.apply_model(x, t_in, context))
+            if i + 1 < len(CALIBRATION_TIMESTEPS):
+                t_next = torch.full((len(prompts),), CALIBRATION_TIMESTEPS[i + 1], dtype=torch.long)
+                x = model.q_sample(x0, t_next, noise)
+        latents.append(x0)
+
+    with model.inference_mode():
+        summary['unet'] = quantize_linears(model.model.diffusion_model, run_unet, tol, 'UNet')
+
+    extractor = MeshExtractor(renderer, res=32, verbose=False)
+    triplanes = model.decode_first_stage(latents[0])
+
+    def run_mlp():
+        coords = extractor.grid_coords()
+        grid = torch.stack(torch.meshgrid(coords, coords, coords, indexing='ij'), -1).reshape(-1, 3)
+        for b in range(triplanes.shape[0]):
+            extractor.query_density(triplanes[b:b+1], grid)
+            extractor.query_color(triplanes[b:b+1], grid)
+
+    summary['triplane_mlp'] = quantize_linears(renderer.decoder, run_mlp, tol, 'triplane MLP')
+    # drop cross-attention outputs cached by the fp32 layers
+    for m in model.model.modules():
+        if hasattr(m, '_context_cache'):
+            m._context_cache = []
+    return summary
+
+
+def compare_outputs(reference, candidate, iso=10):
+    """
+    Compare the density grid ('density', float array) and render ('render', uint8 image) of an
+    int8 run against the fp32 reference.
+
+    Returns:
+        dict with density relative L2 error, max abs error, occupancy IoU at iso and render PSNR
+    """
+    ref, out = reference['density'], candidate['density']
+    occ_ref, occ_out = ref > iso, out > iso
+    union = np.logical_or(occ_ref, occ_out).sum()
+    mse = np.mean((reference['render'].astype(np.float64) - candidate['render'].astype(np.float64)) ** 2)
+    return {
+        'density_rel_l2': float(np.linalg.norm(out - ref) / max(np.linalg.norm(ref), 1e-8)),
+        'density_max_abs': float(np.abs(out - ref).max()),
+        'occupancy_iou': float(np.logical_and(occ_ref, occ_out).sum() / union) if union > 0 else 1.,
+        'render_psnr': float(10 * np.log10(255. ** 2 / mse)) if mse > 0 else float('inf'),
+    }
+
+
+def print_report(rows, path=None):
+    """
+    Print the int8 validation table and optionally save it as JSON.
+    """
+    print(f"{'prompt':<32} {'case':<13} {'density L2':>10} {'max |Δσ|':>9} {'IoU':>6} {'PSNR':>7}")
+    for row in rows:
+        print(f"{row['prompt'][:32]:<32} {row['case']:<13} {row['density_rel_l2']:>10.2%} "
+              f"{row['density_max_abs']:>9.3f} {row['occupancy_iou']:>6.3f} {row['render_psnr']:>7.2f}")
+    if path is not None:
+        with open(path, 'w') as f:
+            json.dump(rows, f, indent=2)
+        print(f"✓ int8 validation report saved to {path}")
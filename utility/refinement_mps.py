@@ -1,16 +1,12 @@
 """Mac MPS-compatible mesh refinement using Hephaestus model."""
 import os
 import torch
-import numpy as np
-import trimesh
-import mcubes
 import re
 import random
 from pathlib import Path
-from tqdm import tqdm
 
 from utility.device_utils import get_device, empty_cache
-from utility.triplane_renderer.eg3d_renderer import sample_from_planes, generate_planes
+from utility.mesh_extractor import MeshExtractor
 
 
 def refine_mesh_mps(
@@ -23,25 +19,37 @@ def refine_mesh_mps(
     sampler='ddim',
     outdir=None,
     save_name=None,
-    verbose=True
+    verbose=True,
+    latent=None,
+    strength=0.5,
+    occupancy=False,
+    termination_eps=0.
 ):
     """
     Refine a mesh using iterative diffusion refinement (Mac MPS compatible).
     
-    This method re-generates the model with higher quality settings to improve
-    the mesh quality. Works on Mac MPS with float32.
+    Given the stage-1 latent, this is an SDEdit warm start: the latent is noised to an
+    intermediate DDIM timestep and denoised from there, so only strength * refinement_steps
+    steps run and the object keeps its identity. Without a latent the model is re-generated
+    from pure noise with higher quality settings. Works on Mac MPS with float32.
     
     Args:
         model: The loaded Hephaestus diffusion model
         mesh_path: Path to input PLY mesh
         prompt: Text prompt for refinement
-        refinement_steps: Number of diffusion steps (more = better quality, slower)
+        refinement_steps: Number of diffusion steps (more = better quality, slower); with a
+            latent, the length of the DDIM schedule the warm start runs a part of
         mcubes_res: Marching cubes resolution (higher = more detail)
         cfg_scale: Classifier-free guidance scale
-        sampler: Sampler type ('ddim', 'plms', 'dpm_solver')
+        sampler: Sampler type ('ddim', 'plms', 'dpm_solver'); the warm start always uses DDIM
         outdir: Output directory
         save_name: Output filename (without extension)
         verbose: Print progress
+        latent: Stage-1 latent [1, 8, 32, 96] of the mesh to refine
+        strength: Fraction of the schedule re-run from the noised latent (0 keeps it, 1 is a
+            full re-generation)
+        occupancy: Skip empty space with an occupancy grid when coloring the vertices (approximate)
+        termination_eps: Early ray termination threshold when coloring the vertices (0 disables)
     
     Returns:
         Path to refined PLY file, or None if refinement failed
@@ -52,7 +60,10 @@ def refine_mesh_mps(
         print(f"\n{'='*60}")
         print(f"🔨 Starting MPS-compatible refinement (Mac)")
         print(f"   Device: {device}")
-        print(f"   Refinement steps: {refinement_steps}")
+        if latent is not None:
+            print(f"   Warm start: strength {strength} of a {refinement_steps}-step DDIM schedule")
+        else:
+            print(f"   Refinement steps: {refinement_steps}")
         print(f"   Marching cubes resolution: {mcubes_res}")
         print(f"{'='*60}\n")
     
@@ -62,7 +73,7 @@ def refine_mesh_mps(
         from ldm.models.diffusion.plms import PLMSSampler
         from ldm.models.diffusion.dpm_solver import DPMSolverSampler
         
-        if sampler == 'ddim':
+        if latent is not None or sampler == 'ddim':
             sampler_obj = DDIMSampler(model)
         elif sampler == 'plms':
             sampler_obj = PLMSSampler(model)
@@ -79,23 +90,26 @@ def refine_mesh_mps(
         else:
             raise ValueError("Model does not have a condition stage model")
         
-        # Sample with higher quality settings
-        if verbose:
-            print(f"Generating refined latent with {refinement_steps} steps...")
-        
         shape = [8, 32, 96]  # Latent shape
         batch_size = 1
-        samples, _ = sampler_obj.sample(
-            S=refinement_steps,
-            batch_size=batch_size,
-            shape=shape,
-            verbose=False,
-            x_T=None,
-            conditioning=cond.repeat(batch_size, 1, 1),
-            unconditional_guidance_scale=cfg_scale,
-            unconditional_conditioning=unconditional_c.repeat(batch_size, 1, 1),
-            eta=0.0
-        )
+        if latent is not None:
+            samples = warm_start_latent(sampler_obj, latent.to(device), cond, unconditional_c,
+                                        refinement_steps, strength, cfg_scale, verbose)
+        else:
+            # Sample with higher quality settings
+            if verbose:
+                print(f"Generating refined latent with {refinement_steps} steps...")
+            samples, _ = sampler_obj.sample(
+                S=refinement_steps,
+                batch_size=batch_size,
+                shape=shape,
+                verbose=False,
+                x_T=None,
+                conditioning=cond.repeat(batch_size, 1, 1),
+                unconditional_guidance_scale=cfg_scale,
+                unconditional_conditioning=unconditional_c.repeat(batch_size, 1, 1),
+                eta=0.0
+            )
         
         # Decode to triplane
         if verbose:
@@ -116,7 +130,9 @@ def refine_mesh_mps(
             mcubes_res=mcubes_res,
             outdir=outdir,
             save_name=save_name,
-            verbose=verbose
+            verbose=verbose,
+            occupancy=occupancy,
+            termination_eps=termination_eps
         )
         
         empty_cache(device)
@@ -140,6 +156,32 @@ def refine_mesh_mps(
         return None
 
 
+@torch.no_grad()
+def warm_start_latent(sampler, latent, cond, unconditional_c, steps, strength, cfg_scale=7.5, verbose=True):
+    """
+    SDEdit: noise a latent to DDIM step strength * steps and denoise it back with the prompt.
+
+    Args:
+        sampler: DDIMSampler
+        latent: Latents [B, 8, 32, 96]
+        cond, unconditional_c: Conditioning for one row; repeated over the batch
+        steps: Length of the DDIM schedule
+
+    Returns:
+        Refined latents, same shape as latent
+    """
+    b = latent.shape[0]
+    sampler.make_schedule(ddim_num_steps=steps, ddim_eta=0., verbose=False)
+    t_enc = min(max(int(strength * steps), 1), steps)
+    if verbose:
+        print(f"Warm-starting from the stage-1 latent: {t_enc}/{steps} DDIM steps...")
+    # decode() starts at schedule index t_enc - 1, so noise the latent to exactly that level
+    t = torch.full((b,), t_enc - 1, device=latent.device, dtype=torch.long)
+    z_enc = sampler.stochastic_encode(latent, t)
+    return sampler.decode(z_enc, cond.repeat(b, 1, 1), t_enc, unconditional_guidance_scale=cfg_scale,
+                          unconditional_conditioning=unconditional_c.repeat(b, 1, 1))
+
+
 def extract_mesh_high_res(
     model,
     decode_res,
@@ -147,7 +189,10 @@ def extract_mesh_high_res(
     mcubes_res=256,
     outdir=None,
     save_name=None,
-    verbose=True
+    verbose=True,
+    sparse=None,
+    occupancy=False,
+    termination_eps=0.
 ):
     """
     Extract high-resolution mesh from triplane representation.
@@ -159,6 +204,9 @@ def extract_mesh_high_res(
         mcubes_res: Resolution for marching cubes
         outdir: Output directory
         save_name: Output filename
+        sparse: Coarse-to-fine extraction (default: enabled for 256³ and above)
+        occupancy: Skip empty space with an occupancy grid when coloring the vertices (approximate)
+        termination_eps: Early ray termination threshold when coloring the vertices (0 disables)
     
     Returns:
         Path to extracted PLY file
@@ -186,124 +234,15 @@ def extract_mesh_high_res(
     
     ply_path = os.path.join(outdir, f"{save_name}.ply")
     
-    # Prepare volume for marching cubes
-    c_list = torch.linspace(-1.2, 1.2, steps=mcubes_res, dtype=torch.float32)
-    grid_x, grid_y, grid_z = torch.meshgrid(
-        c_list, c_list, c_list, indexing='ij'
-    )
-    coords = torch.stack([grid_x, grid_y, grid_z], -1).to(device)
-    
-    # Sample features from triplane
-    plane_axes = generate_planes()
-    feats = sample_from_planes(
-        plane_axes,
-        decode_res.reshape(1, 3, -1, decode_res.shape[-2], decode_res.shape[-1]),
-        coords.reshape(1, -1, 3),
-        padding_mode='zeros',
-        box_warp=2.4
+    if sparse is None:
+        sparse = mcubes_res >= 256
+    extractor = MeshExtractor(
+        model.first_stage_model.triplane_decoder, res=mcubes_res, iso=10, device=device, verbose=verbose,
+        sparse=sparse, occupancy=occupancy, termination_eps=termination_eps
     )
-    
-    # Get density
-    fake_dirs = torch.zeros_like(coords).to(device)
-    fake_dirs[..., 0] = 1
-    
-    with torch.no_grad():
-        out = model.first_stage_model.triplane_decoder.decoder(
-            feats,
-            fake_dirs.reshape(1, -1, 3)
-        )
-    
-    u = out['sigma'].reshape(mcubes_res, mcubes_res, mcubes_res).detach().cpu().numpy()
-    del out, feats, coords
+    extractor.export(decode_res, ply_path)
     empty_cache(device)
     
-    # Marching cubes
-    if verbose:
-        print(f"Running marching cubes at {mcubes_res}³ resolution...")
-    
-    vertices, triangles = mcubes.marching_cubes(u, 10)
-    
-    # Normalize vertices to [-1.2, 1.2] range
-    min_bound = np.array([-1.2, -1.2, -1.2], dtype=np.float32)
-    max_bound = np.array([1.2, 1.2, 1.2], dtype=np.float32)
-    vertices = vertices / (mcubes_res - 1) * (max_bound - min_bound)[None, :] + min_bound[None, :]
-    
-    # Extract vertex colors
-    pt_vertices = torch.from_numpy(vertices.astype(np.float32)).to(device)
-    
-    # Render from multiple views to get colors
-    res_triplane = 256
-    render_kwargs = {
-        'depth_resolution': 128,
-        'disparity_space_sampling': False,
-        'box_warp': 2.4,
-        'depth_resolution_importance': 128,
-        'clamp_mode': 'softplus',
-        'white_back': True,
-        'det': True
-    }
-    
-    rays_o_list = [
-        np.array([0, 0, 2], dtype=np.float32),
-        np.array([0, 0, -2], dtype=np.float32),
-        np.array([0, 2, 0], dtype=np.float32),
-        np.array([0, -2, 0], dtype=np.float32),
-        np.array([2, 0, 0], dtype=np.float32),
-        np.array([-2, 0, 0], dtype=np.float32),
-    ]
-    
-    rgb_final = None
-    diff_final = None
-    
-    if verbose:
-        print("Extracting vertex colors from multiple views...")
-    
-    for rays_o in tqdm(rays_o_list, disable=not verbose):
-        rays_o_tensor = torch.from_numpy(rays_o.reshape(1, 3)).repeat(
-            vertices.shape[0], 1
-        ).float().to(device)
-        rays_d = pt_vertices.reshape(-1, 3) - rays_o_tensor
-        rays_d = rays_d / torch.norm(rays_d, dim=-1).reshape(-1, 1)
-        dist = torch.norm(pt_vertices.reshape(-1, 3) - rays_o_tensor, dim=-1).cpu().numpy().reshape(-1)
-        
-        with torch.no_grad():
-            render_out = model.first_stage_model.triplane_decoder(
-                decode_res.reshape(1, 3, -1, res_triplane, res_triplane),
-                rays_o_tensor.unsqueeze(0),
-                rays_d.unsqueeze(0),
-                render_kwargs,
-                whole_img=False,
-                tvloss=False
-            )
-        
-        rgb = render_out['rgb_marched'].reshape(-1, 3).detach().cpu().numpy()
-        depth = render_out['depth_final'].reshape(-1).detach().cpu().numpy()
-        depth_diff = np.abs(dist - depth)
-        
-        if rgb_final is None:
-            rgb_final = rgb.copy()
-            diff_final = depth_diff.copy()
-        else:
-            ind = diff_final > depth_diff
-            rgb_final[ind] = rgb[ind]
-            diff_final[ind] = depth_diff[ind]
-        
-        del render_out
-        empty_cache(device)
-    
-    # BGR to RGB
-    rgb_final = np.stack([
-        rgb_final[:, 2], rgb_final[:, 1], rgb_final[:, 0]
-    ], -1)
-    
-    # Export to PLY
-    mesh = trimesh.Trimesh(
-        vertices,
-        triangles,
-        vertex_colors=(rgb_final * 255).astype(np.uint8)
-    )
-    trimesh.exchange.export.export_mesh(mesh, ply_path, file_type='ply')
-    
     return ply_path
 
 
@@ -312,7 +251,9 @@ def refine_mesh_automatic_mps(
     ply_path,
     prompt,
     high_quality=True,
-    outdir=None
+    outdir=None,
+    latent=None,
+    strength=0.5
 ):
     """
     Automatically refine a mesh with optimal MPS settings.
@@ -323,6 +264,8 @@ def refine_mesh_automatic_mps(
         prompt: Text prompt
         high_quality: Use high quality settings (more steps, higher resolution)
         outdir: Output directory
+        latent: Optional stage-1 latent to warm-start from (see refine_mesh_mps)
+        strength: Warm-start strength
     
     Returns:
         Path to refined PLY file
@@ -347,6 +290,8 @@ def refine_mesh_automatic_mps(
         sampler='ddim',
         outdir=outdir,
         save_name=save_name,
-        verbose=True
+        verbose=True,
+        latent=latent,
+        strength=strength
     )
 
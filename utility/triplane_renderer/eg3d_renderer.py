@@ -29,7 +29,13 @@ class MipRayMarcher2(nn.Module):
         alpha = 1 - torch.exp(-density_delta)
 
         alpha_shifted = torch.cat([torch.ones_like(alpha[:, :, :1]), 1-alpha + 1e-10], -2)
-        weights = alpha * torch.cumprod(alpha_shifted, -2)[:, :, :-1]
+        transmittance = torch.cumprod(alpha_shifted, -2)[:, :, :-1]
+        weights = alpha * transmittance
+
+        termination_eps = rendering_options.get('termination_eps', 0)
+        if termination_eps > 0:
+            # the ray has terminated once transmittance drops below eps; later samples are ignored
+            weights = weights * (transmittance >= termination_eps)
 
         composite_rgb = torch.sum(weights * colors_mid, -2)
         weight_total = weights.sum(2)
@@ -455,6 +461,28 @@ class TriPlane_Decoder_Decompose(nn.Module):
         sigma = x[..., 0:1]
         return {'rgb': rgb, 'sigma': sigma}
 
+    def query_sigma(self, sampled_features):
+        """
+        Density branch only. Expects sampled features of shape N, 3, M, C and returns N, M, 1.
+        """
+        N, _, M, C = sampled_features.shape
+        sigma_features = sampled_features[..., :self.sigma_dim]
+        sigma_features = sigma_features.permute(0, 2, 1, 3).reshape(N * M, self.sigma_dim * 3)
+        return self.sigmanet(sigma_features).view(N, M, 1)
+
+    def query_rgb(self, sampled_features):
+        """
+        Color branch only. Expects sampled features of shape N, 3, M, C and returns N, M, 3.
+        """
+        N, _, M, C = sampled_features.shape
+        rgb_features = sampled_features[..., -self.c_dim:]
+        rgb_features = rgb_features.permute(0, 2, 1, 3).reshape(N * M, self.c_dim * 3)
+        rgb = self.rgbnet(rgb_features).view(N, M, 3)
+        return torch.sigmoid(rgb)*(1 + 2*0.001) - 0.001 # Uses sigmoid clamping from MipNeRF
+
+# Density assigned to samples skipped by the occupancy grid; softplus(EMPTY_SIGMA - 1) is ~2e-5
+EMPTY_SIGMA = -10.
+
 class Renderer_TriPlane(nn.Module):
     # def __init__(self, rgbnet_dim=18, rgbnet_width=128, viewpe=0, feape=0):
     #     super(Renderer_TriPlane, self).__init__()
@@ -479,26 +507,29 @@ class Renderer_TriPlane(nn.Module):
     def forward(self, planes, ray_origins, ray_directions, rendering_options, whole_img=False, tvloss=False):
         self.plane_axes = self.plane_axes.to(ray_origins.device)
 
-        ray_start, ray_end = get_ray_limits_box(ray_origins, ray_directions, box_side_length=rendering_options['box_warp'])
-        is_ray_valid = ray_end > ray_start
-        if torch.any(is_ray_valid).item():
-            ray_start[~is_ray_valid] = ray_start[is_ray_valid].min()
-            ray_end[~is_ray_valid] = ray_start[is_ray_valid].max()
+        if 'ray_limits' in rendering_options:
+            ray_start, ray_end = rendering_options['ray_limits']
+        else:
+            ray_start, ray_end = self.ray_limits(ray_origins, ray_directions, rendering_options)
         depths_coarse = self.sample_stratified(ray_origins, ray_start, ray_end, rendering_options['depth_resolution'], rendering_options['disparity_space_sampling'],
                                                rendering_options['det'])
 
         batch_size, num_rays, samples_per_ray, _ = depths_coarse.shape
 
         # Coarse Pass
-        sample_coordinates = (ray_origins.unsqueeze(-2) + depths_coarse * ray_directions.unsqueeze(-2)).reshape(batch_size, -1, 3)
-        sample_directions = ray_directions.unsqueeze(-2).expand(-1, -1, samples_per_ray, -1).reshape(batch_size, -1, 3)
-
+        termination_depth = None
+        if rendering_options.get('termination_eps', 0) > 0:
+            colors_coarse, densities_coarse, termination_depth = self.run_coarse_terminated(
+                planes, ray_origins, ray_directions, depths_coarse, rendering_options)
+        else:
+            sample_coordinates = (ray_origins.unsqueeze(-2) + depths_coarse * ray_directions.unsqueeze(-2)).reshape(batch_size, -1, 3)
+            sample_directions = ray_directions.unsqueeze(-2).expand(-1, -1, samples_per_ray, -1).reshape(batch_size, -1, 3)
 
-        out = self.run_model(planes, self.decoder, sample_coordinates, sample_directions, rendering_options)
-        colors_coarse = out['rgb']
-        densities_coarse = out['sigma']
-        colors_coarse = colors_coarse.reshape(batch_size, num_rays, samples_per_ray, colors_coarse.shape[-1])
-        densities_coarse = densities_coarse.reshape(batch_size, num_rays, samples_per_ray, 1)
+            out = self.run_model_occupancy(planes, self.decoder, sample_coordinates, sample_directions, rendering_options)
+            colors_coarse = out['rgb']
+            densities_coarse = out['sigma']
+            colors_coarse = colors_coarse.reshape(batch_size, num_rays, samples_per_ray, colors_coarse.shape[-1])
+            densities_coarse = densities_coarse.reshape(batch_size, num_rays, samples_per_ray, 1)
 
         # Fine Pass
         N_importance = rendering_options['depth_resolution_importance']
@@ -510,7 +541,15 @@ class Renderer_TriPlane(nn.Module):
             sample_directions = ray_directions.unsqueeze(-2).expand(-1, -1, N_importance, -1).reshape(batch_size, -1, 3)
             sample_coordinates = (ray_origins.unsqueeze(-2) + depths_fine * ray_directions.unsqueeze(-2)).reshape(batch_size, -1, 3)
 
-            out = self.run_model(planes, self.decoder, sample_coordinates, sample_directions, rendering_options)
+            if termination_depth is not None:
+                # fine samples behind the point where the coarse ray terminated are never evaluated
+                mask = (depths_fine[..., 0] <= termination_depth.unsqueeze(-1)).reshape(batch_size, -1)
+                occupancy_grid = rendering_options.get('occupancy_grid', None)
+                if occupancy_grid is not None:
+                    mask = mask & self.occupancy_mask(occupancy_grid, sample_coordinates, rendering_options['box_warp'])
+                out = self.run_model_masked(planes, self.decoder, sample_coordinates, sample_directions, rendering_options, mask)
+            else:
+                out = self.run_model_occupancy(planes, self.decoder, sample_coordinates, sample_directions, rendering_options)
             colors_fine = out['rgb']
             densities_fine = out['sigma']
             colors_fine = colors_fine.reshape(batch_size, num_rays, N_importance, colors_fine.shape[-1])
@@ -565,6 +604,29 @@ class Renderer_TriPlane(nn.Module):
                 'tvloss': TVloss,
             }
 
+    def ray_limits(self, ray_origins, ray_directions, rendering_options, per_row=False):
+        """
+        Entry and exit depths of rays through the box. Rays that miss the box get the depth range
+        of the valid rays, taken over the whole batch or, with per_row, over each batch row.
+        """
+        ray_start, ray_end = get_ray_limits_box(ray_origins, ray_directions, box_side_length=rendering_options['box_warp'])
+        is_ray_valid = ray_end > ray_start
+        if not per_row:
+            if torch.any(is_ray_valid).item():
+                ray_start[~is_ray_valid] = ray_start[is_ray_valid].min()
+                ray_end[~is_ray_valid] = ray_start[is_ray_valid].max()
+            return ray_start, ray_end
+
+        row_valid = is_ray_valid.flatten(1).any(-1).reshape(-1, *([1] * (ray_start.dim() - 1)))
+        row_min = torch.where(is_ray_valid, ray_start, torch.full_like(ray_start, float('inf'))).flatten(1).min(-1).values
+        row_max = torch.where(is_ray_valid, ray_start, torch.full_like(ray_start, float('-inf'))).flatten(1).max(-1).values
+        row_min = row_min.reshape(row_valid.shape)
+        row_max = row_max.reshape(row_valid.shape)
+        fix = ~is_ray_valid & row_valid
+        ray_start = torch.where(fix, row_min.expand_as(ray_start), ray_start)
+        ray_end = torch.where(fix, row_max.expand_as(ray_end), ray_end)
+        return ray_start, ray_end
+
     def run_model(self, planes, decoder, sample_coordinates, sample_directions, options):
         sampled_features = sample_from_planes(self.plane_axes, planes, sample_coordinates, padding_mode='zeros', box_warp=options['box_warp'])
 
@@ -573,6 +635,134 @@ class Renderer_TriPlane(nn.Module):
             out['sigma'] += torch.randn_like(out['sigma']) * options['density_noise']
         return out
 
+    def run_model_occupancy(self, planes, decoder, sample_coordinates, sample_directions, options):
+        """
+        run_model, skipping samples in empty cells when options carries an 'occupancy_grid'.
+        """
+        occupancy_grid = options.get('occupancy_grid', None)
+        if occupancy_grid is None:
+            return self.run_model(planes, decoder, sample_coordinates, sample_directions, options)
+        mask = self.occupancy_mask(occupancy_grid, sample_coordinates, options['box_warp'])
+        return self.run_model_masked(planes, decoder, sample_coordinates, sample_directions, options, mask)
+
+    def run_model_masked(self, planes, decoder, sample_coordinates, sample_directions, options, mask):
+        """
+        run_model on the samples selected by mask [N, M] only. Skipped samples get EMPTY_SIGMA
+        density and zero color, so they do not contribute to the composite.
+        """
+        N, M, _ = sample_coordinates.shape
+        out = {
+            'rgb': torch.zeros((N, M, 3), dtype=sample_coordinates.dtype, device=sample_coordinates.device),
+            'sigma': torch.full((N, M, 1), EMPTY_SIGMA, dtype=sample_coordinates.dtype, device=sample_coordinates.device),
+        }
+        for n in range(N):
+            idx = mask[n].nonzero(as_tuple=True)[0]
+            if idx.numel() == 0:
+                continue
+            row = self.run_model(planes[n:n+1], decoder, sample_coordinates[n:n+1, idx], sample_directions[n:n+1, idx], options)
+            out['rgb'][n, idx] = row['rgb'][0].to(out['rgb'].dtype)
+            out['sigma'][n, idx] = row['sigma'][0].to(out['sigma'].dtype)
+        return out
+
+    def run_coarse_terminated(self, planes, ray_origins, ray_directions, depths_coarse, options):
+        """
+        Coarse pass with early ray termination. Samples are evaluated front to back in chunks of
+        options['termination_chunk'] depths; after each chunk the transmittance of every ray is
+        updated (same midpoint rule as MipRayMarcher2) and rays whose transmittance fell below
+        options['termination_eps'] are dropped, so later chunks only run the decoder on live rays.
+
+        Returns:
+            colors [N, M, S, 3], densities [N, M, S, 1] (EMPTY_SIGMA where skipped) and the
+            termination depth [N, M] of every ray (inf for rays that never terminated)
+        """
+        assert options['clamp_mode'] == 'softplus', "Early ray termination only supports `clamp_mode`=`softplus`!"
+        N, M, S, _ = depths_coarse.shape
+        eps = options['termination_eps']
+        chunk = options.get('termination_chunk', 16)
+        occupancy_grid = options.get('occupancy_grid', None)
+
+        colors = torch.zeros((N, M, S, 3), dtype=depths_coarse.dtype, device=depths_coarse.device)
+        densities = torch.full((N, M, S, 1), EMPTY_SIGMA, dtype=depths_coarse.dtype, device=depths_coarse.device)
+        termination_depth = torch.full((N, M), float('inf'), dtype=depths_coarse.dtype, device=depths_coarse.device)
+        optical_depth = torch.zeros((N, M), dtype=depths_coarse.dtype, device=depths_coarse.device)
+        alive = torch.ones((N, M), dtype=torch.bool, device=depths_coarse.device)
+
+        for s0 in range(0, S, chunk):
+            depths = depths_coarse[:, :, s0:s0+chunk]
+            c = depths.shape[2]
+            sample_coordinates = (ray_origins.unsqueeze(-2) + depths * ray_directions.unsqueeze(-2)).reshape(N, -1, 3)
+            sample_directions = ray_directions.unsqueeze(-2).expand(-1, -1, c, -1).reshape(N, -1, 3)
+            mask = alive.unsqueeze(-1).expand(-1, -1, c).reshape(N, -1)
+            if occupancy_grid is not None:
+                mask = mask & self.occupancy_mask(occupancy_grid, sample_coordinates, options['box_warp'])
+            out = self.run_model_masked(planes, self.decoder, sample_coordinates, sample_directions, options, mask)
+            colors[:, :, s0:s0+c] = out['rgb'].reshape(N, M, c, 3)
+            densities[:, :, s0:s0+c] = out['sigma'].reshape(N, M, c, 1)
+
+            # accumulate the intervals ending in this chunk, including the one from the previous chunk
+            lo = max(s0 - 1, 0)
+            seg_depths = depths_coarse[:, :, lo:s0+c, 0]
+            seg_densities = densities[:, :, lo:s0+c, 0]
+            densities_mid = F.softplus((seg_densities[..., 1:] + seg_densities[..., :-1]) / 2 - 1)
+            optical_depth = optical_depth + (densities_mid * (seg_depths[..., 1:] - seg_depths[..., :-1])).sum(-1)
+
+            terminated = alive & (torch.exp(-optical_depth) < eps)
+            termination_depth = torch.where(terminated, depths_coarse[:, :, s0+c-1, 0], termination_depth)
+            alive = alive & ~terminated
+            if not alive.any():
+                break
+        return colors, densities, termination_depth
+
+    def occupancy_mask(self, occupancy_grid, coordinates, box_warp):
+        """
+        Look up the occupancy [N, R, R, R] of points [N, M, 3] inside the box. Returns bool [N, M].
+        """
+        N, R = occupancy_grid.shape[0], occupancy_grid.shape[-1]
+        idx = ((coordinates / box_warp + 0.5) * R).long().clamp(0, R - 1)
+        flat = (idx[..., 0] * R + idx[..., 1]) * R + idx[..., 2]
+        return torch.gather(occupancy_grid.reshape(N, -1), 1, flat)
+
+    def build_occupancy_grid(self, planes, rendering_options, resolution=64, threshold=0.01, dilation=1):
+        """
+        Coarse occupancy bitfield of the rendering box, built once per triplane and reused for
+        every view rendered from it.
+
+        A cell is occupied when the activated density (softplus(sigma - 1), as in MipRayMarcher2)
+        at any of its corners exceeds threshold; occupied cells are then dilated by dilation cells.
+
+        Args:
+            planes: Triplane features [N, 3, C, H, W]
+
+        Returns:
+            bool tensor [N, resolution, resolution, resolution]
+        """
+        N = planes.shape[0]
+        R = resolution
+        half = rendering_options['box_warp'] / 2
+        c_list = torch.linspace(-half, half, R + 1, device=planes.device, dtype=planes.dtype)
+        grid_x, grid_y, grid_z = torch.meshgrid(c_list, c_list, c_list, indexing='ij')
+        coords = torch.stack([grid_x, grid_y, grid_z], -1).reshape(1, -1, 3)
+
+        occupancy = []
+        with torch.no_grad():
+            for n in range(N):
+                corners = []
+                for p in range(0, coords.shape[1], 256 * 256):
+                    c = coords[:, p:p+256*256]
+                    feats = sample_from_planes(self.plane_axes, planes[n:n+1], c, padding_mode='zeros', box_warp=rendering_options['box_warp'])
+                    if hasattr(self.decoder, 'query_sigma'):
+                        sigma = self.decoder.query_sigma(feats)
+                    else:
+                        sigma = self.decoder(feats, torch.zeros_like(c))['sigma']
+                    corners.append(F.softplus(sigma.reshape(-1).float() - 1))
+                corners = (torch.cat(corners, 0) > threshold).reshape(1, 1, R + 1, R + 1, R + 1).float()
+                # a cell is occupied if any of its 8 corners is
+                cells = F.max_pool3d(corners, kernel_size=2, stride=1)
+                if dilation > 0:
+                    cells = F.max_pool3d(cells, kernel_size=2 * dilation + 1, stride=1, padding=dilation)
+                occupancy.append(cells[0, 0] > 0)
+        return torch.stack(occupancy, 0)
+
     def sort_samples(self, all_depths, all_colors, all_densities):
         _, indices = torch.sort(all_depths, dim=-2)
         all_depths = torch.gather(all_depths, -2, indices)